@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 多账号频道池: 一致性哈希分配群聊/好友, 账号异常时切换
+
+
+import bisect
+import hashlib
+import logging
+import threading
+
+from plugins.send_msg.breaker import CircuitBreaker
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class Account:
+    """
+    一个已登录的微信账号。
+    接口调用经过熔断器: 连续 failure_threshold 次失败后熔断 down_time 秒, 期间不再使用;
+    有 probe 时到期后在后台调用 probe (例如刷新通讯录) 检查账号是否恢复, 否则放行一次发送作为探测。
+    """
+
+    def __init__(self, name, channel, channel_type, directory=None, failure_threshold=3, down_time=60,
+                 max_down_time=600, probe=None):
+        self.name = name
+        self.channel = channel
+        self.channel_type = channel_type
+        self.directory = directory
+        self.breaker = CircuitBreaker(f"账号 {name}", failure_threshold=failure_threshold, reset_timeout=down_time,
+                                      max_reset_timeout=max_down_time, probe=probe)
+
+        self.sent = 0
+        self.failed = 0
+
+    @property
+    def alive(self):
+        return self.breaker.available()
+
+    def record_success(self):
+        self.sent += 1
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.failed += 1
+        self.breaker.record_failure()
+
+    def mark_down(self, seconds=None):
+        self.breaker.trip(seconds)
+
+    def mark_up(self):
+        self.breaker.reset()
+
+    def __repr__(self):
+        return f"Account({self.name}, {self.channel_type})"
+
+
+class ChannelPool:
+    """
+    多账号频道池。
+    每个群聊/好友按名称在一致性哈希环上确定账号的先后顺序, affinity 中指定的账号优先;
+    调用方按顺序选择第一个可用且能找到该群聊/好友的账号 (群聊只能由群成员账号发送)。
+    账号不可用时只有原本分配给它的群聊/好友会换到环上的下一个账号。
+    """
+
+    def __init__(self, affinity=None, replicas=100):
+        self.affinity = affinity or {}
+        self.replicas = replicas
+        self._accounts = {}
+        self._ring = []
+        self._lock = threading.Lock()
+
+    def add(self, account):
+        with self._lock:
+            self._accounts[account.name] = account
+            self._rebuild()
+        return account
+
+    def remove(self, name):
+        with self._lock:
+            account = self._accounts.pop(name, None)
+            self._rebuild()
+        return account
+
+    def get(self, name):
+        return self._accounts.get(name)
+
+    @property
+    def accounts(self):
+        return list(self._accounts.values())
+
+    def __len__(self):
+        return len(self._accounts)
+
+    def candidates(self, key, alive_only=True):
+        """
+        返回 key 对应的账号列表, 按优先级排列。
+        """
+        ring = self._ring
+        if not ring:
+            return []
+        ordered = []
+        preferred = self.affinity.get(key)
+        if preferred in self._accounts:
+            ordered.append(self._accounts[preferred])
+        start = bisect.bisect(ring, (_hash(key),))
+        for index in range(len(ring)):
+            account = self._accounts.get(ring[(start + index) % len(ring)][1])
+            if account is not None and account not in ordered:
+                ordered.append(account)
+                if len(ordered) == len(self._accounts):
+                    break
+        if alive_only:
+            return [account for account in ordered if account.alive]
+        return ordered
+
+    def stats(self):
+        return {
+            account.name: {
+                "alive": account.alive,
+                "state": account.breaker.state,
+                "sent": account.sent,
+                "failed": account.failed,
+            }
+            for account in self.accounts
+        }
+
+    def _rebuild(self):
+        self._ring = sorted((_hash(f"{name}#{index}"), name)
+                            for name in self._accounts for index in range(self.replicas))
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 压测工具: 使用内存中的 itchat/ntchat 替身端到端驱动插件
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 压测入口, 在 chatgpt-on-wechat 根目录执行: python -m plugins.send_msg.benchmark --help
+
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import tracemalloc
+
+import requests
+
+from bridge.context import Context, ContextType
+from plugins import Event, EventContext
+from plugins.send_msg.send_msg import FileWatcherPlugin
+from plugins.send_msg.benchmark.fakes import FakeItchat, FakeNtchat, MediaServer
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块, 只能通过 --trace-memory 统计内存
+    resource = None
+
+
+MESSAGE_ID = re.compile(r"msg-(\d+)")
+
+
+class Tracker:
+    """
+    按消息 id 统计送达: 一条消息的全部发送到达替身频道时记录端到端耗时。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._expected = {}
+            self._submitted = {}
+            self._remaining = 0
+            self.latencies = []
+            self.deliveries = 0
+            self.last_delivery = None
+            self._done.clear()
+
+    def submit(self, message_id, deliveries):
+        with self._lock:
+            self._expected[message_id] = deliveries
+            self._submitted[message_id] = time.perf_counter()
+            self._remaining += 1
+
+    def on_send(self, content):
+        match = MESSAGE_ID.search(str(content))
+        if not match:
+            return
+        now = time.perf_counter()
+        message_id = int(match.group(1))
+        with self._lock:
+            self.deliveries += 1
+            self.last_delivery = now
+            remaining = self._expected.get(message_id)
+            if remaining is None:
+                return
+            if remaining > 1:
+                self._expected[message_id] = remaining - 1
+                return
+            del self._expected[message_id]
+            self.latencies.append(now - self._submitted.pop(message_id))
+            self._remaining -= 1
+            if self._remaining == 0:
+                self._done.set()
+
+    def wait(self, timeout):
+        return self._done.wait(timeout)
+
+
+class BenchmarkPlugin(FileWatcherPlugin):
+    """
+    使用临时目录和压测配置的插件, 不读取也不修改插件目录下的 spool、死信和 data.json。
+    """
+
+    bench_config = {}
+
+    def load_config(self):
+        return self.bench_config
+
+
+def build_config(work_dir, args):
+    return {
+        "watch": {"enabled": True, "mode": "document", "file": os.path.join(work_dir, "data.json"),
+                  "debounce": args.debounce, "max_delay": args.debounce * 10},
+        "spool": {"dir": os.path.join(work_dir, "spool"), "fsync": not args.no_fsync},
+        "media_cache": {"dir": os.path.join(work_dir, "media_cache")},
+        "dead_letter": {"path": os.path.join(work_dir, "dead_letter.jsonl")},
+        "idempotency": {"path": os.path.join(work_dir, "idempotency.db")},
+        "dispatcher": {"workers": args.workers, "queue_size": 1000000},
+        "prefetch": {"lookahead": args.lookahead},
+        "rate_limit": {"global_rate": 0, "target_rate": 0},
+        "planner": {"batch_size": args.batch},
+        "api": {},
+    }
+
+
+def make_messages(start_id, count, kind, fanout, media_url, text_size):
+    groups = [FakeItchat.room_name(i) for i in range(fanout)]
+    padding = "x" * text_size
+    messages = []
+    for message_id in range(start_id, start_id + count):
+        if kind == "text":
+            content = f"msg-{message_id} {padding}"
+        else:
+            content = f"{media_url}/media/msg-{message_id}.png"
+        messages.append((message_id, {"receiver_name": [], "message": content, "group_name": groups}))
+    return messages
+
+
+def drive_api(plugin, tracker, messages, fanout, args):
+    for start in range(0, len(messages), args.batch):
+        batch = messages[start:start + args.batch]
+        for message_id, _ in batch:
+            tracker.submit(message_id, fanout)
+        response = requests.post(f"{args.api_url}/send_message",
+                                 json={"data_list": [data for _, data in batch]}, timeout=60)
+        response.raise_for_status()
+
+
+def drive_file(plugin, tracker, messages, fanout, args):
+    tmp_path = plugin.file_path + ".tmp"
+    for start in range(0, len(messages), args.batch):
+        batch = messages[start:start + args.batch]
+        # document 模式下插件读取时把文件 rename 为 data.json.claimed, 等上一批被取走后再写入
+        deadline = time.monotonic() + 30
+        while os.path.exists(plugin.file_path) and os.path.getsize(plugin.file_path) and time.monotonic() < deadline:
+            time.sleep(0.002)
+        for message_id, _ in batch:
+            tracker.submit(message_id, fanout)
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump([data for _, data in batch], file, ensure_ascii=False)
+        os.replace(tmp_path, plugin.file_path)
+        if not plugin.observer.is_alive():
+            plugin.handle_message()
+
+
+def drive_command(plugin, tracker, messages, fanout, args):
+    for message_id, data in messages:
+        tracker.submit(message_id, fanout)
+        command = f"$send_msg [] {data['message']} group[{','.join(data['group_name'])}]"
+        e_context = EventContext(Event.ON_HANDLE_CONTEXT, {"context": Context(ContextType.TEXT, command)})
+        plugin.on_handle_context(e_context)
+
+
+DRIVERS = {"api": drive_api, "file": drive_file, "command": drive_command}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def peak_memory_mb(trace_memory):
+    if trace_memory:
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    if resource is not None:
+        # Linux 上 ru_maxrss 的单位为 KB, 为进程启动以来的峰值
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return float("nan")
+
+
+def run_scenario(plugin, tracker, mode, kind, fanout, start_id, args, media_url):
+    messages = make_messages(start_id, args.messages, kind, fanout, media_url, args.text_size)
+    tracker.reset()
+    if args.trace_memory:
+        tracemalloc.reset_peak()
+
+    started = time.perf_counter()
+    DRIVERS[mode](plugin, tracker, messages, fanout, args)
+    completed = tracker.wait(args.timeout)
+    elapsed = (tracker.last_delivery or time.perf_counter()) - started
+
+    return {
+        "mode": mode,
+        "kind": kind,
+        "fanout": fanout,
+        "messages": len(tracker.latencies),
+        "deliveries": tracker.deliveries,
+        "messages_per_second": len(tracker.latencies) / elapsed if elapsed > 0 else 0.0,
+        "deliveries_per_second": tracker.deliveries / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(tracker.latencies, 0.5) * 1000,
+        "p99_ms": percentile(tracker.latencies, 0.99) * 1000,
+        "peak_memory_mb": peak_memory_mb(args.trace_memory),
+        "completed": completed,
+    }
+
+
+def wait_for_api(api_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{api_url}/metrics", timeout=1)
+            return True
+        except requests.RequestException:
+            time.sleep(0.1)
+    return False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="send_msg 插件压测: 使用内存中的 itchat/ntchat 替身与本地媒体服务")
+    parser.add_argument("--channel", choices=["wx", "ntchat"], default="wx")
+    parser.add_argument("--modes", default="api,file,command", help="api, file, command, 逗号分隔")
+    parser.add_argument("--kinds", default="text,img", help="text, img, 逗号分隔")
+    parser.add_argument("--fanout", default="1,10,50", help="每条消息发送的群聊数, 逗号分隔")
+    parser.add_argument("--messages", type=int, default=200, help="每个场景的消息数")
+    parser.add_argument("--batch", type=int, default=50, help="每次 API 请求 / data.json 写入的消息数")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--lookahead", type=int, default=8, help="媒体预取的任务数, 0 为不预取")
+    parser.add_argument("--friends", type=int, default=500)
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--members", type=int, default=500, help="每个群聊的 MemberList 大小")
+    parser.add_argument("--latency", type=float, default=0.005, help="替身频道每次发送的耗时 (秒)")
+    parser.add_argument("--media-size", type=int, default=256 * 1024)
+    parser.add_argument("--media-latency", type=float, default=0.0)
+    parser.add_argument("--text-size", type=int, default=100)
+    parser.add_argument("--debounce", type=float, default=0.05)
+    parser.add_argument("--no-fsync", action="store_true", help="spool 写入时不 fsync")
+    parser.add_argument("--trace-memory", action="store_true", help="使用 tracemalloc 统计每个场景的内存峰值 (会降低吞吐)")
+    parser.add_argument("--api-url", default="http://127.0.0.1:5688")
+    parser.add_argument("--timeout", type=float, default=300, help="每个场景等待全部送达的最长时间")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fanouts = [int(value) for value in args.fanout.split(",")]
+    if max(fanouts) > args.rooms:
+        sys.exit(f"--fanout 不能大于 --rooms ({args.rooms})")
+
+    work_dir = tempfile.mkdtemp(prefix="send_msg_bench_")
+    tracker = Tracker()
+    channel_class = FakeItchat if args.channel == "wx" else FakeNtchat
+    channel = channel_class(friends=args.friends, rooms=args.rooms, members=args.members,
+                            latency=args.latency, on_send=tracker.on_send)
+    media_server = MediaServer(size=args.media_size, latency=args.media_latency).start()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    BenchmarkPlugin.bench_config = build_config(work_dir, args)
+    plugin = BenchmarkPlugin()
+    plugin.bind_channel(channel, args.channel)
+    plugin.directory.refresh()
+
+    modes = args.modes.split(",")
+    if "api" in modes and not wait_for_api(args.api_url):
+        sys.exit(f"API 服务 {args.api_url} 未启动")
+
+    results = []
+    start_id = 0
+    for mode in modes:
+        for kind in args.kinds.split(","):
+            for fanout in fanouts:
+                result = run_scenario(plugin, tracker, mode, kind, fanout, start_id, args, media_server.base_url)
+                start_id += args.messages
+                results.append(result)
+                if not args.json:
+                    print(f"{mode:8} {kind:5} fanout={fanout:<4} msgs={result['messages']:<6} "
+                          f"deliveries={result['deliveries']:<7} {result['messages_per_second']:9.1f} msg/s "
+                          f"{result['deliveries_per_second']:9.1f} sends/s p50={result['p50_ms']:8.1f}ms "
+                          f"p99={result['p99_ms']:8.1f}ms peak={result['peak_memory_mb']:7.1f}MB"
+                          f"{'' if result['completed'] else '  (超时)'}", flush=True)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    media_server.stop()
+    plugin.stop_watch()
+    shutil.rmtree(work_dir, ignore_errors=True)
+    # uvicorn 与消费线程不会自行退出
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 压测用的 itchat/ntchat 替身与本地媒体文件服务
+
+
+import os
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Record(dict):
+    """
+    与 itchat 的返回值一样, 既可以按键也可以按属性访问。
+    """
+
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+class FakeChannel:
+    """
+    替身的公共部分: 每次发送等待 latency 秒, 然后调用 on_send(内容或文件路径)。
+    """
+
+    def __init__(self, friends=500, rooms=200, members=500, latency=0.0, on_send=None):
+        self.friend_count = friends
+        self.room_count = rooms
+        self.member_count = members
+        self.latency = latency
+        self.on_send = on_send
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def _deliver(self, content):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.sent += 1
+        if self.on_send:
+            self.on_send(content)
+
+    @staticmethod
+    def friend_name(index):
+        return f"friend{index}"
+
+    @staticmethod
+    def room_name(index):
+        return f"群聊{index}"
+
+    @staticmethod
+    def member_name(index):
+        return f"member{index}"
+
+
+class FakeItchat(FakeChannel):
+    """
+    itchat 替身, 实现插件用到的通讯录和发送接口。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.friends = [Record(UserName=f"@friend{i}", NickName=f"nick{i}", RemarkName=self.friend_name(i))
+                        for i in range(self.friend_count)]
+        self.rooms = [Record(UserName=f"@@room{i}", NickName=self.room_name(i), MemberList=self._members(i))
+                      for i in range(self.room_count)]
+        self._rooms_by_id = {room.UserName: room for room in self.rooms}
+
+    def _members(self, room_index):
+        return [Record(UserName=f"@member{room_index}_{j}", NickName=self.member_name(j), DisplayName="")
+                for j in range(self.member_count)]
+
+    def get_friends(self, update=False):
+        return self.friends
+
+    def get_chatrooms(self, update=False):
+        return self.rooms
+
+    def update_chatroom(self, userName, detailedMember=False):
+        return self._rooms_by_id.get(userName)
+
+    def search_friends(self, name=None, remarkName=None, **kwargs):
+        name = remarkName or name
+        return [friend for friend in self.friends if name in (friend.RemarkName, friend.NickName)]
+
+    def search_chatrooms(self, name=None, **kwargs):
+        return [room for room in self.rooms if name in room.NickName]
+
+    def send(self, msg, toUserName=None):
+        self._deliver(msg)
+        return Record(BaseResponse=Record(Ret=0))
+
+    def send_image(self, fileDir, toUserName=None):
+        self._deliver(fileDir)
+        return Record(BaseResponse=Record(Ret=0))
+
+    def send_video(self, fileDir, toUserName=None):
+        self._deliver(fileDir)
+        return Record(BaseResponse=Record(Ret=0))
+
+    def send_file(self, fileDir, toUserName=None):
+        self._deliver(fileDir)
+        return Record(BaseResponse=Record(Ret=0))
+
+
+class FakeNtchat(FakeChannel):
+    """
+    ntchat (wechatnt) 替身。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.contacts = [{"wxid": f"wxid_friend{i}", "nickname": f"nick{i}", "remark": self.friend_name(i)}
+                         for i in range(self.friend_count)]
+        self.rooms = [{"wxid": f"{i}@chatroom", "nickname": self.room_name(i)} for i in range(self.room_count)]
+        self.members = [{"wxid": f"wxid_member{j}", "nickname": self.member_name(j), "display_name": ""}
+                        for j in range(self.member_count)]
+
+    def get_contacts(self):
+        return self.contacts
+
+    def get_rooms(self):
+        return self.rooms
+
+    def get_room_members(self, room_wxid):
+        return {"member_list": self.members}
+
+    def send_text(self, to_wxid, content):
+        self._deliver(content)
+
+    def send_room_at_msg(self, to_wxid, content, at_list):
+        self._deliver(content)
+
+    def send_image(self, to_wxid, file_path):
+        self._deliver(file_path)
+
+    def send_video(self, to_wxid, file_path):
+        self._deliver(file_path)
+
+    def send_file(self, to_wxid, file_path):
+        self._deliver(file_path)
+
+
+class MediaServer:
+    """
+    本地 HTTP 媒体服务: 任意路径都返回 size 字节的内容, 响应前等待 latency 秒。
+    """
+
+    def __init__(self, size=256 * 1024, latency=0.0, host="127.0.0.1", port=0):
+        payload = os.urandom(size)
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if latency:
+                    time.sleep(latency)
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
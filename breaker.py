@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 熔断器: 微信接口或下载连续失败时快速失败, 后台探测恢复
+
+
+import time
+import logging
+import threading
+
+from plugins.send_msg.retry import TransientError
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(TransientError):
+    """
+    熔断器打开, 调用没有执行。调度器把任务放回队列 retry_after 秒后再执行, 不计入重试次数。
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    连续 failure_threshold 次失败后打开, reset_timeout 秒内 check 直接抛出 CircuitOpenError。
+    到期后进入半开状态: 有 probe 时由后台线程调用 probe 检查, 没有时放行一次调用作为探测;
+    探测成功后关闭, 失败则重新打开, 打开时间每次加倍, 最长 max_reset_timeout 秒。
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, max_reset_timeout=300, probe=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.probe = probe
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._open_until = 0
+        self._timeout = reset_timeout
+        self._trial = False
+
+        self.opened = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self.probe is None and time.time() >= self._open_until:
+                return HALF_OPEN
+            return self._state
+
+    def available(self):
+        """
+        当前是否允许调用, 与 check 相同但不占用半开时放行的那一次调用。
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            return self.probe is None and not self._trial and time.time() >= self._open_until
+
+    def retry_after(self):
+        return max(0.0, self._open_until - time.time())
+
+    def check(self):
+        """
+        调用前检查, 不允许调用时抛出 CircuitOpenError。
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self.probe is None and not self._trial and time.time() >= self._open_until:
+                # 半开: 放行一次调用, 结果决定关闭还是重新打开
+                self._state = HALF_OPEN
+                self._trial = True
+                return
+            retry_after = max(self._open_until - time.time(), 1.0)
+        raise CircuitOpenError(f"{self.name} 已熔断, {retry_after:.0f} 秒后重试", retry_after)
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != CLOSED:
+                self._close()
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN:
+                self._reopen()
+            elif self._state == CLOSED and self._failures >= self.failure_threshold:
+                self._open(self.reset_timeout)
+
+    def trip(self, seconds=None):
+        """
+        手动打开, 例如账号确认已掉线。
+        """
+        with self._lock:
+            self._open(self.reset_timeout if seconds is None else seconds)
+
+    def reset(self):
+        with self._lock:
+            self._failures = 0
+            self._close()
+
+    def stats(self):
+        return {"state": self.state, "failures": self._failures, "opened": self.opened,
+                "retry_after": self.retry_after()}
+
+    def _open(self, timeout):
+        self._timeout = min(timeout, self.max_reset_timeout) if timeout else 0
+        self._open_until = time.time() + self._timeout
+        self._trial = False
+        was_closed = self._state == CLOSED
+        self._state = OPEN
+        if was_closed:
+            self.opened += 1
+            logger.warning(f"{self.name} 连续失败 {self._failures} 次, 熔断 {self._timeout:.0f} 秒。")
+            # 半开时重新打开由已有的探测线程继续
+            if self.probe is not None:
+                threading.Thread(target=self._probe_loop, name=f"send_msg-probe-{self.name}", daemon=True).start()
+
+    def _reopen(self):
+        """
+        半开探测失败, 重新打开并加倍打开时间。
+        """
+        self._timeout = min(max(self._timeout, self.reset_timeout) * 2, self.max_reset_timeout)
+        self._open_until = time.time() + self._timeout
+        self._trial = False
+        self._state = OPEN
+        logger.warning(f"{self.name} 探测失败, {self._timeout:.0f} 秒后再次探测。")
+
+    def _close(self):
+        if self._state != CLOSED:
+            logger.info(f"{self.name} 已恢复。")
+        self._state = CLOSED
+        self._open_until = 0
+        self._timeout = self.reset_timeout
+        self._trial = False
+
+    def _probe_loop(self):
+        """
+        打开期间的后台探测, 到期后调用 probe, 成功则关闭。
+        """
+        while True:
+            with self._lock:
+                if self._state == CLOSED:
+                    return
+                wait = self._open_until - time.time()
+            if wait > 0:
+                time.sleep(min(wait, 1.0))
+                continue
+
+            with self._lock:
+                if self._state == CLOSED:
+                    return
+                self._state = HALF_OPEN
+            try:
+                self.probe()
+            except Exception as e:
+                logger.warning(f"{self.name} 探测出错: {e}")
+                with self._lock:
+                    if self._state == HALF_OPEN:
+                        self._reopen()
+                continue
+            with self._lock:
+                self._failures = 0
+                self._close()
+            return
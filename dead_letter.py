@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 发送失败消息的死信存储
+
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+
+class DeadLetterStore:
+    """
+    最终发送失败的消息, 以 JSON Lines 追加保存到磁盘。
+    每条记录包含可以重新提交的消息 (message/receiver_name/group_name)、错误原因和尝试次数。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._load()
+
+    def add(self, message, error, attempts=1):
+        """
+        保存一条失败消息, 返回记录 id。
+        """
+        entry = {
+            "id": uuid.uuid4().hex[:12],
+            "time": int(time.time()),
+            "error": str(error),
+            "attempts": attempts,
+            "message": message,
+        }
+        with self._lock:
+            self._entries[entry["id"]] = entry
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        logger.warning(f"消息进入死信队列 {entry['id']}: {error}")
+        return entry["id"]
+
+    def list(self, limit=None):
+        with self._lock:
+            entries = list(self._entries.values())
+        return entries[:limit] if limit else entries
+
+    def get(self, ids=None):
+        """
+        返回指定 id 的记录 (ids 为空时返回全部), 用于重新提交; 提交成功后再调用 remove 删除。
+        """
+        with self._lock:
+            if ids:
+                return [self._entries[entry_id] for entry_id in ids if entry_id in self._entries]
+            return list(self._entries.values())
+
+    def remove(self, ids):
+        with self._lock:
+            removed = [self._entries.pop(entry_id) for entry_id in ids if entry_id in self._entries]
+            if removed:
+                self._rewrite()
+        return removed
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时写了一半的尾行
+                    continue
+                self._entries[entry["id"]] = entry
+
+    def _rewrite(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for entry in self._entries.values():
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
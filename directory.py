@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 好友与群聊通讯录缓存
+
+
+import time
+import logging
+import threading
+
+from plugins.send_msg.metrics import STAGE_SECONDS
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+
+def normalize_name(name):
+    """
+    规范化名称: 一些微信名称是不常见字, 会有特殊符号, 需要除去。
+    """
+    return name.replace("\x7f\x7f", "") if name else name
+
+
+class NameIndex:
+    """
+    名称到记录的哈希索引。
+    fields 按优先级排列, 查找时依次匹配; 同一字段下多个记录同名视为歧义。
+    """
+
+    def __init__(self, records, fields):
+        self.fields = fields
+        self._maps = [{} for _ in fields]
+        for record in records or []:
+            for field_map, field in zip(self._maps, fields):
+                name = normalize_name(record.get(field))
+                if name:
+                    field_map.setdefault(name, []).append(record)
+
+    def lookup(self, name):
+        """
+        返回匹配的候选记录列表, 未找到返回空列表。
+        """
+        name = normalize_name(name)
+        for field_map in self._maps:
+            candidates = field_map.get(name)
+            if candidates:
+                return candidates
+        return []
+
+    def find(self, name):
+        """
+        返回第一个匹配的记录, 名称有歧义时记录警告。
+        """
+        candidates = self.lookup(name)
+        if len(candidates) > 1:
+            logger.warning(f"名称 {name} 匹配到 {len(candidates)} 个对象, 使用第一个。")
+        return candidates[0] if candidates else None
+
+
+class ContactDirectory:
+    """
+    好友与群聊通讯录缓存, itchat 与 ntchat 共用。
+    缓存超过 ttl 后在下次查找时刷新; 查找未命中时强制刷新一次
+    (两次强制刷新至少间隔 miss_refresh_interval 秒); 可选后台定时刷新。
+    每个快照建立名称索引, 群成员索引按群聊快照缓存。
+    """
+
+    # 名称索引字段, 按优先级排列
+    friend_fields = ()
+    room_fields = ()
+    member_fields = ()
+
+    def __init__(self, channel, ttl=300, refresh_interval=0, miss_refresh_interval=10):
+        self.channel = channel
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+
+        self._lock = threading.Lock()
+        self._friends = {}
+        self._rooms = {}
+        self._friends_at = 0
+        self._rooms_at = 0
+        self._friend_index = NameIndex([], self.friend_fields)
+        self._room_index = NameIndex([], self.room_fields)
+        # 群 id -> (群聊快照, 建立时间, 成员索引)
+        self._member_indexes = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.ambiguous = 0
+
+        self._stop_event = threading.Event()
+        self._refresh_thread = None
+
+    # ------------------------------------------------------------------ 查找
+
+    def find_friend(self, name):
+        """
+        通过备注名或昵称查找好友, 未找到返回 None。
+        """
+        return self._find("friends", name)
+
+    def find_chatroom(self, name):
+        """
+        通过群名查找群聊, 未找到返回 None。
+        """
+        return self._find("rooms", name)
+
+    def find_member(self, room, name):
+        """
+        在群聊中通过昵称或群昵称查找成员, 未找到返回 None。
+        同一群聊快照的成员索引只建立一次。
+        """
+        built_at, index = self.member_index(room)
+        member = self._resolve(index, name)
+        if member is not None:
+            self.hits += 1
+            return member
+
+        self.misses += 1
+        if time.time() - built_at > self.miss_refresh_interval:
+            _, index = self.member_index(room, force=True)
+            return self._resolve(index, name)
+        return None
+
+    def member_index(self, room, force=False):
+        """
+        返回群聊的 (建立时间, 成员索引), 群聊快照未变化且未过期时复用。
+        """
+        room_id = self._record_id(room)
+        cached = self._member_indexes.get(room_id)
+        if not force and cached and cached[0] is room and time.time() - cached[1] <= self.ttl:
+            return cached[1], cached[2]
+
+        entry = (room, time.time(), NameIndex(self._fetch_members(room, force), self.member_fields))
+        self._member_indexes[room_id] = entry
+        return entry[1], entry[2]
+
+    def _find(self, kind, name):
+        if self._age(kind) > self.ttl:
+            self.refresh(kind)
+
+        record = self._match(kind, name)
+        if record is not None:
+            self.hits += 1
+            return record
+
+        self.misses += 1
+        if self._age(kind) > self.miss_refresh_interval:
+            self.refresh(kind)
+            return self._match(kind, name)
+        return None
+
+    def _match(self, kind, name):
+        if kind == "friends":
+            return self._resolve(self._friend_index, name)
+        return self._resolve(self._room_index, name) or self._match_room_fallback(name)
+
+    def _resolve(self, index, name):
+        candidates = index.lookup(name)
+        if len(candidates) > 1:
+            self.ambiguous += 1
+            logger.warning(f"名称 {name} 匹配到 {len(candidates)} 个对象, 使用第一个。")
+        return candidates[0] if candidates else None
+
+    def _match_room_fallback(self, name):
+        return None
+
+    def _age(self, kind):
+        refreshed_at = self._friends_at if kind == "friends" else self._rooms_at
+        return time.time() - refreshed_at
+
+    # ------------------------------------------------------------------ 刷新
+
+    def refresh(self, kind=None):
+        """
+        重新拉取通讯录, kind 为 "friends"、"rooms" 或 None (全部)。
+        按 id 合并, 未变化的记录保留原对象, 有变化时重建名称索引, 返回变化的记录数。
+        """
+        changed = 0
+        with self._lock, STAGE_SECONDS.time(stage="directory_refresh"):
+            if kind in (None, "friends"):
+                self._friends, count = self._merge(self._friends, self._fetch_friends())
+                if count or not self._friends_at:
+                    self._friend_index = NameIndex(self._friends.values(), self.friend_fields)
+                self._friends_at = time.time()
+                changed += count
+            if kind in (None, "rooms"):
+                self._rooms, count = self._merge(self._rooms, self._fetch_rooms())
+                if count or not self._rooms_at:
+                    self._room_index = NameIndex(self._rooms.values(), self.room_fields)
+                    # 已解散或退出的群聊不再保留成员索引
+                    for room_id in self._member_indexes.keys() - self._rooms.keys():
+                        self._member_indexes.pop(room_id, None)
+                self._rooms_at = time.time()
+                changed += count
+            self.refreshes += 1
+        return changed
+
+    def _merge(self, old, records):
+        merged = {}
+        changed = 0
+        for record in records or []:
+            record_id = self._record_id(record)
+            previous = old.get(record_id)
+            if previous is not None and previous == record:
+                merged[record_id] = previous
+            else:
+                merged[record_id] = record
+                changed += 1
+        changed += len(old.keys() - merged.keys())
+        return merged, changed
+
+    def start_background_refresh(self):
+        """
+        启动后台刷新线程, refresh_interval 为 0 时不启动。
+        """
+        if not self.refresh_interval or self._refresh_thread is not None:
+            return
+        self._refresh_thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self):
+        self._stop_event.set()
+
+    def _refresh_loop(self):
+        while not self._stop_event.wait(self.refresh_interval):
+            try:
+                changed = self.refresh()
+                if changed:
+                    logger.info(f"通讯录后台刷新完成, 变化 {changed} 条。")
+            except Exception as e:
+                logger.warning(f"通讯录后台刷新失败: {e}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "hit_rate": self.hits / total if total else 0.0,
+            "ambiguous": self.ambiguous,
+            "friends": len(self._friends),
+            "rooms": len(self._rooms),
+        }
+
+    # ------------------------------------------------------------------ 子类实现
+
+    def _fetch_friends(self):
+        raise NotImplementedError
+
+    def _fetch_rooms(self):
+        raise NotImplementedError
+
+    def _fetch_members(self, room, force=False):
+        raise NotImplementedError
+
+    def _record_id(self, record):
+        raise NotImplementedError
+
+
+class ItchatDirectory(ContactDirectory):
+    """
+    itchat 通讯录缓存。
+    """
+
+    friend_fields = ("RemarkName", "NickName", "DisplayName")
+    room_fields = ("NickName",)
+    member_fields = ("NickName", "DisplayName")
+
+    def _fetch_friends(self):
+        return self.channel.get_friends(update=True)
+
+    def _fetch_rooms(self):
+        return self.channel.get_chatrooms(update=True)
+
+    def _fetch_members(self, room, force=False):
+        if force:
+            # 成员未命中时拉取群成员详情, 新入群的成员才能找到
+            room = self.channel.update_chatroom(room.get("UserName"), detailedMember=True) or room
+        return room.get("MemberList") or []
+
+    def _record_id(self, record):
+        return record.get("UserName")
+
+    def _match_room_fallback(self, name):
+        # 与 itchat.search_chatrooms 一致: 完全匹配失败时使用包含匹配
+        for room in list(self._rooms.values()):
+            if name in (room.get("NickName") or ""):
+                return room
+        return None
+
+
+class NtchatDirectory(ContactDirectory):
+    """
+    ntchat 通讯录缓存。
+    """
+
+    friend_fields = ("nickname", "remark")
+    room_fields = ("nickname",)
+    member_fields = ("nickname", "display_name", "remark")
+
+    def _fetch_friends(self):
+        return self.channel.get_contacts()
+
+    def _fetch_rooms(self):
+        return self.channel.get_rooms()
+
+    def _fetch_members(self, room, force=False):
+        room_members = self.channel.get_room_members(room.get("wxid")) or {}
+        return room_members.get("member_list", [])
+
+    def _record_id(self, record):
+        return record.get("wxid")
@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 消息发送调度: 工作线程池与令牌桶限流
+
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import deque
+
+from plugins.send_msg.metrics import STAGE_SECONDS, LANE_WAIT
+from plugins.send_msg.breaker import CircuitOpenError
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    令牌桶: 每秒补充 rate 个令牌, 最多积累 burst 个。
+    reserve 先扣除令牌 (可以欠账), 返回需要等待的秒数。
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= cost
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def is_full(self):
+        with self._lock:
+            return self.tokens + (time.monotonic() - self.updated_at) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """
+    每个账号的限流与每个群聊/好友的限流, rate 为 0 表示不限流。
+    未指定账号的任务共用一个全局令牌桶。
+    """
+
+    # 单目标令牌桶超过该数量时清理已经回满的桶
+    max_buckets = 10000
+
+    def __init__(self, global_rate=2.0, global_burst=10, target_rate=1.0, target_burst=5):
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self._account_buckets = {}
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, keys=(), cost=1, account=None):
+        """
+        为一次发送扣除令牌, 阻塞到所有相关的桶都允许发送, 返回等待的秒数。
+        """
+        waits = [0.0]
+        if account is not None and self.global_rate:
+            waits.append(self._account_bucket(account).reserve(cost))
+        elif self.global_bucket:
+            waits.append(self.global_bucket.reserve(cost))
+        if self.target_rate:
+            for key in keys:
+                waits.append(self._bucket(key).reserve(cost))
+        delay = max(waits)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def estimate(self, sends):
+        """
+        估计按当前限流发送完 sends ([(账号, 限流目标, 次数), ...]) 需要的秒数, 按各令牌桶初始为满计算。
+        不同账号、不同目标并行, 结果为最慢的一个桶排空所需的时间。
+        """
+        account_costs = {}
+        target_costs = {}
+        for account, keys, cost in sends:
+            account_costs[account] = account_costs.get(account, 0) + cost
+            for key in keys:
+                target_costs[key] = target_costs.get(key, 0) + cost
+        seconds = [0.0]
+        if self.global_rate:
+            seconds.extend((cost - self.global_burst) / self.global_rate for cost in account_costs.values())
+        if self.target_rate:
+            seconds.extend((cost - self.target_burst) / self.target_rate for cost in target_costs.values())
+        return max(0.0, max(seconds))
+
+    def _account_bucket(self, account):
+        with self._lock:
+            bucket = self._account_buckets.get(account)
+            if bucket is None:
+                bucket = self._account_buckets[account] = TokenBucket(self.global_rate, self.global_burst)
+            return bucket
+
+    def _bucket(self, key):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full()}
+                bucket = TokenBucket(self.target_rate, self.target_burst)
+                self._buckets[key] = bucket
+            return bucket
+
+
+# 发送优先级, 从高到低; 每个优先级一个队列 (lane)
+LANES = ("urgent", "normal", "bulk")
+DEFAULT_LANE = "normal"
+# 各队列的调度权重: 都有任务时按权重比例分配工作线程, bulk 至少分到 1/21
+DEFAULT_LANE_WEIGHTS = {"urgent": 16, "normal": 4, "bulk": 1}
+
+
+class Job:
+    """
+    一个待执行的发送任务。
+    key 相同的任务按提交顺序串行执行; limit_keys 为限流使用的目标, cost 为发送次数, account 为发送账号,
+    lane 为优先级队列, prefetch 为任务即将执行时提前调用的准备函数 (例如预先下载文件)。
+    """
+
+    def __init__(self, func, key=None, limit_keys=None, cost=1, callback=None, account=None, lane=DEFAULT_LANE,
+                 prefetch=None):
+        self.func = func
+        self.prefetch = prefetch
+        self.key = key
+        self.account = account
+        self.lane = lane
+        self.limit_keys = limit_keys if limit_keys is not None else ((key,) if key else ())
+        self.cost = cost
+        self.callback = callback
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class Dispatcher:
+    """
+    有界工作线程池。
+    任务在独立线程中执行, 不阻塞 watchdog 线程; 同一 key 的任务保持顺序,
+    不同 key 的任务并发执行; 每次执行前按 RateLimiter 限流。
+    失败的任务按 retry_policy 延迟后重新执行, 等待期间不占用工作线程, 同一 key 的后续任务继续等待以保持顺序;
+    抛出 CircuitOpenError 的任务在熔断恢复时重新执行, 不计入重试次数。
+    任务按 lane 分队列, 空闲的工作线程按平滑加权轮询从有任务的队列中选取, 高优先级任务不必等待排在前面的批量任务,
+    低优先级队列仍按权重分到工作线程, 不会饿死。顺序只在同一 lane 的同一 key 内保证。
+    queue_size 为每个 lane 的上限。
+    工作线程取出任务时, 对接下来要执行的任务调用其 prefetch (每个任务只调用一次), 见 _take_prefetches。
+    """
+
+    def __init__(self, workers=4, queue_size=10000, rate_limiter=None, retry_policy=None, lane_weights=None,
+                 lookahead=0):
+        self.workers = workers
+        self.lookahead = lookahead
+        self.queue_size = queue_size
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retry_policy = retry_policy
+        self.lane_weights = {**DEFAULT_LANE_WEIGHTS, **(lane_weights or {})}
+        # 等待重试的任务: (到期时间, 序号, 任务)
+        self._delayed = []
+        self._delayed_counter = itertools.count()
+        self._cond = threading.Condition()
+        # lane -> 可以立即执行的任务
+        self._ready = {lane: deque() for lane in LANES}
+        self._ready_count = 0
+        # 平滑加权轮询的当前权重
+        self._lane_current = dict.fromkeys(LANES, 0)
+        # (lane, key) -> 等待同一 key 前序任务完成的任务
+        self._chains = {}
+        # 已提交但尚未开始执行的任务数 (包括等待前序任务的), 总数和每个 lane 的
+        self._pending = 0
+        self._lane_pending = dict.fromkeys(LANES, 0)
+        self._lane_wait = {lane: [0, 0.0] for lane in LANES}
+        self._threads = []
+        self._running = False
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        # 因熔断放回队列的次数
+        self.held = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"send_msg-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._retry_loop, name="send_msg-retry", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._threads = []
+
+    def submit(self, func, key=None, limit_keys=None, cost=1, callback=None, block=True, timeout=None, account=None,
+               lane=DEFAULT_LANE, prefetch=None):
+        """
+        提交任务, lane 的队列已满时按 block/timeout 等待, 超时返回 False。
+        callback(error, attempts) 在任务最终成功或放弃重试后调用, 成功时 error 为 None。
+        """
+        if lane not in LANES:
+            raise ValueError(f"未知的优先级: {lane}")
+        job = Job(func, key=key, limit_keys=limit_keys, cost=cost, callback=callback, account=account, lane=lane,
+                  prefetch=prefetch)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while self._lane_pending[lane] >= self.queue_size:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if not block or (remaining is not None and remaining <= 0):
+                    return False
+                self._cond.wait(remaining)
+
+            self._pending += 1
+            self._lane_pending[lane] += 1
+            if key is not None:
+                chain = self._chains.get((lane, key))
+                if chain is not None:
+                    chain.append(job)
+                    return True
+                self._chains[(lane, key)] = deque()
+            self._push_ready(job)
+            self._cond.notify_all()
+        return True
+
+    def queue_depth(self):
+        return self._pending
+
+    def lane_depths(self):
+        return {(lane,): count for lane, count in self._lane_pending.items()}
+
+    def stats(self):
+        finished = self.completed + self.failed
+        return {
+            "queue_depth": self._pending,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "failed": self.failed,
+            "retrying": len(self._delayed),
+            "retried": self.retried,
+            "held": self.held,
+            "wait_avg": self.wait_total / finished if finished else 0.0,
+            "wait_max": self.wait_max,
+            "lanes": {
+                lane: {
+                    "queue_depth": self._lane_pending[lane],
+                    "wait_avg": total / count if count else 0.0,
+                }
+                for lane, (count, total) in self._lane_wait.items()
+            },
+        }
+
+    def _push_ready(self, job):
+        self._ready[job.lane].append(job)
+        self._ready_count += 1
+
+    def _pop_ready(self):
+        """
+        平滑加权轮询: 每个有任务的 lane 加上自己的权重, 选当前值最大的, 被选中的减去本轮的总权重。
+        """
+        total = 0
+        best = None
+        for lane in LANES:
+            if not self._ready[lane]:
+                continue
+            weight = self.lane_weights[lane]
+            self._lane_current[lane] += weight
+            total += weight
+            if best is None or self._lane_current[lane] > self._lane_current[best]:
+                best = lane
+        self._lane_current[best] -= total
+        self._ready_count -= 1
+        return self._ready[best].popleft()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._running and not self._ready_count:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                job = self._pop_ready()
+                self._pending -= 1
+                self._lane_pending[job.lane] -= 1
+                self.in_flight += 1
+                self._cond.notify_all()
+                prefetches = self._take_prefetches(job)
+            for prefetch in prefetches:
+                try:
+                    prefetch()
+                except Exception as e:
+                    logger.warning(f"预取出错: {e}")
+            self._run(job)
+
+    def _take_prefetches(self, job):
+        """
+        取出接下来要执行的任务尚未调用的 prefetch: 同一 key 排在当前任务之后的 lookahead 个任务,
+        以及各 lane 中排在最前的 lookahead 个任务。当前任务自己下载, 不再预取。
+        """
+        if not self.lookahead:
+            return []
+        job.prefetch = None
+        chain = self._chains.get((job.lane, job.key)) if job.key is not None else None
+        queues = [chain] if chain else []
+        queues.extend(self._ready[lane] for lane in LANES)
+        prefetches = []
+        for candidate in itertools.chain.from_iterable(itertools.islice(queue, self.lookahead) for queue in queues):
+            if candidate.prefetch is not None:
+                prefetches.append(candidate.prefetch)
+                candidate.prefetch = None
+        return prefetches
+
+    def _run(self, job):
+        error = None
+        job.attempts += 1
+        try:
+            self.rate_limiter.acquire(job.limit_keys, job.cost, job.account)
+            waited = time.monotonic() - job.enqueued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            lane_wait = self._lane_wait[job.lane]
+            lane_wait[0] += 1
+            lane_wait[1] += waited
+            STAGE_SECONDS.observe(waited, stage="queue_wait")
+            LANE_WAIT.observe(waited, lane=job.lane)
+            job.func()
+        except CircuitOpenError as e:
+            # 熔断期间任务留在队列中, 恢复后再执行, 不计入重试次数
+            job.attempts -= 1
+            with self._cond:
+                self.in_flight -= 1
+                self.held += 1
+                heapq.heappush(self._delayed, (time.monotonic() + e.retry_after, next(self._delayed_counter), job))
+                self._cond.notify_all()
+            logger.debug(f"发送任务等待熔断恢复: {e}")
+            return
+        except Exception as e:
+            error = e
+            logger.error(f"发送任务执行出错 (第 {job.attempts} 次): {e}")
+
+        if error is not None and self.retry_policy and self.retry_policy.should_retry(error, job.attempts):
+            delay = self.retry_policy.delay(job.attempts)
+            with self._cond:
+                self.in_flight -= 1
+                self.retried += 1
+                heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._delayed_counter), job))
+                self._cond.notify_all()
+            logger.info(f"发送任务 {delay:.1f} 秒后重试。")
+            return
+
+        with self._cond:
+            self.in_flight -= 1
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+            if job.key is not None:
+                # 前序任务结束, 同一 key 的下一个任务可以执行
+                chain = self._chains.get((job.lane, job.key))
+                if chain:
+                    self._push_ready(chain.popleft())
+                else:
+                    self._chains.pop((job.lane, job.key), None)
+            self._cond.notify_all()
+        if job.callback:
+            try:
+                job.callback(error, job.attempts)
+            except Exception as e:
+                logger.error(f"发送任务回调出错: {e}")
+
+    def _retry_loop(self):
+        """
+        把到期的重试任务放回可执行队列。
+        """
+        with self._cond:
+            while self._running:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, job = heapq.heappop(self._delayed)
+                    job.enqueued_at = now
+                    self._push_ready(job)
+                    self._pending += 1
+                    self._lane_pending[job.lane] += 1
+                    self._cond.notify_all()
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._cond.wait(timeout)
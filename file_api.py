@@ -7,14 +7,22 @@
 # Desc  :
 
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel, validator
-from typing import List, Dict
+from typing import Any, List, Dict, Optional, Union
 from urllib.parse import unquote
 import json
 from common.log import logger
+from plugins.send_msg.metrics import registry, STAGE_SECONDS, IDEMPOTENT_REPLAYS
+from plugins.send_msg.dispatcher import LANES
+from plugins.send_msg.idempotency import DONE, PENDING
+from plugins.send_msg.spool import SpoolWriter
+from plugins.send_msg.scheduler import parse_send_at, parse_interval
+from plugins.send_msg.template import validate_template_request
 import threading
-import os
+import asyncio
+import time
 
 # FastAPI app initialization
 app = FastAPI()
@@ -22,6 +30,34 @@ app = FastAPI()
 # Define data model for validation
 class DataItem(BaseModel):
     message: str
+    # Optional client-side id: an item whose id was already accepted is answered with its original seq
+    id: Optional[str] = None
+    receiver_name: List[str] = []
+    group_name: List[str] = []
+    # Optional scheduling: send time (timestamp or ISO 8601 local time), repeat interval and random delay
+    send_at: Optional[Union[float, str]] = None
+    repeat: Optional[Union[float, str]] = None
+    jitter: Optional[Union[float, str]] = None
+    # Dispatch lane: urgent, normal (default) or bulk
+    priority: Optional[str] = None
+
+    @validator('send_at')
+    def validate_send_at(cls, v):
+        return parse_send_at(v)
+
+    @validator('priority')
+    def validate_priority(cls, v):
+        if v is not None and v not in LANES:
+            raise ValueError(f"priority只能是 {', '.join(LANES)}")
+        return v
+
+    @validator('repeat')
+    def validate_repeat(cls, v):
+        return parse_interval(v)
+
+    @validator('jitter')
+    def validate_jitter(cls, v):
+        return parse_interval(v, allow_zero=True)
 
     @validator('message')
     def decode_message(cls, v):
@@ -36,35 +72,207 @@ class RequestData(BaseModel):
 
     @validator('data_list')
     def validate_data_list(cls, v):
+        # 元素类型和 message 字段已由 DataItem 校验
         if not v:
             raise ValueError('data_list不能为空')
-        for item in v:
-            if not isinstance(item, dict):
-                raise ValueError('data_list的每个元素必须为字典类型')
-            if 'message' not in item:
-                raise ValueError('每个消息必须包含message')
         return v
 
 
+class TemplateRequest(BaseModel):
+    # One template plus compact per-recipient rows, stored as a single record and rendered per delivery
+    template: str
+    columns: List[str] = []
+    receiver_name: List[str] = []
+    group_name: List[str] = []
+    # rows is validated after the fields above so shared targets and columns are available
+    rows: List[Union[List[Any], Dict[str, Any]]]
+    send_at: Optional[Union[float, str]] = None
+    repeat: Optional[Union[float, str]] = None
+    jitter: Optional[Union[float, str]] = None
+    # Dispatch lane: urgent, normal (default) or bulk
+    priority: Optional[str] = None
+
+    @validator('send_at')
+    def validate_send_at(cls, v):
+        return parse_send_at(v)
+
+    @validator('priority')
+    def validate_priority(cls, v):
+        if v is not None and v not in LANES:
+            raise ValueError(f"priority只能是 {', '.join(LANES)}")
+        return v
+
+    @validator('repeat')
+    def validate_repeat(cls, v):
+        return parse_interval(v)
+
+    @validator('jitter')
+    def validate_jitter(cls, v):
+        return parse_interval(v, allow_zero=True)
+
+    @validator('template')
+    def decode_template(cls, v):
+        try:
+            return unquote(v)
+        except Exception as e:
+            logger.warning(f"解码 template 失败: {str(e)}, 使用原始值: {v}")
+            return v
+
+    @validator('rows')
+    def validate_rows(cls, v, values):
+        if not v:
+            raise ValueError('rows不能为空')
+        if 'template' in values:
+            shared_targets = bool(values.get('receiver_name') or values.get('group_name'))
+            validate_template_request(values['template'], values.get('columns') or [], v, shared_targets)
+        return v
+
+
+def handoff(seqs, records):
+    # Records without a sink stay in the spool and are replayed when the plugin starts
+    sink = app.state.sink
+    if sink is not None:
+        sink(list(zip(seqs, records)))
+
+
+async def commit(records):
+    # Append through the group-commit writer thread and hand off once durable; the loop only awaits
+    return await asyncio.wrap_future(app.state.writer.submit(records))
+
+
+async def claim(store, key):
+    # Claims answered from memory stay on the loop; those needing the SQLite index run in a thread
+    claimed = store.claim_cached(key)
+    if claimed is None:
+        claimed = await asyncio.to_thread(store.claim, key)
+    return claimed
+
+
+async def claim_request(idempotency_key):
+    # Returns (store key, stored response); the key is None when there is nothing to record
+    store = app.state.idempotency
+    if not idempotency_key or store is None:
+        return None, None
+    key = f"request:{idempotency_key}"
+    status, result = await claim(store, key)
+    if status == DONE:
+        return None, result
+    if status == PENDING:
+        raise HTTPException(status_code=409, detail="相同 Idempotency-Key 的请求正在处理")
+    return key, None
+
+
+def release_request(key):
+    if key is not None:
+        app.state.idempotency.release(key)
+
+
+def replay(result):
+    IDEMPOTENT_REPLAYS.inc(scope="request")
+    return JSONResponse(content=result, headers={"Idempotent-Replayed": "true"})
+
+
+async def finish_request(key, result):
+    # Persisting the key may touch the disk index, so keep it off the event loop
+    if key is not None:
+        await asyncio.to_thread(app.state.idempotency.complete_many, [(key, result)])
+    return result
+
+
+async def commit_items(items, allow_conflicts=False):
+    """
+    Commit DataItems, skipping those whose id was already accepted (answered with the stored seq).
+    Items whose id is being committed by another request are conflicts: with allow_conflicts they
+    are left out (ids entry None), otherwise the whole call fails with 409 before anything is written.
+    Returns (ids, duplicates, conflict indexes).
+    """
+    store = app.state.idempotency
+    ids = [None] * len(items)
+    fresh = []
+    conflicts = []
+    # store key -> indexes of items carrying it in this call, the first one is committed
+    claimed = {}
+    for index, item in enumerate(items):
+        if item.id is None or store is None:
+            fresh.append(index)
+            continue
+        key = f"item:{item.id}"
+        if key in claimed:
+            claimed[key].append(index)
+            continue
+        status, result = await claim(store, key)
+        if status == DONE:
+            ids[index] = result
+        elif status == PENDING:
+            conflicts.append(index)
+        else:
+            claimed[key] = [index]
+            fresh.append(index)
+
+    if conflicts and not allow_conflicts:
+        for key in claimed:
+            store.release(key)
+        raise HTTPException(status_code=409, detail="相同 id 的消息正在处理")
+
+    try:
+        seqs = await commit([items[index].dict(exclude_none=True) for index in fresh])
+    except Exception:
+        for key in claimed:
+            store.release(key)
+        raise
+    for index, seq in zip(fresh, seqs):
+        ids[index] = seq
+    for indexes in claimed.values():
+        for index in indexes[1:]:
+            ids[index] = ids[indexes[0]]
+    if claimed:
+        await asyncio.to_thread(store.complete_many, [(key, ids[indexes[0]]) for key, indexes in claimed.items()])
+
+    duplicates = len(items) - len(fresh) - len(conflicts)
+    if duplicates:
+        IDEMPOTENT_REPLAYS.inc(duplicates, scope="item")
+    return ids, duplicates, conflicts
+
+
 # POST route to handle send_message requests
 @app.post("/send_message")
-async def send_message(request_data: RequestData):
+async def send_message(request_data: RequestData, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+                       dry_run: bool = False):
+    if dry_run:
+        return await plan_data_list(request_data.data_list)
+    # A retried request with the same Idempotency-Key gets the first response without being written again
+    request_key, stored = await claim_request(idempotency_key)
+    if stored is not None:
+        return replay(stored)
     try:
-        data_list = request_data.data_list
+        result = await write_data_list(request_data.data_list)
+    except BaseException:
+        release_request(request_key)
+        raise
+    return await finish_request(request_key, result)
+
 
+async def write_data_list(data_list):
+    try:
         # Validate the data (this is now handled by Pydantic validators)
         try:
-            # Proceed to save data after validation
-            curdir = os.path.dirname(__file__)
-            config_path = os.path.join(curdir, "data.json")
-            with open(config_path, 'w', encoding='utf-8') as file:
-                json.dump([item.dict() for item in data_list], file, ensure_ascii=False)
-            logger.info(f"写入成功,写入内容{data_list}")
-            return {"status": "success", "message": "发送成功"}
+            # Append to the message spool for durability, then hand the records to the plugin in-process
+            with STAGE_SECONDS.time(stage="api"):
+                seqs, duplicates, _ = await commit_items(data_list)
+            logger.info(f"写入成功,写入内容{data_list}, 序号{seqs}")
+            result = {"status": "success", "message": "发送成功", "ids": seqs}
+            if duplicates:
+                result["duplicates"] = duplicates
+            return result
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"写入文件时发生错误: {str(e)}")
             raise HTTPException(status_code=500, detail="服务器内部错误")
 
+    except HTTPException:
+        raise
+
     except ValueError as e:
         logger.error(f"数据验证失败: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
@@ -74,15 +282,204 @@ async def send_message(request_data: RequestData):
         raise HTTPException(status_code=500, detail="服务器内部错误")
 
 
+async def plan_data_list(data_list):
+    # Dry run: resolve targets and media types through the plugin's planner, nothing is written or sent
+    planner = app.state.dry_run
+    if planner is None:
+        raise HTTPException(status_code=503, detail="插件启动中, 预演暂不可用")
+    records = [item.dict(exclude_none=True) for item in data_list]
+    try:
+        # Resolution may refresh the contact directory or probe media URLs, keep it off the event loop
+        report = await asyncio.to_thread(planner, records)
+    except Exception as e:
+        logger.error(f"预演发送计划时发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail="服务器内部错误")
+    logger.info(f"预演发送计划, 消息 {report['items']} 条, 发送 {len(report['deliveries'])} 次")
+    return {"status": "success", "message": "预演成功", "dry_run": True, **report}
+
+
+# POST route for a templated fan-out: one template, one row of variables per recipient
+@app.post("/send_message/template")
+async def send_message_template(request_data: TemplateRequest,
+                                idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    request_key, stored = await claim_request(idempotency_key)
+    if stored is not None:
+        return replay(stored)
+    try:
+        with STAGE_SECONDS.time(stage="api"):
+            record = request_data.dict(exclude_none=True)
+            seqs = await commit([record])
+        logger.info(f"写入模板消息成功, {len(request_data.rows)} 行, 序号{seqs}")
+        result = {"status": "success", "message": "发送成功", "ids": seqs, "rows": len(request_data.rows)}
+    except Exception as e:
+        release_request(request_key)
+        logger.error(f"写入模板消息时发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail="服务器内部错误")
+    return await finish_request(request_key, result)
+
+
+# POST route to ingest newline-delimited JSON, one DataItem per line
+@app.post("/send_message/stream")
+async def send_message_stream(request: Request):
+    config = app.state.config
+    batch_size = config.get("stream_batch_size", 500)
+    max_pending = config.get("stream_max_pending", 50000)
+    backpressure_timeout = config.get("stream_backpressure_timeout", 30)
+
+    spool = app.state.spool
+    ids = []
+    errors = {}
+    duplicates = [0]
+    batch = []
+    started = time.monotonic()
+
+    async def flush():
+        # Wait while the consumer is too far behind, then append the batch in one write
+        deadline = time.monotonic() + backpressure_timeout
+        while spool.pending_count() >= max_pending:
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.05)
+        with STAGE_SECONDS.time(stage="api"):
+            seqs, batch_duplicates, conflicts = await commit_items([item for _, item in batch], allow_conflicts=True)
+        for (line_no, _), seq in zip(batch, seqs):
+            ids[line_no] = seq
+        for index in conflicts:
+            errors[batch[index][0] + 1] = "相同 id 的消息正在处理"
+        duplicates[0] += batch_duplicates
+        batch.clear()
+        return True
+
+    def parse(raw):
+        line_no = len(ids)
+        ids.append(None)
+        raw = raw.strip()
+        if not raw:
+            return
+        try:
+            batch.append((line_no, DataItem(**json.loads(raw))))
+        except Exception as e:
+            errors[line_no + 1] = str(e)
+
+    buffer = b""
+    completed = True
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for raw in lines:
+            parse(raw)
+        if len(batch) >= batch_size and not await flush():
+            completed = False
+            break
+    if completed:
+        if buffer.strip():
+            parse(buffer)
+        completed = not batch or await flush()
+
+    accepted = sum(1 for seq in ids if seq is not None)
+    if not completed:
+        # The consumer did not catch up in time: report what was accepted so the client can resume
+        logger.error(f"流式写入背压超时, 已接收 {accepted} 条")
+        return JSONResponse(status_code=503, content={
+            "status": "error", "message": "发送队列已满, 请稍后重试",
+            "accepted": accepted, "rejected": len(errors), "ids": ids, "errors": errors,
+        })
+
+    elapsed = time.monotonic() - started
+    rate = accepted / elapsed if elapsed > 0 else 0.0
+    logger.info(f"流式写入完成: 接收 {accepted} 条, 拒绝 {len(errors)} 条, {rate:.0f} 条/秒")
+    return {"status": "success", "accepted": accepted, "rejected": len(errors), "duplicates": duplicates[0],
+            "records_per_second": rate, "ids": ids, "errors": errors}
+
+
+# GET route exposing stage latencies, counters and queue/cache gauges in Prometheus text format
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+# GET route listing pending scheduled messages, earliest first
+@app.get("/schedules")
+async def list_schedules(limit: int = 100):
+    scheduler = app.state.scheduler
+    if scheduler is None:
+        raise HTTPException(status_code=404, detail="未启用定时消息")
+    return {"status": "success", "total": len(scheduler), "entries": scheduler.list(limit)}
+
+
+# DELETE route cancelling a scheduled (or recurring) message by the id returned from /send_message
+@app.delete("/schedules/{entry_id}")
+async def cancel_schedule(entry_id: str):
+    scheduler = app.state.scheduler
+    if scheduler is None or not scheduler.cancel(entry_id):
+        raise HTTPException(status_code=404, detail=f"未找到定时消息: {entry_id}")
+    return {"status": "success", "id": entry_id}
+
+
+class ReplayRequest(BaseModel):
+    ids: List[str] = []
+
+
+# GET route to inspect messages that failed after all retries
+@app.get("/dead_letters")
+async def list_dead_letters(limit: int = 100):
+    dead_letters = app.state.dead_letters
+    if dead_letters is None:
+        raise HTTPException(status_code=404, detail="未启用死信队列")
+    return {"status": "success", "total": len(dead_letters), "entries": dead_letters.list(limit)}
+
+
+# POST route to resubmit dead letters (all of them when ids is empty)
+@app.post("/dead_letters/replay")
+async def replay_dead_letters(replay_request: ReplayRequest = None):
+    dead_letters = app.state.dead_letters
+    if dead_letters is None:
+        raise HTTPException(status_code=404, detail="未启用死信队列")
+    entries = dead_letters.get(replay_request.ids if replay_request else None)
+    if not entries:
+        return {"status": "success", "replayed": 0, "ids": []}
+    records = [entry["message"] for entry in entries]
+    # Remove the entries only once the records are durable in the spool, a failed commit keeps them
+    seqs = await commit(records)
+    await asyncio.to_thread(dead_letters.remove, [entry["id"] for entry in entries])
+    logger.info(f"重新提交死信 {[entry['id'] for entry in entries]}, 序号{seqs}")
+    return {"status": "success", "replayed": len(seqs), "ids": seqs}
+
+
 # FileWriter class to run the FastAPI app in a separate thread
 class FileWriter:
-    def __init__(self):
+    def __init__(self, spool, config=None, sink=None, dead_letters=None, scheduler=None, idempotency=None, dry_run=None):
         super().__init__()
+        app.state.spool = spool
+        app.state.config = config or {}
+        app.state.writer = SpoolWriter(
+            spool,
+            window=app.state.config.get("commit_window", 0.002),
+            max_records=app.state.config.get("commit_max_records", 10000),
+            on_commit=handoff,
+        )
+        app.state.sink = sink
+        app.state.idempotency = idempotency
+        app.state.dry_run = dry_run
+        app.state.dead_letters = dead_letters
+        app.state.scheduler = scheduler
         self.flask_thread = threading.Thread(target=self.run_fastapi_app)
         self.flask_thread.start()
 
+    def set_dry_run(self, dry_run):
+        # The API starts before the plugin has built its planner and dispatcher, dry runs answer 503 until this is set
+        app.state.dry_run = dry_run
+
     def run_fastapi_app(self):
         import uvicorn
-        uvicorn.run(app, host="0.0.0.0", port=5688)
+        config = app.state.config
+        uvicorn.run(
+            app,
+            host=config.get("host", "0.0.0.0"),
+            port=config.get("port", 5688),
+            loop=config.get("loop", "auto"),
+            http=config.get("http", "auto"),
+            backlog=config.get("backlog", 2048),
+        )
 
 
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 幂等键存储: 重复提交的请求直接返回第一次的结果
+
+
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+# claim 的结果
+NEW = "new"
+DONE = "done"
+PENDING = "pending"
+
+
+class BloomFilter:
+    """
+    固定大小的布隆过滤器, 判断 key 一定不存在或可能存在。
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for index in self._indexes(key):
+            self._bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key))
+
+
+class IdempotencyStore:
+    """
+    幂等键 -> 第一次请求的结果。
+    内存中为最多 max_entries 条的 LRU, 超过 ttl 秒的记录视为不存在。
+    指定 path 时每条结果同时写入 SQLite 索引 (重启后仍有效), LRU 未命中时先查布隆过滤器,
+    只有可能存在的 key 才查询磁盘, 键的数量很大时内存占用保持不变。
+    同一 key 的请求正在处理时 claim 返回 PENDING, 处理失败时调用 release 允许重试。
+    内存中的状态和 SQLite 连接各用一把锁, 写入磁盘时不阻塞只查内存的 claim_cached。
+    """
+
+    # 每写入多少条清理一次磁盘上过期的记录
+    purge_every = 1000
+
+    def __init__(self, max_entries=100000, ttl=86400, path=None, bloom_capacity=1000000, bloom_error_rate=0.01):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        # key -> (过期时间, 结果)
+        self._entries = OrderedDict()
+        self._pending = set()
+        self._db = None
+        self._bloom = None
+        self._writes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        if path:
+            self._bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+            self._open()
+
+    def claim(self, key):
+        """
+        返回 (NEW, None)、(DONE, 结果) 或 (PENDING, None); NEW 表示调用方负责处理并在之后调用 complete 或 release。
+        """
+        claimed = self.claim_cached(key)
+        if claimed is not None:
+            return claimed
+        row = self._load(key)
+        now = time.time()
+        with self._lock:
+            # 查询磁盘期间其他线程可能已经处理了同一 key
+            entry = self._entries.get(key)
+            if entry is None and row is not None and row[0] > now:
+                entry = row
+                self._remember(key, *entry)
+            return self._claim(key, entry)
+
+    def claim_cached(self, key):
+        """
+        只查内存的 claim, 不会等待磁盘; 需要查询磁盘索引时返回 None, 由调用方在其他线程中调用 claim。
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is None and key not in self._pending and self._db is not None and key in self._bloom:
+                return None
+            return self._claim(key, entry)
+
+    def complete(self, key, result):
+        self.complete_many([(key, result)])
+
+    def complete_many(self, items):
+        """
+        记录 [(key, 结果), ...], 写入磁盘索引时一次提交。
+        """
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, result in items:
+                self._pending.discard(key)
+                self._remember(key, expires, result)
+            if self._db is None:
+                return
+            for key, _ in items:
+                self._bloom.add(key)
+        # 已在内存中, claim 不必等待磁盘写入
+        with self._db_lock:
+            self._db.executemany("INSERT OR REPLACE INTO idempotency (key, expires, result) VALUES (?, ?, ?)",
+                                 [(key, expires, json.dumps(result, ensure_ascii=False)) for key, result in items])
+            previous, self._writes = self._writes, self._writes + len(items)
+            if previous // self.purge_every != self._writes // self.purge_every:
+                self._db.execute("DELETE FROM idempotency WHERE expires <= ?", (time.time(),))
+            self._db.commit()
+
+    def release(self, key):
+        with self._lock:
+            self._pending.discard(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+        }
+
+    def _claim(self, key, entry):
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return DONE, entry[1]
+        if key in self._pending:
+            return PENDING, None
+        self._pending.add(key)
+        self.misses += 1
+        return NEW, None
+
+    def _remember(self, key, expires, result):
+        self._entries[key] = (expires, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, key):
+        """
+        从磁盘索引查找 LRU 中没有的 key, 返回 (过期时间, 结果) 或 None。
+        """
+        with self._db_lock:
+            row = self._db.execute("SELECT expires, result FROM idempotency WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _open(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS idempotency (key TEXT PRIMARY KEY, expires REAL, result TEXT)")
+        self._db.execute("DELETE FROM idempotency WHERE expires <= ?", (time.time(),))
+        self._db.commit()
+        count = 0
+        for (key,) in self._db.execute("SELECT key FROM idempotency"):
+            self._bloom.add(key)
+            count += 1
+        if count:
+            logger.info(f"加载幂等键 {count} 个。")
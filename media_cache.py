@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 按 URL 与内容哈希寻址的媒体缓存
+
+
+import os
+import time
+import shutil
+import hashlib
+import itertools
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote
+
+import requests
+
+from plugins.send_msg.metrics import STAGE_SECONDS
+from plugins.send_msg.breaker import CircuitBreaker
+from plugins.send_msg.media_type import guess_extension
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+TMP_SUFFIX = ".part"
+
+
+class MediaFile:
+    """
+    缓存中的一个文件, refs 为正在使用它的发送数。
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.refs = 0
+
+
+class MediaCache:
+    """
+    本地媒体缓存。
+    同一 URL 在 ttl 内只下载一次, 下载采用流式分块写入;
+    文件按内容哈希存放, 按总字节数做 LRU 淘汰, 正在使用的文件不会被删除。
+    每个域名一个熔断器, 连续 failure_threshold 次连接失败、超时或 5xx 后, reset_timeout 秒内不再下载该域名的文件,
+    get 直接抛出 CircuitOpenError, 不必每条消息都等待超时。
+    adopt 接管的下载最多 adopt_workers 个同时进行, 超出时关闭响应, 由发送时自己下载。
+    """
+
+    # 保留下载失败原因的 URL 数
+    max_errors = 1024
+
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024, ttl=600, chunk_size=64 * 1024, timeout=22,
+                 failure_threshold=3, reset_timeout=30, adopt_workers=4):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        # 域名 -> CircuitBreaker
+        self.breakers = {}
+
+        self._lock = threading.Lock()
+        # url -> (文件 key, 下载时间)
+        self._urls = {}
+        # 文件 key -> MediaFile, 按最近使用排序
+        self._files = OrderedDict()
+        # url -> 正在下载的 Event, 同一 URL 并发请求只下载一次
+        self._downloading = {}
+        self.total_bytes = 0
+        self._adopt_slots = threading.BoundedSemaphore(adopt_workers)
+        self._adopt_executor = ThreadPoolExecutor(max_workers=adopt_workers, thread_name_prefix="send_msg-adopt")
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # url -> 最近一次下载失败的异常, 用于区分域名不可用和 URL 本身的问题, 最多 max_errors 条
+        self._errors = OrderedDict()
+
+        self._reset_dir()
+
+    @contextmanager
+    def acquire(self, url):
+        """
+        获取 URL 对应的本地文件路径, 使用期间文件不会被淘汰。
+        下载失败时返回 None。
+        """
+        key = self.get(url)
+        try:
+            yield self._files[key].path if key else None
+        finally:
+            if key:
+                self.release(key)
+
+    def get(self, url):
+        """
+        返回 URL 对应的文件 key 并增加引用计数, 需要调用 release 释放。
+        """
+        while True:
+            with self._lock:
+                cached = self._urls.get(url)
+                if cached and cached[0] in self._files and time.time() - cached[1] <= self.ttl:
+                    self.hits += 1
+                    return self._ref(cached[0])
+
+                event = self._downloading.get(url)
+                if event is None:
+                    self._breaker(url).check()
+                    event = threading.Event()
+                    self._downloading[url] = event
+                    self.misses += 1
+                    break
+            # 其他线程正在下载同一 URL, 等待其完成后重新查找
+            event.wait()
+            with self._lock:
+                if url not in self._urls:
+                    return None
+
+        return self._download_and_store(url, ref=True)
+
+    def adopt(self, url, response, first_chunk):
+        """
+        接管类型探测时已经打开的流式响应, 在后台线程中继续下载, 已读取的第一块不再重复下载。
+        URL 已缓存、正在下载或后台下载已满时直接关闭响应。
+        """
+        if not self._adopt_slots.acquire(blocking=False):
+            response.close()
+            return
+        with self._lock:
+            cached = self._urls.get(url)
+            if (cached and cached[0] in self._files and time.time() - cached[1] <= self.ttl) or url in self._downloading:
+                self._adopt_slots.release()
+                response.close()
+                return
+            self._downloading[url] = threading.Event()
+            self.misses += 1
+        self._adopt_executor.submit(self._adopt_download, url, response, first_chunk)
+
+    def last_error(self, url):
+        """
+        url 最近一次下载失败的异常, 没有失败记录时返回 None。
+        """
+        with self._lock:
+            return self._errors.get(url)
+
+    def check_host(self, url):
+        """
+        url 所在域名已熔断时抛出 CircuitOpenError, 例如在类型探测前检查。
+        """
+        self._breaker(url).check()
+
+    def host_retry_after(self, url):
+        """
+        url 所在域名熔断时返回距离下次探测的秒数 (至少 1), 未熔断返回 0。
+        """
+        breaker = self._breaker(url)
+        return 0 if breaker.available() else max(breaker.retry_after(), 1.0)
+
+    def record_result(self, url, error=None):
+        """
+        把不经过 get 的请求 (例如类型探测) 的结果计入 url 所在域名的熔断器。
+        """
+        breaker = self._breaker(url)
+        if error is not None and self.is_host_failure(error):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+    def _adopt_download(self, url, response, first_chunk):
+        try:
+            self._download_and_store(url, False, response, first_chunk)
+        finally:
+            self._adopt_slots.release()
+
+    def _download_and_store(self, url, ref=False, response=None, first_chunk=b""):
+        """
+        下载并登记到缓存, 返回文件 key, 失败返回 None。调用前 URL 已登记在 _downloading 中。
+        ref 为 True 时同时增加引用计数。
+        """
+        breaker = self._breaker(url)
+        try:
+            with STAGE_SECONDS.time(stage="download"):
+                key, path, size = self._download(url, response, first_chunk)
+        except Exception as e:
+            logger.error(f"从 {url} 下载文件时出错: {e}")
+            if self.is_host_failure(e):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            with self._lock:
+                self._urls.pop(url, None)
+                self._errors[url] = e
+                self._errors.move_to_end(url)
+                while len(self._errors) > self.max_errors:
+                    self._errors.popitem(last=False)
+                self._downloading.pop(url).set()
+            return None
+
+        breaker.record_success()
+        with self._lock:
+            self._errors.pop(url, None)
+            if key not in self._files:
+                self._files[key] = MediaFile(path, size)
+                self.total_bytes += size
+            self._urls[url] = (key, time.time())
+            self._downloading.pop(url).set()
+            result = self._ref(key) if ref else key
+            self._evict()
+            return result
+
+    def release(self, key):
+        with self._lock:
+            media_file = self._files.get(key)
+            if media_file is not None:
+                media_file.refs -= 1
+            self._evict()
+
+    def size_of(self, key):
+        with self._lock:
+            media_file = self._files.get(key)
+            return media_file.size if media_file else 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "files": len(self._files),
+            "bytes": self.total_bytes,
+        }
+
+    def _breaker(self, url):
+        host = urlparse(url).netloc
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers.setdefault(host, CircuitBreaker(
+                f"下载 {host}", failure_threshold=self.failure_threshold, reset_timeout=self.reset_timeout))
+        return breaker
+
+    @staticmethod
+    def is_host_failure(error):
+        """
+        连接失败、超时和 5xx 说明服务端不可用; 4xx 等只是这个 URL 有问题。
+        """
+        if isinstance(error, requests.HTTPError):
+            return error.response is not None and error.response.status_code >= 500
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def _ref(self, key):
+        self._files[key].refs += 1
+        self._files.move_to_end(key)
+        return key
+
+    def _evict(self):
+        """
+        超过容量时从最久未使用的文件开始删除, 跳过仍被引用的文件。
+        """
+        if self.total_bytes <= self.max_bytes:
+            return
+        for key in list(self._files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            media_file = self._files[key]
+            if media_file.refs > 0:
+                continue
+            del self._files[key]
+            self.total_bytes -= media_file.size
+            self.evictions += 1
+            self._remove_file(media_file.path)
+        for url in [url for url, (key, _) in self._urls.items() if key not in self._files]:
+            del self._urls[url]
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+            # 同一内容的其他文件名仍在使用时目录非空, 保留目录
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def _download(self, url, response=None, first_chunk=b""):
+        """
+        流式下载到临时文件, 边写边计算内容哈希, 完成后移动到 <哈希>/<文件名>。
+        response 为已经读取了 first_chunk 的响应时从该处继续。
+        """
+        hasher = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(suffix=TMP_SUFFIX, dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                if response is None:
+                    response = requests.get(url, stream=True, timeout=self.timeout)
+                head = b""
+                with response:
+                    response.raise_for_status()
+                    content_type = response.headers.get("Content-Type")
+                    for chunk in itertools.chain([first_chunk], response.iter_content(chunk_size=self.chunk_size)):
+                        if chunk:
+                            if len(head) < 16:
+                                head += chunk[:16]
+                            file.write(chunk)
+                            hasher.update(chunk)
+                            size += len(chunk)
+
+            digest = hasher.hexdigest()
+            file_name = self._file_name(url, content_type, head)
+            key = f"{digest}/{file_name}"
+            target_dir = os.path.join(self.cache_dir, digest)
+            path = os.path.join(target_dir, file_name)
+            os.makedirs(target_dir, exist_ok=True)
+            os.replace(tmp_path, path)
+            return key, path, size
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _file_name(self, url, content_type=None, head=b""):
+        # 发送文件时微信会显示文件名, 因此保留 URL 中的原始文件名;
+        # 没有后缀时 (如 /download?id=3) 按文件头或 Content-Type 补上, 否则微信无法识别文件类型
+        name = os.path.basename(unquote(urlparse(url).path)) or "file"
+        if not os.path.splitext(name)[1]:
+            name += guess_extension(content_type, head) or ""
+        return name
+
+    def _reset_dir(self):
+        """
+        清理上次运行遗留的缓存文件, 缓存索引只保存在内存中。
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(TMP_SUFFIX):
+                os.remove(path)
+            elif os.path.isdir(path) and len(name) == 64:
+                shutil.rmtree(path, ignore_errors=True)
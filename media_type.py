@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 根据 URL 后缀、Content-Type 和文件头判断媒体类型
+
+
+import os
+import logging
+import mimetypes
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote
+
+import requests
+
+from plugins.send_msg.metrics import STAGE_SECONDS
+from plugins.send_msg.breaker import CircuitOpenError
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+# 域名不可用 (连接失败、超时、5xx 或已熔断) 时无法判断类型, 由发送时再次判断; 不缓存
+DEFERRED = "deferred"
+
+SUFFIX_TYPES = {
+    "img": (".jpg", ".jpeg", ".png", ".gif", ".img", ".webp", ".bmp"),
+    "video": (".mp4", ".avi", ".mov", ".mkv", ".webm"),
+    "file": (".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".zip", ".rar", ".7z", ".txt", ".csv"),
+}
+
+CONTENT_TYPES = {
+    "application/pdf": "file",
+    "application/msword": "file",
+    "application/vnd.ms-excel": "file",
+    "application/vnd.ms-powerpoint": "file",
+    "application/zip": "file",
+    "application/x-zip-compressed": "file",
+    "application/x-rar-compressed": "file",
+    "application/vnd.rar": "file",
+    "application/x-7z-compressed": "file",
+    "text/plain": "file",
+    "text/csv": "file",
+    # 网页链接按文本发送
+    "text/html": "text",
+}
+
+# (偏移, 文件头, 类型, 后缀)
+MAGIC_BYTES = (
+    (0, b"\x89PNG\r\n\x1a\n", "img", ".png"),
+    (0, b"\xff\xd8\xff", "img", ".jpg"),
+    (0, b"GIF87a", "img", ".gif"),
+    (0, b"GIF89a", "img", ".gif"),
+    (0, b"BM", "img", ".bmp"),
+    (4, b"ftyp", "video", ".mp4"),
+    (0, b"\x1a\x45\xdf\xa3", "video", ".mkv"),
+    (0, b"%PDF", "file", ".pdf"),
+    (0, b"PK\x03\x04", "file", ".zip"),
+    (0, b"Rar!", "file", ".rar"),
+    (0, b"7z\xbc\xaf\x27\x1c", "file", ".7z"),
+    (0, b"\xd0\xcf\x11\xe0", "file", ".doc"),
+)
+
+# mimetypes 对这些类型给出的后缀不常见, 微信按后缀显示文件时使用常见后缀
+CONTENT_TYPE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "video/quicktime": ".mov",
+    "text/plain": ".txt",
+    "application/x-zip-compressed": ".zip",
+    "application/x-rar-compressed": ".rar",
+    "application/vnd.rar": ".rar",
+    "application/x-7z-compressed": ".7z",
+}
+
+
+def type_from_suffix(url):
+    """
+    按 URL 路径的后缀判断, 忽略查询参数, 无法判断返回 None。
+    """
+    path = unquote(urlparse(url).path).lower()
+    suffix = os.path.splitext(path)[1]
+    for media_type, suffixes in SUFFIX_TYPES.items():
+        if suffix in suffixes:
+            return media_type
+    return None
+
+
+def type_from_content_type(content_type):
+    if not content_type:
+        return None
+    mime = content_type.split(";")[0].strip().lower()
+    if mime.startswith("image/"):
+        return "img"
+    if mime.startswith("video/"):
+        return "video"
+    if mime.startswith("application/vnd.openxmlformats-officedocument."):
+        return "file"
+    return CONTENT_TYPES.get(mime)
+
+
+def type_from_magic(chunk):
+    for offset, magic, media_type, _ in MAGIC_BYTES:
+        if chunk[offset:offset + len(magic)] == magic:
+            return media_type
+    if chunk[:4] == b"RIFF":
+        return {b"WEBP": "img", b"AVI ": "video"}.get(chunk[8:12])
+    return None
+
+
+def guess_extension(content_type=None, chunk=b""):
+    """
+    按文件头或 Content-Type 推断文件后缀 (如 ".png"), 无法推断返回 None。
+    文件头比服务端声明的类型可靠, 优先使用。
+    """
+    for offset, magic, _, extension in MAGIC_BYTES:
+        if chunk[offset:offset + len(magic)] == magic:
+            return extension
+    if chunk[:4] == b"RIFF":
+        extension = {b"WEBP": ".webp", b"AVI ": ".avi"}.get(chunk[8:12])
+        if extension:
+            return extension
+    if not content_type:
+        return None
+    mime = content_type.split(";")[0].strip().lower()
+    if mime == "text/html":
+        return None
+    return CONTENT_TYPE_EXTENSIONS.get(mime) or mimetypes.guess_extension(mime)
+
+
+class MediaClassifier:
+    """
+    判断 URL 的媒体类型: img、video、file、text (网页链接)、unsupported 或 DEFERRED (域名暂时不可用)。
+    后缀无法判断时先发送 HEAD 请求看 Content-Type, 仍无法判断时流式 GET 读取第一块按文件头判断;
+    GET 得到的响应交给媒体缓存继续下载, 不会重复下载, 不支持的内容在读取第一块后即断开。
+    探测前检查媒体缓存中该域名的熔断器, 已熔断时不发请求; 连接失败、超时和 5xx 计入熔断器, 且不再尝试 GET。
+    结果按 URL 缓存, 最多 max_entries 条; 网络错误的结果不缓存。
+    """
+
+    def __init__(self, media_cache, probe=True, max_entries=4096, timeout=5):
+        self.media_cache = media_cache
+        self.probe = probe
+        self.max_entries = max_entries
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+
+    def classify(self, url, adopt=True):
+        """
+        adopt 为 False 时 (例如预演) 探测用的 GET 响应直接关闭, 不交给媒体缓存下载。
+        """
+        with self._lock:
+            media_type = self._cache.get(url)
+            if media_type is not None:
+                self._cache.move_to_end(url)
+                self.hits += 1
+                return media_type
+            self.misses += 1
+
+        media_type = type_from_suffix(url)
+        if media_type is None:
+            if not self.probe:
+                media_type = "unsupported"
+            else:
+                with STAGE_SECONDS.time(stage="probe"):
+                    media_type = self._probe(url, adopt)
+                if media_type is None:
+                    return "unsupported"
+                if media_type == DEFERRED:
+                    return DEFERRED
+
+        with self._lock:
+            self._cache[url] = media_type
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return media_type
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "probes": self.probes,
+            "entries": len(self._cache),
+        }
+
+    def _probe(self, url, adopt=True):
+        """
+        通过网络判断类型。域名不可用或已熔断返回 DEFERRED, 其他网络错误返回 None。
+        """
+        try:
+            self.media_cache.check_host(url)
+        except CircuitOpenError as e:
+            logger.warning(f"跳过探测 {url} 的类型: {e}")
+            return DEFERRED
+
+        self.probes += 1
+        try:
+            head = requests.head(url, allow_redirects=True, timeout=self.timeout)
+            head.raise_for_status()
+            media_type = type_from_content_type(head.headers.get("Content-Type"))
+            if media_type is not None:
+                self.media_cache.record_result(url)
+                return media_type
+        except requests.RequestException as e:
+            if self.media_cache.is_host_failure(e):
+                logger.warning(f"探测 {url} 的类型失败: {e}")
+                self.media_cache.record_result(url, e)
+                return DEFERRED
+            logger.debug(f"HEAD {url} 失败, 改用 GET 探测: {e}")
+
+        try:
+            response = requests.get(url, stream=True, timeout=self.timeout)
+            response.raise_for_status()
+            chunk = next(response.iter_content(chunk_size=self.media_cache.chunk_size), b"")
+        except requests.RequestException as e:
+            logger.warning(f"探测 {url} 的类型失败: {e}")
+            self.media_cache.record_result(url, e)
+            return DEFERRED if self.media_cache.is_host_failure(e) else None
+        except StopIteration:
+            # 服务端可用, 只是内容为空
+            self.media_cache.record_result(url)
+            logger.warning(f"探测 {url} 的类型失败: 内容为空")
+            return None
+        self.media_cache.record_result(url)
+
+        media_type = type_from_content_type(response.headers.get("Content-Type")) or type_from_magic(chunk)
+        if adopt and media_type in ("img", "video", "file"):
+            # 已读取的第一块和未读取的部分交给媒体缓存, 发送时直接使用
+            self.media_cache.adopt(url, response, chunk)
+        else:
+            response.close()
+        return media_type or "unsupported"
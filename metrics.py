@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 各阶段耗时与发送计数, 以 Prometheus 文本格式输出
+
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+# 默认耗时分桶 (秒), 覆盖从内存操作到慢速下载
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+def _label_key(labelnames, labels):
+    return tuple((name, str(labels.get(name, ""))) for name in labelnames)
+
+
+class Counter:
+    """
+    只增不减的计数器。
+    """
+
+    type_name = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield self.name, key, value
+
+
+class Histogram:
+    """
+    耗时分布, 每次记录只做一次二分查找和一次加法, 累计值在输出时计算。
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # 标签 -> [各分桶计数 (最后一个为 +Inf), 总和]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(self.labelnames, labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        记录 with 代码块的耗时, 代码块抛出异常时同样记录。
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", key + (("le", le),), cumulative
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, cumulative
+
+
+class Gauge:
+    """
+    输出时调用 func 取值的瞬时值, 记录路径上没有任何开销。
+    func 返回数值, 或 {标签值元组: 数值} 字典。
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, func, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.labelnames = labelnames
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            for label_values, item in value.items():
+                yield self.name, tuple(zip(self.labelnames, label_values)), item
+        elif value is not None:
+            yield self.name, (), value
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        注册指标, 同名指标替换旧的 (插件重新加载时重新注册瞬时值)。
+        """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def gauge(self, name, help_text, func, labelnames=()):
+        return self.register(Gauge(name, help_text, func, labelnames))
+
+    def render(self):
+        """
+        Prometheus 文本格式 (version 0.0.4)。
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            except Exception as e:
+                lines.append(f"# {metric.name} 取值失败: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# 各阶段耗时: api (接口写入)、handoff (写入到开始处理)、plan (生成发送计划, 含通讯录查找)、
+# directory_refresh (拉取通讯录)、queue_wait (调度排队与限流)、download (下载文件)、send (一次发送, 含下载)、
+# channel (微信接口调用)
+STAGE_SECONDS = registry.register(Histogram(
+    "send_msg_stage_seconds", "各处理阶段的耗时 (秒)", labelnames=("stage",)))
+
+# 每个优先级队列的排队耗时, 包括限流等待
+LANE_WAIT = registry.register(Histogram(
+    "send_msg_queue_wait_seconds", "各优先级队列的排队耗时 (秒)", labelnames=("lane",)))
+
+# API 写入 spool 时每次组提交合并的请求数
+COMMIT_BATCH = registry.register(Histogram(
+    "send_msg_commit_batch_requests", "每次写入 spool 合并的请求数", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)))
+
+# 按幂等键直接返回之前结果的次数: request (整个请求)、item (单条消息)
+IDEMPOTENT_REPLAYS = registry.register(Counter(
+    "send_msg_idempotent_replays_total", "重复提交直接返回之前结果的次数", labelnames=("scope",)))
+
+# 消息计数: sent (发送成功)、failed (最终失败)、unsupported (不支持的文件类型)
+MESSAGES = registry.register(Counter(
+    "send_msg_messages_total", "按结果统计的发送次数", labelnames=("status",)))
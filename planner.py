@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 批量发送计划: 解析目标、去重与合并
+
+
+import time
+import logging
+
+from plugins.send_msg.dispatcher import LANES, DEFAULT_LANE
+from plugins.send_msg.template import compile_template, is_template, iter_rows, RenderedMessage
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+AT_ALL_NAMES = ("所有人", "all")
+
+
+class Target:
+    """
+    解析后的发送目标。
+    dest 为 itchat 的 UserName 或 ntchat 的 wxid; at_names/at_ids 为群聊中 @ 的成员;
+    request 为只发往该目标的原始消息字段 (receiver_name/group_name), 用于失败后重新提交;
+    account 为发送该目标使用的账号。
+    """
+
+    def __init__(self, dest, label, at_names=(), at_ids=(), at_all=False, is_group=False, request=None, account=None):
+        self.dest = dest
+        self.label = label
+        self.at_names = tuple(at_names)
+        self.at_ids = tuple(at_ids)
+        self.at_all = at_all
+        self.is_group = is_group
+        self.request = request or {}
+        self.account = account
+
+    @property
+    def at_key(self):
+        return self.at_all, self.at_names, self.at_ids
+
+
+class Delivery:
+    """
+    一次实际的发送。sources 为包含该发送的消息来源 (spool 序号), priority 为发送使用的优先级队列。
+    """
+
+    def __init__(self, target, media_type, content, sources=(), priority=DEFAULT_LANE):
+        self.target = target
+        self.media_type = media_type
+        self.content = content
+        self.sources = list(sources)
+        self.priority = priority
+
+    @property
+    def dedup_key(self):
+        return self.target.dest, self.target.at_key, self.media_type, self.content
+
+    def render(self):
+        """
+        发送的文本或 URL, 模板消息在这里才渲染。
+        """
+        return str(self.content)
+
+    def to_message(self):
+        """
+        还原为可以重新提交的消息。
+        """
+        message = {"receiver_name": [], "group_name": [], **self.target.request, "message": self.render()}
+        if self.priority != DEFAULT_LANE:
+            message["priority"] = self.priority
+        return message
+
+    def __repr__(self):
+        return f"Delivery({self.target.label}, {self.media_type}, {self.content!r})"
+
+
+class PlanFailure:
+    """
+    无法发送的目标, 例如群聊或好友不存在。message 为只包含该目标的原始消息。
+    """
+
+    def __init__(self, sources, target, error, message=None):
+        self.sources = list(sources)
+        self.target = target
+        self.error = error
+        self.message = message or {}
+
+    def __repr__(self):
+        return f"PlanFailure({self.target}, {self.error})"
+
+
+class Plan:
+    """
+    发送计划。timings 为各阶段累计耗时 (秒): media_type 判断媒体类型, resolve 解析群聊/好友, merge 合并文本, total 全部。
+    """
+
+    def __init__(self):
+        self.deliveries = []
+        self.failures = []
+        self.items = 0
+        self.resolved = 0
+        self.duplicates = 0
+        self.merged = 0
+        self.unsupported = 0
+        self.timings = {"media_type": 0.0, "resolve": 0.0, "merge": 0.0, "total": 0.0}
+
+
+class DeliveryPlanner:
+    """
+    把一批消息转换为发送计划。
+    同一批中的每个群聊/好友只解析一次; 目标、@ 对象和内容完全相同的发送只保留一次, 使用其中最高的优先级;
+    开启 merge_texts 时, 同一目标、同一优先级的连续短文本合并为一条, 合并后长度不超过 merge_limit。
+    """
+
+    def __init__(self, resolve_group, resolve_friend, detect_media_type,
+                 merge_texts=False, merge_limit=2000, merge_separator="\n"):
+        self.resolve_group = resolve_group
+        self.resolve_friend = resolve_friend
+        self.detect_media_type = detect_media_type
+        self.merge_texts = merge_texts
+        self.merge_limit = merge_limit
+        self.merge_separator = merge_separator
+
+    def plan(self, items):
+        """
+        items 为 [(来源, 消息字典), ...], 返回 Plan。
+        """
+        started = time.perf_counter()
+        plan = Plan()
+        group_cache = {}
+        friend_cache = {}
+        media_types = {}
+        deliveries = {}
+
+        for source, data in items:
+            plan.items += 1
+            sources = [source] if source is not None else []
+            # 格式错误的消息 (或模板行) 只让它自己失败, 不影响同一批中的其他消息
+            try:
+                if not isinstance(data, dict):
+                    raise ValueError(f"消息应该是 JSON 对象: {data!r}")
+                priority = data.get("priority") or DEFAULT_LANE
+                if priority not in LANES:
+                    logger.warning(f"未知的优先级 {priority}, 按 {DEFAULT_LANE} 发送")
+                    priority = DEFAULT_LANE
+                for receiver_names, group_names, content, message in self._expand(data):
+                    try:
+                        self._plan_item(plan, sources, receiver_names, group_names, content, message, priority,
+                                        group_cache, friend_cache, media_types, deliveries)
+                    except Exception as e:
+                        plan.failures.append(PlanFailure(
+                            sources, None, e, self._failure_message(receiver_names, group_names, content, message)))
+            except Exception as e:
+                plan.failures.append(PlanFailure(sources, None, e, data if isinstance(data, dict) else {"message": data}))
+
+        merge_started = time.perf_counter()
+        plan.deliveries = self._merge(plan, list(deliveries.values())) if self.merge_texts else list(deliveries.values())
+        finished = time.perf_counter()
+        plan.timings["merge"] = finished - merge_started
+        plan.timings["total"] = finished - started
+        return plan
+
+    def _expand(self, data):
+        """
+        返回 (接收者, 群聊, 内容, 原始消息) 列表; 模板消息每行一项, 内容为发送时才渲染的 RenderedMessage。
+        """
+        receiver_names = tuple(data.get("receiver_name") or [])
+        group_names = data.get("group_name") or []
+        if not is_template(data):
+            yield receiver_names, group_names, data.get("message", ""), data
+            return
+
+        template = compile_template(data["template"])
+        for values in iter_rows(data):
+            row_receivers = values.get("receiver_name", receiver_names)
+            row_groups = values.get("group_name", group_names)
+            row_receivers = tuple([row_receivers] if isinstance(row_receivers, str) else row_receivers or [])
+            row_groups = [row_groups] if isinstance(row_groups, str) else row_groups or []
+            content = RenderedMessage(template, values)
+            # 失败时才渲染, 用于写入死信队列
+            yield row_receivers, row_groups, content, None
+
+    def _plan_item(self, plan, sources, receiver_names, group_names, content, message, priority,
+                   group_cache, friend_cache, media_types, deliveries):
+        # 模板消息按模板原文判断类型
+        media_key = content.template.source if isinstance(content, RenderedMessage) else content
+        if not isinstance(media_key, str):
+            raise ValueError(f"message 应该是字符串: {media_key!r}")
+        if media_key not in media_types:
+            started = time.perf_counter()
+            media_types[media_key] = self.detect_media_type(media_key)
+            plan.timings["media_type"] += time.perf_counter() - started
+        media_type = media_types[media_key]
+        if media_type == "unsupported":
+            plan.unsupported += 1
+            plan.failures.append(PlanFailure(sources, media_key, ValueError(f"不支持的文件类型: {media_key}"),
+                                             self._failure_message(receiver_names, group_names, content, message)))
+            return
+
+        targets = []
+        if group_names:
+            for group_name in group_names:
+                key = (group_name, receiver_names)
+                if key not in group_cache:
+                    group_cache[key] = self._resolve(plan, self.resolve_group, group_name, receiver_names)
+                targets.extend(self._collect(plan, sources, group_cache[key], content, group_name, receiver_names))
+        elif receiver_names:
+            for receiver_name in receiver_names:
+                if receiver_name not in friend_cache:
+                    friend_cache[receiver_name] = self._resolve(plan, self.resolve_friend, receiver_name)
+                targets.extend(self._collect(plan, sources, friend_cache[receiver_name], content,
+                                              receiver_names=(receiver_name,)))
+        else:
+            plan.failures.append(PlanFailure(sources, None, ValueError("接收者列表为空，无法发送个人消息。"),
+                                             self._failure_message(receiver_names, group_names, content, message)))
+
+        for target in targets:
+            delivery = Delivery(target, media_type, content, sources, priority)
+            existing = deliveries.get(delivery.dedup_key)
+            if existing is not None:
+                existing.sources.extend(sources)
+                existing.priority = min(existing.priority, priority, key=LANES.index)
+                plan.duplicates += 1
+            else:
+                deliveries[delivery.dedup_key] = delivery
+
+    def _failure_message(self, receiver_names, group_names, content, message):
+        """
+        失败时写入死信队列的消息; 模板消息没有原始消息, 在这里才渲染。
+        """
+        if message is not None:
+            return message
+        return {"receiver_name": list(receiver_names), "group_name": list(group_names), "message": str(content)}
+
+    def _resolve(self, plan, resolver, *args):
+        """
+        调用解析函数, 返回 ([Target], [(名称, 错误)])。
+        解析函数抛出异常时整个群聊/好友失败, 名称为 None。
+        """
+        plan.resolved += 1
+        started = time.perf_counter()
+        try:
+            return resolver(*args)
+        except Exception as e:
+            return [], [(None, e)]
+        finally:
+            plan.timings["resolve"] += time.perf_counter() - started
+
+    def _collect(self, plan, sources, resolved, content, group_name=None, receiver_names=()):
+        """
+        记录解析失败, 失败的消息只保留失败的群聊/成员/好友, 返回解析出的目标。
+        """
+        targets, errors = resolved
+        for name, error in errors:
+            if group_name is not None:
+                receivers = [name] if name is not None else list(receiver_names)
+                message = {"receiver_name": receivers, "group_name": [group_name], "message": str(content)}
+                label = f"{group_name}/{name}" if name is not None else group_name
+            else:
+                message = {"receiver_name": list(receiver_names), "group_name": [], "message": str(content)}
+                label = receiver_names[0]
+            plan.failures.append(PlanFailure(sources, label, error, message))
+        return targets
+
+    def _merge(self, plan, deliveries):
+        """
+        合并同一目标、同一 @ 对象的连续文本; 中间有媒体消息时不跨越合并, 以保持顺序。
+        """
+        merged = []
+        open_texts = {}
+        for delivery in deliveries:
+            key = (delivery.target.dest, delivery.target.at_key, delivery.priority)
+            # 模板消息发送时才渲染, 不参与合并
+            if delivery.media_type != "text" or not isinstance(delivery.content, str):
+                for open_key in [k for k in open_texts if k[0] == delivery.target.dest]:
+                    del open_texts[open_key]
+                merged.append(delivery)
+                continue
+
+            current = open_texts.get(key)
+            if current is not None and len(current.content) + len(self.merge_separator) + len(delivery.content) <= self.merge_limit:
+                current.content = f"{current.content}{self.merge_separator}{delivery.content}"
+                current.sources.extend(delivery.sources)
+                plan.merged += 1
+            else:
+                open_texts[key] = delivery
+                merged.append(delivery)
+        return merged
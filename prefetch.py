@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 媒体预取: 在发送前并发下载即将发送的文件
+
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from plugins.send_msg.breaker import CircuitOpenError
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+
+class MediaPrefetcher:
+    """
+    调度器在工作线程取出任务时, 对队列中接下来的任务调用 prefetch(url),
+    由 workers 个下载线程提前把文件下载到媒体缓存, 与当前的上传同时进行。
+    预取的文件持有引用, 在对应的发送结束 (done) 前不会被淘汰; 持有的字节数超过 max_bytes 时不再预取,
+    由发送时自己下载。超过 max_age 秒仍未发送的文件释放引用。
+    """
+
+    def __init__(self, media_cache, workers=4, max_bytes=256 * 1024 * 1024, max_age=600):
+        self.media_cache = media_cache
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="send_msg-prefetch")
+
+        self._lock = threading.Lock()
+        # url -> (文件 key, 大小, 预取时间); 正在下载的 url 对应 None
+        self._held = {}
+        self.held_bytes = 0
+
+        self.prefetched = 0
+        self.skipped = 0
+
+    def prefetch(self, url):
+        with self._lock:
+            self._expire()
+            if url in self._held:
+                return
+            if self.held_bytes >= self.max_bytes:
+                self.skipped += 1
+                return
+            self._held[url] = None
+        self._executor.submit(self._fetch, url)
+
+    def done(self, url):
+        """
+        使用该文件的发送已结束, 释放预取时持有的引用。
+        """
+        with self._lock:
+            entry = self._held.get(url)
+            if entry is None:
+                # 未预取, 或仍在下载 (下载完成后由 _fetch 释放)
+                self._held.pop(url, None)
+                return
+            del self._held[url]
+            self.held_bytes -= entry[1]
+        self.media_cache.release(entry[0])
+
+    def stats(self):
+        return {"prefetched": self.prefetched, "skipped": self.skipped,
+                "files": len(self._held), "bytes": self.held_bytes}
+
+    def _fetch(self, url):
+        try:
+            key = self.media_cache.get(url)
+        except CircuitOpenError as e:
+            logger.debug(f"跳过预取 {url}: {e}")
+            key = None
+        except Exception as e:
+            logger.warning(f"预取 {url} 时出错: {e}")
+            key = None
+
+        size = self.media_cache.size_of(key) if key else 0
+        with self._lock:
+            if key and url in self._held:
+                self._held[url] = (key, size, time.monotonic())
+                self.held_bytes += size
+                self.prefetched += 1
+                return
+            # 下载失败, 或者发送已经先结束
+            self._held.pop(url, None)
+        if key:
+            self.media_cache.release(key)
+
+    def _expire(self):
+        now = time.monotonic()
+        for url, entry in list(self._held.items()):
+            if entry is not None and now - entry[2] > self.max_age:
+                del self._held[url]
+                self.held_bytes -= entry[1]
+                self.media_cache.release(entry[0])
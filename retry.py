@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 发送失败重试策略
+
+
+import random
+
+
+class TransientError(Exception):
+    """
+    可以重试的临时错误, 例如文件下载失败、微信接口返回失败。
+    """
+
+
+class ChannelError(TransientError):
+    """
+    微信接口调用失败, 计入账号的失败次数。
+    """
+
+
+def is_transient(error):
+    """
+    判断错误是否值得重试。
+    ValueError 表示数据本身有问题 (找不到群聊/好友、不支持的类型等), 重试也不会成功;
+    其他错误 (网络、会话异常等) 视为临时错误。
+    """
+    if isinstance(error, TransientError):
+        return True
+    return not isinstance(error, ValueError)
+
+
+class RetryPolicy:
+    """
+    带抖动的指数退避: 第 n 次重试的基础等待为 base_delay * 2^(n-1), 不超过 max_delay,
+    其中 jitter 比例的部分随机化, 避免大量失败同时重试。
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2.0, max_delay=300.0, jitter=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def should_retry(self, error, attempts):
+        return attempts < self.max_attempts and is_transient(error)
+
+    def delay(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 定时与周期消息调度
+
+
+import os
+import re
+import json
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from datetime import datetime
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+# 定时相关字段, 到期提交发送时从消息中去掉
+SCHEDULE_FIELDS = ("send_at", "repeat", "jitter")
+
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+INTERVAL_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*$")
+
+
+def parse_send_at(value):
+    """
+    解析发送时间: 时间戳 (秒) 或 ISO 8601 格式的本地时间, 如 "2026-10-18 09:00:00"。
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value.strip()).timestamp()
+    except ValueError:
+        raise ValueError(f"无法解析发送时间: {value}")
+
+
+def parse_interval(value, allow_zero=False):
+    """
+    解析时间间隔: 秒数, 或带单位的字符串 "30s"、"5m"、"1h"、"1d"。
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+    else:
+        match = INTERVAL_PATTERN.match(value)
+        if not match:
+            raise ValueError(f"无法解析时间间隔: {value}")
+        seconds = float(match.group(1)) * INTERVAL_UNITS[match.group(2) or "s"]
+    if seconds < 0 or (seconds == 0 and not allow_zero):
+        raise ValueError(f"时间间隔必须大于 0: {value}")
+    return seconds
+
+
+def is_scheduled(data):
+    return isinstance(data, dict) and bool(data.get("send_at") or data.get("repeat"))
+
+
+class Scheduler:
+    """
+    定时消息调度。
+    按触发时间维护最小堆, 插入和触发都是 O(log n); 取消时只从索引中删除, 堆中的旧项在弹出时跳过。
+    每次变更追加写入日志文件, 日志远大于有效记录数时压缩为快照, 重启后恢复全部待发送的消息。
+    jitter 为触发时间的随机延后范围 (秒), 把同一时刻的大量消息分散开。
+    on_fire(messages) 在调度线程中调用, 参数为到期的消息列表。
+    """
+
+    # 日志行数超过 有效记录数 * compact_ratio (且不少于 compact_min) 时压缩
+    compact_ratio = 2
+    compact_min = 1000
+    # on_fire 出错 (例如写入 spool 失败) 时, 到期的消息延后多少秒再次提交
+    retry_delay = 10
+
+    def __init__(self, path, on_fire, jitter=0.0, fsync=True):
+        self.path = path
+        self.on_fire = on_fire
+        self.jitter = jitter
+        self.fsync = fsync
+
+        self._cond = threading.Condition()
+        # id -> 记录 {"id", "send_at", "repeat", "jitter", "message"}
+        self._entries = {}
+        # (触发时间, 序号, id); id -> 当前有效的序号
+        self._heap = []
+        self._heap_keys = {}
+        self._counter = itertools.count()
+        self._journal_lines = 0
+        self._file = None
+        self._thread = None
+        self._running = False
+
+        self.fired = 0
+        self._load()
+
+    # ------------------------------------------------------------------ 接口
+
+    def add_many(self, items):
+        """
+        items 为 [(id, 消息), ...], 消息中的 send_at/repeat/jitter 为定时参数。
+        id 已存在时跳过 (重放 spool 时不会重复添加), 返回新增的 id 列表。
+        """
+        # 先解析全部参数, 有错误时整批都不添加
+        entries = [{
+            "id": str(entry_id),
+            "send_at": parse_send_at(message.get("send_at")) or time.time(),
+            "repeat": parse_interval(message.get("repeat")),
+            "jitter": parse_interval(message.get("jitter"), allow_zero=True),
+            "message": {k: v for k, v in message.items() if k not in SCHEDULE_FIELDS},
+        } for entry_id, message in items]
+
+        added = []
+        with self._cond:
+            for entry in entries:
+                if entry["id"] in self._entries:
+                    continue
+                self._entries[entry["id"]] = entry
+                self._push(entry)
+                added.append(entry)
+            if added:
+                self._write([{"op": "add", "entry": entry} for entry in added])
+                self._cond.notify_all()
+        return [entry["id"] for entry in added]
+
+    def cancel(self, entry_id):
+        with self._cond:
+            entry = self._entries.pop(str(entry_id), None)
+            if entry is None:
+                return False
+            self._heap_keys.pop(entry["id"], None)
+            self._write([{"op": "remove", "id": entry["id"]}])
+            return True
+
+    def list(self, limit=None):
+        with self._cond:
+            entries = sorted(self._entries.values(), key=lambda entry: entry["send_at"])
+        return entries[:limit] if limit else entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name="send_msg-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------------ 调度
+
+    def _push(self, entry, fire_at=None):
+        if fire_at is None:
+            jitter = entry["jitter"] if entry["jitter"] is not None else self.jitter
+            fire_at = entry["send_at"] + (random.uniform(0, jitter) if jitter else 0)
+        counter = next(self._counter)
+        self._heap_keys[entry["id"]] = counter
+        heapq.heappush(self._heap, (fire_at, counter, entry["id"]))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    # 跳过已取消或已重新调度的旧项
+                    while self._heap and self._heap_keys.get(self._heap[0][2]) != self._heap[0][1]:
+                        heapq.heappop(self._heap)
+                    if self._heap and self._heap[0][0] <= time.time():
+                        break
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if not self._running:
+                    return
+                due = self._pop_due()
+
+            try:
+                self.on_fire([entry["message"] for entry in due])
+                self.fired += len(due)
+            except Exception as e:
+                logger.error(f"提交定时消息时出错, {self.retry_delay} 秒后重试: {e}")
+                with self._cond:
+                    self._retry(due)
+                continue
+            with self._cond:
+                self._reschedule(due)
+
+    def _pop_due(self):
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, counter, entry_id = heapq.heappop(self._heap)
+            if self._heap_keys.get(entry_id) == counter:
+                del self._heap_keys[entry_id]
+                due.append(self._entries[entry_id])
+        return due
+
+    def _retry(self, due):
+        """
+        提交失败的消息放回堆中, retry_delay 秒后再次触发; 记录不变, 重启后仍按原时间立即触发。
+        """
+        fire_at = time.time() + self.retry_delay
+        for entry in due:
+            if self._entries.get(entry["id"]) is entry:
+                self._push(entry, fire_at)
+
+    def _reschedule(self, due):
+        """
+        周期消息计算下一次时间 (停机期间错过的周期不补发), 一次性消息删除。
+        """
+        now = time.time()
+        ops = []
+        for entry in due:
+            if self._entries.get(entry["id"]) is not entry:
+                continue
+            if entry["repeat"]:
+                missed = max(0, int((now - entry["send_at"]) // entry["repeat"]))
+                entry["send_at"] += (missed + 1) * entry["repeat"]
+                self._push(entry)
+                ops.append({"op": "add", "entry": entry})
+            else:
+                del self._entries[entry["id"]]
+                ops.append({"op": "remove", "id": entry["id"]})
+        self._write(ops)
+
+    # ------------------------------------------------------------------ 持久化
+
+    def _write(self, ops):
+        if not ops:
+            return
+        if self._journal_lines + len(ops) > max(self.compact_min, len(self._entries) * self.compact_ratio):
+            self._compact()
+            return
+        file = self._journal()
+        file.write("".join(json.dumps(op, ensure_ascii=False) + "\n" for op in ops).encode("utf-8"))
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+        self._journal_lines += len(ops)
+
+    def _journal(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+        return self._file
+
+    def _compact(self):
+        """
+        把当前全部记录写成快照替换日志文件。
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            for entry in self._entries.values():
+                file.write((json.dumps({"op": "add", "entry": entry}, ensure_ascii=False) + "\n").encode("utf-8"))
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        self._journal_lines = len(self._entries)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        partial = False
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    # 崩溃时写了一半的尾行
+                    partial = True
+                    continue
+                self._journal_lines += 1
+                if op["op"] == "add":
+                    self._entries[op["entry"]["id"]] = op["entry"]
+                else:
+                    self._entries.pop(op["id"], None)
+        for entry in self._entries.values():
+            self._push(entry)
+        if partial:
+            # 重写日志, 避免后续追加的记录接在残缺的行后面
+            self._compact()
+        if self._entries:
+            logger.info(f"恢复定时消息 {len(self._entries)} 条。")
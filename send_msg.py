@@ -9,14 +9,32 @@
 
 import os
 import json
-import requests
+import time
 import logging
+import uuid
+import queue
+import threading
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
-from plugins import Plugin, register
+from plugins import Plugin, register, Event, EventContext, EventAction
 from plugins.send_msg.file_api import FileWriter
+from plugins.send_msg.spool import MessageSpool
+from plugins.send_msg.directory import ItchatDirectory, NtchatDirectory
+from plugins.send_msg.media_cache import MediaCache
+from plugins.send_msg.media_type import MediaClassifier, DEFERRED
+from plugins.send_msg.prefetch import MediaPrefetcher
+from plugins.send_msg.dispatcher import Dispatcher, RateLimiter, LANES
+from plugins.send_msg.planner import DeliveryPlanner, Target, AT_ALL_NAMES
+from plugins.send_msg.template import is_template
+from plugins.send_msg.retry import RetryPolicy, TransientError, ChannelError
+from plugins.send_msg.accounts import Account, ChannelPool
+from plugins.send_msg.idempotency import IdempotencyStore
+from plugins.send_msg.breaker import CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+from plugins.send_msg.dead_letter import DeadLetterStore
+from plugins.send_msg.scheduler import Scheduler, is_scheduled
+from plugins.send_msg.metrics import registry, STAGE_SECONDS, MESSAGES
 from config import conf
 
 
@@ -25,13 +43,54 @@ logger = logging.getLogger(__name__)
 
 
 class FileChangeHandler(FileSystemEventHandler):
-    def __init__(self, callback):
+    """
+    监听 data.json 的变化。
+    短时间内的多次事件合并为一次回调: debounce 秒内没有新事件, 或距离第一次事件已超过 max_delay 秒;
+    支持写临时文件后 rename 到 data.json 的写入方式。
+    """
+
+    def __init__(self, callback, file_name='data.json', debounce=0.2, max_delay=2.0):
         super().__init__()
         self.callback = callback
+        self.file_name = file_name
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._timer = None
+        self._first_event_at = None
 
     def on_modified(self, event):
-        if not event.is_directory and event.src_path.endswith('data.json'):
-            self.callback()
+        if not event.is_directory:
+            self._on_event(event.src_path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._on_event(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._on_event(event.dest_path)
+
+    def _on_event(self, path):
+        if os.path.basename(path) != self.file_name:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            if self._first_event_at is None:
+                self._first_event_at = now
+            if self._timer is not None:
+                self._timer.cancel()
+            delay = min(self.debounce, max(0.0, self._first_event_at + self.max_delay - now))
+            self._timer = threading.Timer(delay, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            self._timer = None
+            self._first_event_at = None
+        self.callback()
 
 
 @register(
@@ -46,21 +105,218 @@ class FileWatcherPlugin(Plugin):
     def __init__(self):
         super().__init__()
         self.channel = None
+        self.directory = None
         self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
+        self.config = self.load_config() or {}
 
-        # 初始化 FileWriter API 服务
+        # 初始化消息 spool 与 FileWriter API 服务
         curdir = os.path.dirname(os.path.abspath(__file__))
-        FileWriter()
+        self.plugin_dir = curdir
+        spool_conf = self.config.get("spool", {})
+        self.spool = MessageSpool(
+            os.path.join(curdir, spool_conf.get("dir", "spool")),
+            segment_bytes=spool_conf.get("segment_bytes", 4 * 1024 * 1024),
+            fsync=spool_conf.get("fsync", True),
+            checkpoint_every=spool_conf.get("checkpoint_every", 100),
+            checkpoint_interval=spool_conf.get("checkpoint_interval", 1.0),
+        )
+        self._consume_lock = threading.Lock()
+        # 启动恢复时重放到的最大序号, 以及每条消息未完成的任务数
+        self._dispatched_seq = self.spool.checkpoint
+        self._pending_items = {}
+        self._pending_lock = threading.Lock()
+        # file_api 写入 spool 后通过该队列把消息直接交给消费线程, None 表示检查 data.json
+        self._handoff = queue.Queue()
+        # 重试后仍然失败的消息保存到死信队列, 可以通过 API 或 $dlq replay 重新提交
+        dead_letter_conf = self.config.get("dead_letter", {})
+        self.dead_letters = DeadLetterStore(os.path.join(curdir, dead_letter_conf.get("path", "dead_letter.jsonl")))
+        # 带 send_at/repeat 的消息交给调度器, 到期后重新写入 spool 发送
+        scheduler_conf = self.config.get("scheduler", {})
+        self.scheduler = Scheduler(
+            os.path.join(curdir, scheduler_conf.get("path", "schedule.jsonl")),
+            on_fire=self._submit_scheduled,
+            jitter=scheduler_conf.get("jitter", 0),
+            fsync=scheduler_conf.get("fsync", True),
+        )
+        # 幂等键: 上游超时重试的请求直接返回第一次的结果, 不会重复发送
+        idempotency_conf = self.config.get("idempotency", {})
+        self.idempotency = None
+        if idempotency_conf.get("enabled", True):
+            path = idempotency_conf.get("path", "idempotency.db")
+            self.idempotency = IdempotencyStore(
+                max_entries=idempotency_conf.get("max_entries", 100000),
+                ttl=idempotency_conf.get("ttl", 86400),
+                path=os.path.join(curdir, path) if path else None,
+                bloom_capacity=idempotency_conf.get("bloom_capacity", 1000000),
+            )
+
+        # API 先启动以便尽早接收消息; 预演依赖后面创建的发送计划、调度器和账号, 初始化完成后再开放
+        self.file_writer = FileWriter(self.spool, self.config.get("api", {}), sink=self.ingest,
+                                      dead_letters=self.dead_letters, scheduler=self.scheduler,
+                                      idempotency=self.idempotency)
+
+        # 媒体文件缓存, 同一 URL 发给多个接收者时只下载一次
+        media_conf = self.config.get("media_cache", {})
+        self.media_cache = MediaCache(
+            os.path.join(curdir, media_conf.get("dir", "media_cache")),
+            max_bytes=media_conf.get("max_bytes", 512 * 1024 * 1024),
+            ttl=media_conf.get("ttl", 600),
+            chunk_size=media_conf.get("chunk_size", 64 * 1024),
+            timeout=media_conf.get("timeout", 22),
+            failure_threshold=media_conf.get("failure_threshold", 3),
+            reset_timeout=media_conf.get("reset_timeout", 30),
+            adopt_workers=media_conf.get("adopt_workers", 4),
+        )
+        # 媒体类型判断: 后缀无法判断时按 Content-Type 和文件头判断, 结果按 URL 缓存
+        media_type_conf = self.config.get("media_type", {})
+        self.media_classifier = MediaClassifier(
+            self.media_cache,
+            probe=media_type_conf.get("probe", True),
+            max_entries=media_type_conf.get("cache_size", 4096),
+            timeout=media_type_conf.get("timeout", 5),
+        )
+        # 媒体预取: 下载队列中接下来要发送的文件, 与当前的上传同时进行
+        prefetch_conf = self.config.get("prefetch", {})
+        self.prefetcher = None
+        if prefetch_conf.get("lookahead", 8):
+            self.prefetcher = MediaPrefetcher(
+                self.media_cache,
+                workers=prefetch_conf.get("workers", 4),
+                max_bytes=prefetch_conf.get("max_bytes", 256 * 1024 * 1024),
+                max_age=media_conf.get("ttl", 600),
+            )
+
+        # 发送调度: 工作线程池 + 限流, 消息处理不占用 watchdog 线程
+        dispatcher_conf = self.config.get("dispatcher", {})
+        rate_conf = self.config.get("rate_limit", {})
+        retry_conf = self.config.get("retry", {})
+        self.dispatcher = Dispatcher(
+            workers=dispatcher_conf.get("workers", 4),
+            queue_size=dispatcher_conf.get("queue_size", 10000),
+            rate_limiter=RateLimiter(
+                global_rate=rate_conf.get("global_rate", 2.0),
+                global_burst=rate_conf.get("global_burst", 10),
+                target_rate=rate_conf.get("target_rate", 1.0),
+                target_burst=rate_conf.get("target_burst", 5),
+            ),
+            retry_policy=RetryPolicy(
+                max_attempts=retry_conf.get("max_attempts", 5),
+                base_delay=retry_conf.get("base_delay", 2.0),
+                max_delay=retry_conf.get("max_delay", 300.0),
+                jitter=retry_conf.get("jitter", 0.5),
+            ),
+            lane_weights=dispatcher_conf.get("lane_weights"),
+            lookahead=prefetch_conf.get("lookahead", 8) if self.prefetcher else 0,
+        )
+        self.dispatcher.start()
+        # $send_msg 命令等待发送结束的最长时间 (秒), 超时后回复"仍在发送中"
+        self.command_timeout = dispatcher_conf.get("command_timeout", 30)
+
+        # 发送计划: 一批消息中的目标只解析一次, 相同发送去重, 可选合并短文本
+        planner_conf = self.config.get("planner", {})
+        self.batch_size = planner_conf.get("batch_size", 500)
+        self.planner = DeliveryPlanner(
+            self._resolve_group,
+            self._resolve_friend,
+            self._detect_media_type,
+            merge_texts=planner_conf.get("merge_texts", False),
+            merge_limit=planner_conf.get("merge_limit", 2000),
+        )
+        # 预演使用的计划: 解析方式相同, 判断媒体类型时不下载文件
+        self.dry_run_planner = DeliveryPlanner(
+            self._resolve_group,
+            self._resolve_friend,
+            lambda content: self._detect_media_type(content, adopt=False),
+            merge_texts=planner_conf.get("merge_texts", False),
+            merge_limit=planner_conf.get("merge_limit", 2000),
+        )
 
         # 设置文件监视
-        self.file_path = os.path.join(curdir, "data.json")
+        watch_conf = self.config.get("watch", {})
+        self.file_path = os.path.join(curdir, watch_conf.get("file", "data.json"))
+        # document: 整个文件为一个消息列表, 读取时 rename 为 data.json.claimed, 导入后删除; tail: 每行一条消息, 从记录的偏移量增量读取
+        self.watch_mode = watch_conf.get("mode", "document")
+        self._tail_state_path = self.file_path + ".offset"
         self.observer = Observer()
-        self.event_handler = FileChangeHandler(self.handle_message)
-        self.start_watch()
+        self.event_handler = FileChangeHandler(
+            self.handle_message,
+            file_name=os.path.basename(self.file_path),
+            debounce=watch_conf.get("debounce", 0.2),
+            max_delay=watch_conf.get("max_delay", 2.0),
+        )
+        if watch_conf.get("enabled", True):
+            self.start_watch()
+
+        # 多账号频道池: 群聊/好友按一致性哈希分配到账号, 账号不可用时切换到下一个
+        accounts_conf = self.config.get("accounts", {})
+        self.pool = ChannelPool(
+            affinity=accounts_conf.get("affinity"),
+            replicas=accounts_conf.get("replicas", 100),
+        )
 
         # 根据配置初始化通信频道
         self.channel_type = conf().get("channel_type", "wx")
         self.initialize_channel()
+        if accounts_conf.get("extra"):
+            threading.Thread(target=self.login_extra_accounts, args=(accounts_conf["extra"],),
+                             name="send_msg-accounts", daemon=True).start()
+
+        self.register_metrics()
+        self.file_writer.set_dry_run(self.dry_run)
+
+        # 消费线程: 接收 file_api 交接的消息和 data.json 中的消息
+        threading.Thread(target=self._consume_loop, name="send_msg-consumer", daemon=True).start()
+        self.scheduler.start()
+
+    def register_metrics(self):
+        """
+        注册 /metrics 输出的瞬时值, 在输出时读取, 不增加发送路径的开销。
+        """
+        registry.gauge("send_msg_queue_depth", "调度器中等待执行的发送任务数", self.dispatcher.queue_depth)
+        registry.gauge("send_msg_in_flight", "正在执行的发送任务数", lambda: self.dispatcher.in_flight)
+        registry.gauge("send_msg_lane_depth", "各优先级队列中等待执行的发送任务数", self.dispatcher.lane_depths,
+                       labelnames=("lane",))
+        registry.gauge("send_msg_retrying", "等待重试的发送任务数", lambda: len(self.dispatcher._delayed))
+        registry.gauge("send_msg_spool_pending", "spool 中尚未确认的消息数", self.spool.pending_count)
+        registry.gauge("send_msg_dead_letters", "死信队列中的消息数", lambda: len(self.dead_letters))
+        registry.gauge("send_msg_scheduled", "等待发送的定时消息数", lambda: len(self.scheduler))
+        registry.gauge("send_msg_accounts_alive", "可用的微信账号数", lambda: sum(account.alive for account in self.pool.accounts))
+        if self.prefetcher is not None:
+            registry.gauge("send_msg_prefetch_bytes", "已预取尚未发送的文件字节数", lambda: self.prefetcher.held_bytes)
+        registry.gauge("send_msg_circuit_open", "熔断器是否打开 (1 为打开或探测中)",
+                       lambda: {(breaker.name,): int(breaker.state != CLOSED) for breaker in self._breakers()},
+                       labelnames=("breaker",))
+        registry.gauge("send_msg_cache_hit_ratio", "通讯录与媒体缓存命中率", self._cache_hit_ratios, labelnames=("cache",))
+
+    def _breakers(self):
+        breakers = [account.breaker for account in self.pool.accounts]
+        return breakers + list(self.media_cache.breakers.values())
+
+    def _breaker_status(self):
+        """
+        $check watchdog 中的熔断状态, 只列出账号和未关闭的下载熔断器。
+        """
+        names = {CLOSED: "正常", OPEN: "熔断", HALF_OPEN: "探测中"}
+        parts = []
+        for breaker in self._breakers():
+            stats = breaker.stats()
+            if breaker.name.startswith("下载") and stats["state"] == CLOSED:
+                continue
+            part = f"{breaker.name} {names[stats['state']]}"
+            if stats["state"] == OPEN:
+                part += f" ({stats['retry_after']:.0f} 秒后探测)"
+            parts.append(part)
+        held = self.dispatcher.stats()["held"]
+        return ", ".join(parts) + (f"; 因熔断等待的任务 {held} 次" if held else "")
+
+    def _cache_hit_ratios(self):
+        ratios = {("media",): self.media_cache.stats()["hit_rate"],
+                  ("media_type",): self.media_classifier.stats()["hit_rate"]}
+        if self.idempotency is not None:
+            ratios[("idempotency",)] = self.idempotency.stats()["hit_rate"]
+        if self.directory:
+            ratios[("directory",)] = self.directory.stats()["hit_rate"]
+        return ratios
 
     def initialize_channel(self):
         if self.channel_type == "wx":
@@ -77,6 +333,88 @@ class FileWatcherPlugin(Plugin):
                 logger.error(f"未安装 ntchat: {e}")
         else:
             logger.error(f"不支持的 channel_type: {self.channel_type}")
+            return
+
+        if self.channel is not None:
+            self.bind_channel(self.channel)
+
+    def bind_channel(self, channel, channel_type=None):
+        """
+        使用指定的频道对象发送消息并重建通讯录缓存, 用于替换为测试或压测用的频道。
+        """
+        if self.directory is not None:
+            self.directory.stop_background_refresh()
+        self.channel = channel
+        if channel_type is not None:
+            self.channel_type = channel_type
+        self.initialize_directory()
+        self.pool.remove("default")
+        self.pool.add(self._new_account("default", channel, self.channel_type, self.directory))
+
+    def add_account(self, name, channel, channel_type=None):
+        """
+        添加一个已登录的账号到频道池, 与主账号分担发送。
+        """
+        channel_type = channel_type or self.channel_type
+        directory = self._new_directory(channel, channel_type)
+        directory.start_background_refresh()
+        old = self.pool.get(name)
+        if old is not None and old.directory is not None:
+            old.directory.stop_background_refresh()
+        account = self.pool.add(self._new_account(name, channel, channel_type, directory))
+        logger.info(f"已添加账号 {name}, 当前共 {len(self.pool)} 个账号。")
+        return account
+
+    def login_extra_accounts(self, extra):
+        """
+        登录配置中的其他账号, 登录失败的账号跳过。
+        itchat 每个账号使用独立的实例和登录状态文件; ntchat 每个账号打开一个新的微信客户端。
+        """
+        for index, account_conf in enumerate(extra, start=1):
+            name = account_conf.get("name") or f"account{index}"
+            try:
+                if self.channel_type == "wx":
+                    import itchat
+                    channel = itchat.new_instance()
+                    channel.auto_login(hotReload=True, statusStorageDir=os.path.join(self.plugin_dir, f"itchat_{name}.pkl"))
+                elif self.channel_type == "ntchat":
+                    import ntchat
+                    channel = ntchat.WeChat()
+                    channel.open(smart=account_conf.get("smart", True))
+                    channel.wait_login()
+                else:
+                    return
+                self.add_account(name, channel)
+            except Exception as e:
+                logger.error(f"登录账号 {name} 失败: {e}")
+
+    def _new_account(self, name, channel, channel_type, directory):
+        accounts_conf = self.config.get("accounts", {})
+        return Account(
+            name, channel, channel_type, directory,
+            failure_threshold=accounts_conf.get("failure_threshold", 3),
+            down_time=accounts_conf.get("down_time", 60),
+            max_down_time=accounts_conf.get("max_down_time", 600),
+            # 熔断后通过刷新通讯录检查账号是否恢复
+            probe=directory.refresh,
+        )
+
+    def initialize_directory(self):
+        """
+        初始化通讯录缓存, 避免每条消息都全量刷新好友和群聊列表。
+        """
+        self.directory = self._new_directory(self.channel, self.channel_type)
+        self.directory.start_background_refresh()
+
+    def _new_directory(self, channel, channel_type):
+        directory_conf = self.config.get("directory", {})
+        directory_class = ItchatDirectory if channel_type == "wx" else NtchatDirectory
+        return directory_class(
+            channel,
+            ttl=directory_conf.get("ttl", 300),
+            refresh_interval=directory_conf.get("refresh_interval", 0),
+            miss_refresh_interval=directory_conf.get("miss_refresh_interval", 10),
+        )
 
     def on_handle_context(self, e_context: EventContext):
         context = e_context.get('context', {})
@@ -98,12 +436,32 @@ class FileWatcherPlugin(Plugin):
 
         elif content == "$check watchdog":
             status = "Watchdog 正在运行。如需停止，请使用命令 $stop watchdog。" if self.observer.is_alive() else "Watchdog 未在运行。如需启动，请使用命令 $start watchdog。"
+            if self.directory:
+                stats = self.directory.stats()
+                status += f"\n通讯录缓存: 命中 {stats['hits']}, 未命中 {stats['misses']}, 刷新 {stats['refreshes']}, 命中率 {stats['hit_rate']:.1%}"
+            stats = self.dispatcher.stats()
+            status += f"\n发送队列: 排队 {stats['queue_depth']}, 发送中 {stats['in_flight']}, 完成 {stats['completed']}, 失败 {stats['failed']}, 平均等待 {stats['wait_avg']:.1f}s"
+            status += "\n优先级队列: " + ", ".join(f"{lane} 排队 {lane_stats['queue_depth']} 平均等待 {lane_stats['wait_avg']:.1f}s"
+                                               for lane, lane_stats in stats["lanes"].items())
+            status += f"\n重试: 等待重试 {stats['retrying']}, 已重试 {stats['retried']}, 死信 {len(self.dead_letters)}"
+            if self.prefetcher is not None:
+                stats = self.prefetcher.stats()
+                status += f"\n媒体预取: 已预取 {stats['prefetched']}, 超出预算跳过 {stats['skipped']}, 持有 {stats['bytes'] / 1024 / 1024:.1f}MB"
+            status += f"\n定时消息: 等待 {len(self.scheduler)}, 已触发 {self.scheduler.fired}"
+            if len(self.pool) > 1:
+                accounts = ", ".join(f"{name} {'可用' if stats['alive'] else '不可用'} 发送 {stats['sent']} 失败 {stats['failed']}"
+                                     for name, stats in self.pool.stats().items())
+                status += f"\n账号: {accounts}"
+            status += f"\n熔断: {self._breaker_status()}"
             e_context['reply'] = self.create_reply(ReplyType.INFO, status)
             e_context.action = EventAction.BREAK_PASS
 
         elif content.startswith("$send_msg"):
             self.handle_send_msg_command(content, e_context)
 
+        elif content.startswith("$dlq"):
+            self.handle_dlq_command(content, e_context)
+
     def create_reply(self, reply_type, content):
         reply = Reply()
         reply.type = reply_type
@@ -112,34 +470,92 @@ class FileWatcherPlugin(Plugin):
 
     def handle_send_msg_command(self, content, e_context):
         try:
-            receiver_names, message, group_names = self.parse_send_msg_command(content)
-            self.send_message(receiver_names, message, group_names)
-            e_context['reply'] = self.create_reply(ReplyType.INFO, "消息发送成功。")
+            receiver_names, message, group_names, priority, dry_run = self.parse_send_msg_command(content)
+            if dry_run:
+                record = {"receiver_name": receiver_names, "message": message, "group_name": group_names}
+                if priority is not None:
+                    record["priority"] = priority
+                e_context['reply'] = self.create_reply(ReplyType.INFO, self._format_dry_run(self.dry_run([record])))
+            elif priority is None:
+                if self.send_message(receiver_names, message, group_names, timeout=self.command_timeout):
+                    e_context['reply'] = self.create_reply(ReplyType.INFO, "消息发送成功。")
+                else:
+                    e_context['reply'] = self.create_reply(ReplyType.INFO, "消息已提交, 仍在发送中。")
+            else:
+                # 指定优先级时进入对应的发送队列, 与 API 提交的消息一起调度
+                record = {"receiver_name": receiver_names, "message": message, "group_name": group_names, "priority": priority}
+                seqs = self.spool.append_many([record])
+                self.ingest(list(zip(seqs, [record])))
+                e_context['reply'] = self.create_reply(ReplyType.INFO, f"消息已加入 {priority} 发送队列, 序号 {seqs[0]}。")
         except Exception as e:
             logger.error(f"发送消息失败: {e}")
             e_context['reply'] = self.create_reply(ReplyType.ERROR, f"消息发送失败: {str(e)}")
         e_context.action = EventAction.BREAK_PASS
 
+    def _format_dry_run(self, report, limit=20):
+        lines = [f"预演: 消息 {report['items']} 条, 发送 {len(report['deliveries'])} 次 (调用 {report['sends']} 次), "
+                 f"去重 {report['duplicates']} 次, 无法发送 {len(report['unresolved'])} 个, "
+                 f"按限流预计 {report['estimated_seconds']:.1f} 秒发完"]
+        timings = report["timings"]
+        lines.append(f"耗时: 判断类型 {timings['media_type'] * 1000:.1f}ms, 解析目标 {timings['resolve'] * 1000:.1f}ms, "
+                     f"合计 {timings['total'] * 1000:.1f}ms")
+        for delivery in report["deliveries"][:limit]:
+            at = f" @{','.join(delivery['at'])}" if delivery["at"] else ""
+            account = f" ({delivery['account']})" if delivery["account"] and len(self.pool) > 1 else ""
+            lines.append(f"→ {delivery['target']}{at}{account} [{delivery['media_type']}] {delivery['message']}")
+        if len(report["deliveries"]) > limit:
+            lines.append(f"... 另有 {len(report['deliveries']) - limit} 次发送")
+        for failure in report["unresolved"][:limit]:
+            lines.append(f"✗ {failure['target']}: {failure['error']}")
+        return "\n".join(lines)
+
+    def handle_dlq_command(self, content, e_context):
+        """
+        $dlq 查看死信队列; $dlq replay [id1, id2] 重新提交指定 (或全部) 死信。
+        """
+        args = content[len("$dlq"):].strip()
+        if args.startswith("replay"):
+            ids = [entry_id.strip() for entry_id in args[len("replay"):].strip().strip('[]').split(',') if entry_id.strip()]
+            entries = self.dead_letters.get(ids)
+            if entries:
+                records = [entry["message"] for entry in entries]
+                # 写入 spool 成功后才从死信队列删除
+                seqs = self.spool.append_many(records)
+                self.dead_letters.remove([entry["id"] for entry in entries])
+                self.ingest(list(zip(seqs, records)))
+            reply = f"已重新提交 {len(entries)} 条死信。"
+        else:
+            entries = self.dead_letters.list(limit=20)
+            lines = [f"{entry['id']} {entry['message'].get('message', '')} ({entry['attempts']} 次): {entry['error']}" for entry in entries]
+            reply = f"死信队列共 {len(self.dead_letters)} 条。" + ("\n" + "\n".join(lines) if lines else "")
+        e_context['reply'] = self.create_reply(ReplyType.INFO, reply)
+        e_context.action = EventAction.BREAK_PASS
+
     def parse_send_msg_command(self, command):
         """
         解析 $send_msg 命令。
         预期格式：
             $send_msg [名称1, 名称2] 消息内容
             $send_msg [名称1, 名称2] 消息内容 group[群聊1, 群聊2]
+            $send_msg [名称1, 名称2] 消息内容 group[群聊1, 群聊2] priority[urgent]
+            $send_msg --dry-run [名称1, 名称2] 消息内容 group[群聊1, 群聊2]   只预演发送计划, 不发送
         """
         import re
 
-        pattern = r'^\$send_msg\s*(\[[^\]]*\])?\s*(.*?)\s*(group\[[^\]]*\])?$'
+        pattern = r'^\$send_msg\s*(--dry-run(?:\s+|$))?\s*(\[[^\]]*\])?\s*(.*?)\s*(group\[[^\]]*\])?\s*(priority\[[^\]]*\])?$'
         match = re.match(pattern, command)
         if not match:
             raise ValueError("命令格式不正确。")
 
-        receiver_part, message, group_part = match.groups()
+        dry_run_part, receiver_part, message, group_part, priority_part = match.groups()
 
         receiver_names = [name.strip() for name in receiver_part.strip('[]').split(',') if name.strip()] if receiver_part else []
-        group_names = [name.strip() for name in group_part.strip('group[]').split(',') if name.strip()] if group_part else []
+        group_names = [name.strip() for name in group_part[len('group['):-1].split(',') if name.strip()] if group_part else []
+        priority = priority_part[len('priority['):-1].strip() if priority_part else None
+        if priority is not None and priority not in LANES:
+            raise ValueError(f"优先级只能是 {', '.join(LANES)}。")
 
-        return receiver_names, message, group_names
+        return receiver_names, message, group_names, priority, dry_run_part is not None
 
     def start_watch(self):
         if not self.observer.is_alive():
@@ -158,293 +574,749 @@ class FileWatcherPlugin(Plugin):
             logger.info("Watchdog 未在运行。")
 
     def handle_message(self):
+        """
+        通知消费线程检查 data.json, 立即返回, 不阻塞 watchdog 线程。
+        """
+        self._handoff.put(None)
+
+    def ingest(self, entries):
+        """
+        file_api 写入 spool 后调用, 把 [(seq, 消息), ...] 直接交给消费线程,
+        不再经过文件监听和重新读取。
+        """
+        self._handoff.put((time.perf_counter(), entries))
+
+    def _consume_loop(self):
+        """
+        消费线程: 合并队列中已到达的消息, 生成发送计划后提交到调度器。
+        启动后先重放 spool 中上次未确认的消息, 不必等待新的消息到达。
+        """
+        with self._consume_lock:
+            self._drain_spool()
+        while True:
+            entries, check_file = self._next_handoff()
+            with self._consume_lock:
+                if check_file:
+                    with STAGE_SECONDS.time(stage="import"):
+                        entries.extend(self._import_data_file())
+                # 重放时已经提交过的消息不再重复提交
+                entries = [entry for entry in entries if entry[0] > self._dispatched_seq]
+                for start in range(0, len(entries), self.batch_size):
+                    batch = entries[start:start + self.batch_size]
+                    try:
+                        self.process_messages(batch)
+                    except Exception as e:
+                        self._fail_batch(batch, e)
+
+    def _next_handoff(self):
+        """
+        阻塞等待交接队列, 然后取出所有已到达的内容, 返回 (消息列表, 是否检查 data.json)。
+        """
+        entries = []
+        check_file = False
+        item = self._handoff.get()
+        while True:
+            if item is None:
+                check_file = True
+            else:
+                queued_at, items = item
+                STAGE_SECONDS.observe(time.perf_counter() - queued_at, stage="handoff")
+                entries.extend(items)
+            try:
+                item = self._handoff.get_nowait()
+            except queue.Empty:
+                return entries, check_file
+
+    def _import_data_file(self):
+        """
+        兼容外部程序写入的 data.json, 导入的消息先追加到 spool, 返回 [(seq, 消息), ...]。
+        """
         try:
-            if not os.path.exists(self.file_path):
-                logger.warning(f"文件 {self.file_path} 不存在。")
-                return
+            if self.watch_mode == "tail":
+                if not os.path.exists(self.file_path):
+                    return []
+                return self._tail_data_file()
+            return self._read_data_document()
+        except FileNotFoundError as e:
+            logger.error(f"读取文件 {self.file_path} 出错: {e}")
+        except json.JSONDecodeError as e:
+            # 写入方可能还没写完, 下一次文件事件会再次读取
+            logger.warning(f"文件 {self.file_path} 不是完整的 JSON, 等待写入完成: {e}")
+        except Exception as e:
+            logger.error(f"导入 data.json 时出错: {e}")
+        return []
 
+    def _read_data_document(self):
+        """
+        document 模式: 文件内容为消息列表 (或包含 data_list 的对象)。
+        内容完整时先把文件 rename 为 data.json.claimed 再导入, 写入 spool 后删除;
+        导入期间写入或 rename 到 data.json 的新文件不受影响, 由它自己的文件事件触发导入。
+        上次导入中断留下的 claimed 文件先导入。
+        """
+        claimed_path = self.file_path + ".claimed"
+        entries = []
+        if os.path.exists(claimed_path):
+            try:
+                entries.extend(self._import_claimed(claimed_path))
+            except ValueError as e:
+                logger.error(f"文件 {claimed_path} 无法导入, 已改名为 .invalid: {e}")
+
+        try:
             with open(self.file_path, 'r', encoding='utf-8') as file:
                 data = file.read().strip()
+        except FileNotFoundError:
+            return entries
+        if not data:
+            return entries
+        # 写入方可能还没写完, 不完整时抛出 JSONDecodeError, 等待下一次文件事件
+        data_list = json.loads(data)
+        os.replace(self.file_path, claimed_path)
+        entries.extend(self._import_claimed(claimed_path, data, data_list))
+        return entries
+
+    def _import_claimed(self, claimed_path, data=None, data_list=None):
+        """
+        导入 rename 得到的文件并删除; 内容不是消息列表时改名为 data.json.invalid, 不再重复读取。
+        """
+        with open(claimed_path, 'r', encoding='utf-8') as file:
+            claimed = file.read().strip()
+        try:
+            if claimed != data:
+                # 读取与 rename 之间文件被替换, 以 rename 得到的内容为准
+                data_list = json.loads(claimed) if claimed else []
+            if isinstance(data_list, dict):
+                data_list = data_list.get("data_list")
+            if not isinstance(data_list, list):
+                raise ValueError("data.json 应该包含消息列表。")
+        except ValueError:
+            os.replace(claimed_path, self.file_path + ".invalid")
+            raise
+        data_list = self._check_records(data_list)
+        seqs = self.spool.append_many(data_list)
+        os.remove(claimed_path)
+        return list(zip(seqs, data_list))
 
-            if data:
-                data_list = json.loads(data)
-                if not isinstance(data_list, list):
-                    raise ValueError("data.json 应该包含消息列表。")
-                for item in data_list:
-                    self.process_message(item)
-                # 处理完毕后清空文件
-                with open(self.file_path, 'w', encoding='utf-8') as file:
-                    file.write('')
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            logger.error(f"读取文件 {self.file_path} 出错: {e}")
-        except Exception as e:
-            logger.error(f"处理消息时出错: {e}")
+    def _tail_data_file(self):
+        """
+        tail 模式: 每行一条消息 (或消息列表), 只解析上次偏移量之后的完整行。
+        文件被替换或截短时从头读取。
+        """
+        state = self._load_tail_state()
+        stat = os.stat(self.file_path)
+        offset = state.get("offset", 0)
+        if state.get("inode") != stat.st_ino or stat.st_size < offset:
+            offset = 0
+
+        with open(self.file_path, 'rb') as file:
+            file.seek(offset)
+            chunk = file.read(stat.st_size - offset)
+        end = chunk.rfind(b"\n") + 1
+        if not end:
+            return []
+
+        records = []
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"data.json 中的行无法解析, 已跳过: {e}")
+                continue
+            records.extend(record if isinstance(record, list) else [record])
+
+        records = self._check_records(records)
+        seqs = self.spool.append_many(records)
+        self._save_tail_state({"inode": stat.st_ino, "offset": offset + end})
+        return list(zip(seqs, records))
+
+    def _check_records(self, records):
+        """
+        data.json 中的记录写入 spool 前检查格式: 不是消息对象、message 不是字符串的记录直接进入死信队列。
+        """
+        valid = []
+        for record in records:
+            if isinstance(record, dict) and (is_template(record) or isinstance(record.get("message", ""), str)):
+                valid.append(record)
+                continue
+            error = ValueError(f"data.json 中的消息格式不正确: {record!r}")
+            logger.error(str(error))
+            self.dead_letters.add(record if isinstance(record, dict) else {"message": record}, error)
+        return valid
+
+    def _load_tail_state(self):
+        try:
+            with open(self._tail_state_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save_tail_state(self, state):
+        tmp_path = self._tail_state_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self._tail_state_path)
+
+    def _drain_spool(self):
+        """
+        重放 spool 中 checkpoint 之后的消息 (上次运行未确认的部分)。
+        调度器队列已满时阻塞, 形成背压。
+        """
+        while True:
+            try:
+                entries = self.spool.read(self._dispatched_seq, limit=self.batch_size)
+            except Exception as e:
+                logger.error(f"读取 spool 时出错: {e}")
+                return
+            if not entries:
+                break
+            try:
+                self.process_messages(entries)
+            except Exception as e:
+                self._fail_batch(entries, e)
+            self._dispatched_seq = entries[-1][0]
+
+    def _fail_batch(self, entries, error):
+        """
+        process_messages 意外出错: 整批消息进入死信队列并确认, 不阻塞 checkpoint 和后续消息。
+        """
+        logger.error(f"处理消息时出错, {len(entries)} 条消息进入死信队列: {error}")
+        with self._pending_lock:
+            for seq, _ in entries:
+                self._pending_items.pop(seq, None)
+        for seq, data in entries:
+            self.dead_letters.add(data if isinstance(data, dict) else {"message": data}, error)
+            if seq is not None:
+                self.spool.ack(seq)
+
+    def process_messages(self, entries):
+        """
+        为一批 (seq, 消息) 生成发送计划, 每个发送提交为一个任务。
+        一条消息涉及的发送全部结束后确认 spool 中的序号。
+        带 send_at/repeat 的消息交给调度器保存后即确认。
+        """
+        if any(is_scheduled(data) for _, data in entries):
+            self._schedule([entry for entry in entries if is_scheduled(entry[1])])
+            entries = [entry for entry in entries if not is_scheduled(entry[1])]
+            if not entries:
+                return
 
-    def process_message(self, data):
+        with STAGE_SECONDS.time(stage="plan"):
+            plan = self.planner.plan(entries)
+        if plan.unsupported:
+            MESSAGES.inc(plan.unsupported, status="unsupported")
+        if len(plan.failures) > plan.unsupported:
+            MESSAGES.inc(len(plan.failures) - plan.unsupported, status="failed")
+        logger.info(f"发送计划: 消息 {plan.items} 条, 解析目标 {plan.resolved} 次, 发送 {len(plan.deliveries)} 次, "
+                    f"去重 {plan.duplicates} 次, 合并 {plan.merged} 次, 失败 {len(plan.failures)} 个")
+
+        with self._pending_lock:
+            for seq, _ in entries:
+                self._pending_items[seq] = 0
+            for delivery in plan.deliveries:
+                for seq in delivery.sources:
+                    self._pending_items[seq] += 1
+
+        for failure in plan.failures:
+            logger.error(f"处理消息时出错: {failure.error}")
+            if failure.sources:
+                self.dead_letters.add(failure.message, failure.error)
+
+        for seq, _ in entries:
+            if not self._pending_items.get(seq):
+                self._on_delivery_done([seq])
+
+        # 高优先级的发送先提交, 同一优先级内保持原有顺序
+        for delivery in sorted(plan.deliveries, key=lambda d: LANES.index(d.priority)):
+            self._submit_delivery(delivery)
+
+    def _submit_delivery(self, delivery, block=True, on_done=None):
+        """
+        把一次发送提交到调度器, 按发送账号和目标限流; 队列已满且 block 为 False 时返回 False。
+        on_done(error) 在发送最终结束 (成功或进入死信队列) 后调用。
+        """
+        account = delivery.target.account
+
+        def callback(error, attempts):
+            self._on_delivery_done(delivery.sources, delivery, error, attempts)
+            if on_done is not None:
+                on_done(error)
+
+        return self.dispatcher.submit(
+            lambda: self._send_delivery(delivery),
+            key=(account.name if account else None, delivery.target.dest),
+            limit_keys=(delivery.target.dest,),
+            account=account.name if account else None,
+            cost=self._delivery_cost(delivery),
+            lane=delivery.priority,
+            prefetch=self._prefetch_of(delivery),
+            block=block,
+            callback=callback,
+        )
+
+    def _schedule(self, entries):
+        """
+        保存定时消息, 以 spool 序号作为定时消息 id, 重放时不会重复添加。参数错误的消息进入死信队列。
+        """
+        entries = [(seq if seq is not None else uuid.uuid4().hex, data) for seq, data in entries]
         try:
-            receiver_names = data.get("receiver_name", [])
-            content = data.get("message", "")
-            group_names = data.get("group_name", [])
+            self.scheduler.add_many(entries)
+        except ValueError:
+            for seq, data in entries:
+                try:
+                    self.scheduler.add_many([(seq, data)])
+                except ValueError as e:
+                    logger.error(f"定时消息参数错误: {e}")
+                    self.dead_letters.add(data, e)
+        for seq, _ in entries:
+            if isinstance(seq, int):
+                self._on_delivery_done([seq])
+
+    def _submit_scheduled(self, messages):
+        """
+        调度器回调: 到期的消息写入 spool 后交给消费线程。
+        """
+        seqs = self.spool.append_many(messages)
+        self.ingest(list(zip(seqs, messages)))
+        logger.info(f"提交定时消息 {len(messages)} 条, 序号{seqs}")
 
-            self.send_message(receiver_names, content, group_names)
-        except Exception as e:
-            logger.error(f"处理消息时出错: {e}")
+    def process_message(self, data, seq=None):
+        self.process_messages([(seq, data)])
+
+    def dry_run(self, messages):
+        """
+        只生成发送计划, 不发送也不写入 spool。
+        返回展开后的发送列表、无法解析的目标、各阶段耗时, 以及按限流估计的发送时间 (秒)。
+        发送和失败的 sources 为消息在 messages 中的下标。
+        """
+        plan = self.dry_run_planner.plan(list(enumerate(messages)))
+
+        started = time.perf_counter()
+        deliveries = []
+        sends = []
+        for delivery in plan.deliveries:
+            account = delivery.target.account
+            account_name = account.name if account else None
+            cost = self._delivery_cost(delivery)
+            sends.append((account_name, (delivery.target.dest,), cost))
+            deliveries.append({
+                "target": delivery.target.label,
+                "is_group": delivery.target.is_group,
+                "at": list(delivery.target.at_names),
+                "account": account_name,
+                "media_type": delivery.media_type,
+                "priority": delivery.priority,
+                "message": delivery.render(),
+                "sources": delivery.sources,
+            })
+        estimated = self.dispatcher.rate_limiter.estimate(sends)
+        timings = dict(plan.timings, report=time.perf_counter() - started)
+
+        lanes = {lane: 0 for lane in LANES}
+        accounts = {}
+        for delivery in deliveries:
+            lanes[delivery["priority"]] += 1
+            accounts[delivery["account"]] = accounts.get(delivery["account"], 0) + 1
+        return {
+            "items": plan.items,
+            "deliveries": deliveries,
+            "unresolved": [{"target": failure.target, "error": str(failure.error), "sources": failure.sources}
+                           for failure in plan.failures],
+            "resolved": plan.resolved,
+            "duplicates": plan.duplicates,
+            "merged": plan.merged,
+            "unsupported": plan.unsupported,
+            "sends": sum(cost for _, _, cost in sends),
+            "lanes": lanes,
+            "accounts": accounts,
+            "estimated_seconds": round(estimated, 3),
+            "timings": {stage: round(seconds, 6) for stage, seconds in timings.items()},
+        }
+
+    def _delivery_cost(self, delivery):
+        # itchat 发送带 @ 的媒体消息时会先单独发送一条 @ 文本
+        account = delivery.target.account
+        channel_type = account.channel_type if account is not None else self.channel_type
+        if channel_type == "wx" and delivery.media_type != "text" and delivery.target.at_names:
+            return 2
+        return 1
+
+    def _prefetch_of(self, delivery):
+        if self.prefetcher is None or delivery.media_type not in ("img", "video", "file"):
+            return None
+        url = delivery.render()
+        return lambda: self.prefetcher.prefetch(url)
 
-    def send_message(self, receiver_names, content, group_names=None):
+    def _on_delivery_done(self, sources, delivery=None, error=None, attempts=0):
         """
-        根据配置的 channel_type 发送消息。
+        一次发送结束: 最终失败的发送进入死信队列, 消息的全部发送结束后确认 spool 序号。
+        """
+        if error is not None:
+            MESSAGES.inc(status="failed")
+            self.dead_letters.add(delivery.to_message(), error, attempts)
+        if self.prefetcher is not None and delivery is not None and delivery.media_type in ("img", "video", "file"):
+            self.prefetcher.done(delivery.render())
+        done = []
+        with self._pending_lock:
+            for seq in sources:
+                if seq is None:
+                    continue
+                remaining = self._pending_items.get(seq, 0) - 1
+                if remaining > 0:
+                    self._pending_items[seq] = remaining
+                else:
+                    self._pending_items.pop(seq, None)
+                    done.append(seq)
+        for seq in done:
+            self.spool.ack(seq)
+
+    def send_message(self, receiver_names, content, group_names=None, timeout=None):
+        """
+        发送一条消息: 与其他消息一样经过调度器的限流、重试和死信队列, 并等待全部发送结束。
+        所有发送结束后, 若有发送失败或目标解析失败则抛出第一个错误;
+        超过 timeout 秒仍未结束时返回 False (消息继续在后台发送), 否则返回 True。
         """
         if self.channel_type not in ["wx", "ntchat"]:
             logger.error(f"不支持的 channel_type: {self.channel_type}")
-            return
+            return True
 
         try:
-            if self.channel_type == "wx":
-                self._send_itchat_message(receiver_names, content, group_names)
-            elif self.channel_type == "ntchat":
-                self._send_ntchat_message(receiver_names, content, group_names)
+            plan = self.planner.plan([(None, {"receiver_name": receiver_names, "message": content, "group_name": group_names})])
+            errors = []
+            remaining = [len(plan.deliveries)]
+            finished = threading.Event()
+            lock = threading.Lock()
+
+            def on_done(error):
+                with lock:
+                    if error is not None:
+                        errors.append(error)
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        finished.set()
+
+            if not plan.deliveries:
+                finished.set()
+            for delivery in plan.deliveries:
+                self._submit_delivery(delivery, on_done=on_done)
+            if not finished.wait(timeout):
+                return False
+            if errors:
+                raise errors[0]
+            if plan.failures:
+                raise plan.failures[0].error
+            return True
         except Exception as e:
             logger.error(f"发送消息时出错: {e}")
             raise
 
-    def _detect_media_type(self, content):
+    def _send_delivery(self, delivery):
+        account = delivery.target.account
+        if account is not None:
+            if not account.alive:
+                return self._failover(delivery)
+            account.breaker.check()
+        if delivery.media_type == DEFERRED:
+            self._classify_deferred(delivery)
+
+        channel_type = account.channel_type if account is not None else self.channel_type
+        with STAGE_SECONDS.time(stage="send"):
+            try:
+                if channel_type == "wx":
+                    self._send_itchat_message(delivery)
+                elif channel_type == "ntchat":
+                    self._send_ntchat_message(delivery)
+            except ChannelError:
+                if account is not None:
+                    account.record_failure()
+                raise
+        if account is not None:
+            account.record_success()
+        MESSAGES.inc(status="sent")
+
+    def _classify_deferred(self, delivery):
+        """
+        生成计划时域名不可用、未能判断类型的链接, 发送前再次判断。
+        仍不可用时抛出 CircuitOpenError (域名已熔断) 或 TransientError, 由调度器稍后重试。
+        """
+        url = delivery.render()
+        media_type = self._detect_media_type(url)
+        if media_type == DEFERRED:
+            retry_after = self.media_cache.host_retry_after(url)
+            if retry_after:
+                raise CircuitOpenError(f"下载 {url} 的域名已熔断, 稍后判断类型", retry_after)
+            raise TransientError(f"暂时无法判断 {url} 的类型")
+        if media_type == "unsupported":
+            raise ValueError(f"不支持的文件类型: {url}")
+        delivery.media_type = media_type
+
+    def _failover(self, delivery):
+        """
+        账号不可用时重新解析目标, 作为新任务提交给调度器, 由其他能发送该群聊/好友的账号按该账号的限流发送;
+        原任务在新任务提交后结束, 消息在新任务结束后才确认。
         """
-        根据内容判断媒体类型。
+        logger.warning(f"账号 {delivery.target.account.name} 不可用, 改由其他账号发送到 {delivery.target.label}")
+        plan = self.planner.plan([(None, delivery.to_message())])
+        if plan.failures:
+            raise plan.failures[0].error
+        if any(not new_delivery.target.account.alive for new_delivery in plan.deliveries):
+            # 所有账号都已熔断, 任务留在队列中等待恢复
+            retry_after = min(account.breaker.retry_after() for account in self.pool.accounts) or 1.0
+            raise CircuitOpenError(f"没有可用的账号发送到 {delivery.target.label}", retry_after)
+
+        for new_delivery in plan.deliveries:
+            new_delivery.sources = list(delivery.sources)
+            new_delivery.priority = delivery.priority
+            self._add_pending(new_delivery.sources, 1)
+            # 在工作线程中提交, 队列已满时不等待, 原任务稍后重试
+            if not self._submit_delivery(new_delivery, block=False):
+                self._add_pending(new_delivery.sources, -1)
+                raise TransientError(f"发送队列已满, 稍后改由其他账号发送到 {delivery.target.label}")
+
+    def _add_pending(self, sources, count):
+        with self._pending_lock:
+            for seq in sources:
+                if seq is not None:
+                    self._pending_items[seq] = self._pending_items.get(seq, 0) + count
+
+    def _detect_media_type(self, content, adopt=True):
+        """
+        根据内容判断媒体类型。adopt 为 False 时探测不会开始下载文件 (预演使用)。
         """
         if content.startswith(("http://", "https://")):
-            lower_content = content.lower()
-            if lower_content.endswith((".jpg", ".jpeg", ".png", ".gif", ".img")):
-                return "img"
-            elif lower_content.endswith((".mp4", ".avi", ".mov", ".pdf")):
-                return "video"
-            elif lower_content.endswith((".doc", ".docx", ".xls", ".xlsx", ".zip", ".rar", ".txt", ".csv")):
-                return "file"
-            else:
+            media_type = self.media_classifier.classify(content, adopt=adopt)
+            if media_type == "unsupported":
                 logger.warning(f"不支持的文件类型: {content}")
-                return "unsupported"
+            return media_type
         return "text"
 
-    def _send_itchat_message(self, receiver_names, content, group_names):
+    def _resolve_group(self, group_name, receiver_names):
         """
-        使用 itchat 发送消息。
+        解析群聊及需要 @ 的成员, 返回 ([Target], [(名称, 错误)])。
+        按账号池中的顺序使用第一个能找到该群聊的账号 (该账号是群成员)。
         """
-        try:
-            self.channel.get_friends(update=True)
-            self.channel.get_chatrooms(update=True)
-
-            media_type = self._detect_media_type(content)
-            if media_type == "unsupported":
-                return
+        for account in self._accounts_for(group_name):
+            chatroom = account.directory.find_chatroom(group_name)
+            if chatroom:
+                break
+        else:
+            raise ValueError(f"未找到群聊: {group_name}")
+        channel_type = account.channel_type
+        dest = chatroom.get("UserName") if channel_type == "wx" else chatroom.get("wxid")
+
+        def request(*names):
+            return {"receiver_name": list(names), "group_name": [group_name]}
+
+        if not receiver_names:
+            return [Target(dest, group_name, is_group=True, request=request(), account=account)], []
+
+        if any(name in AT_ALL_NAMES for name in receiver_names) and channel_type == "ntchat":
+            return [Target(dest, group_name, at_names=["所有人"], at_all=True, is_group=True,
+                           request=request(*receiver_names), account=account)], []
+
+        targets, errors, at_names, at_ids = [], [], [], []
+        for receiver_name in receiver_names:
+            if receiver_name in AT_ALL_NAMES:
+                targets.append(Target(dest, group_name, at_names=["所有人"], at_all=True, is_group=True,
+                                      request=request(receiver_name), account=account))
+                continue
+            if channel_type == "wx":
+                member = self._find_itchat_member(chatroom, receiver_name, account.directory)
+                if member:
+                    # itchat 每个 @ 对象单独发送一条
+                    targets.append(Target(dest, group_name, at_names=[member.NickName], is_group=True,
+                                          request=request(receiver_name), account=account))
+                    continue
+            else:
+                wxid = self._find_ntchat_member(chatroom, receiver_name, account.directory)
+                if wxid:
+                    at_names.append(receiver_name)
+                    at_ids.append(wxid)
+                    continue
+            errors.append((receiver_name, ValueError(f"在群聊 {group_name} 中未找到成员: {receiver_name}")))
+
+        if at_ids:
+            # ntchat 一条消息 @ 多个成员
+            targets.append(Target(dest, group_name, at_names=at_names, at_ids=at_ids, is_group=True,
+                                  request=request(*at_names), account=account))
+        return targets, errors
+
+    def _resolve_friend(self, receiver_name):
+        """
+        解析个人消息的接收者, 返回 ([Target], [(名称, 错误)])。
+        按账号池中的顺序使用第一个有该好友的账号。
+        """
+        if receiver_name in AT_ALL_NAMES:
+            raise ValueError("无法在个人消息中 @ 所有人。")
+        request = {"receiver_name": [receiver_name]}
+        for account in self._accounts_for(receiver_name):
+            if account.channel_type == "wx":
+                friend = account.directory.find_friend(receiver_name)
+                if friend:
+                    return [Target(friend.UserName, friend.NickName, request=request, account=account)], []
+            else:
+                wxid = self._find_ntchat_friend(receiver_name, account.directory)
+                if wxid:
+                    return [Target(wxid, receiver_name, request=request, account=account)], []
+        raise ValueError(f"未找到好友: {receiver_name}")
 
-            if group_names:
-                for group_name in group_names:
-                    chatrooms = self.channel.search_chatrooms(name=group_name)
-                    if not chatrooms:
-                        raise ValueError(f"未找到群聊: {group_name}")
-                    chatroom = chatrooms[0]
-
-                    if receiver_names:
-                        for receiver_name in receiver_names:
-                            at_content = ""
-                            if receiver_name in ["所有人", "all"]:
-                                at_content = "@所有人 "
-                            else:
-                                member = self._find_itchat_member(chatroom, receiver_name)
-                                if member:
-                                    at_content = f"@{member.NickName} "
-                                else:
-                                    raise ValueError(f"在群聊 {group_name} 中未找到成员: {receiver_name}")
-                            self.send_msg(media_type, content, chatroom.UserName, at_content)
-                            logger.info(f"发送消息到 {group_name} 的 {receiver_name}: {content}")
-                    else:
-                        self.send_msg(media_type, content, chatroom.UserName)
-                        logger.info(f"发送消息到群聊 {group_name}: {content}")
+    def _accounts_for(self, name):
+        """
+        群聊/好友对应的账号, 按优先级排列; 所有账号都不可用时返回全部账号, 发送失败后按重试策略重试。
+        """
+        return self.pool.candidates(name) or self.pool.candidates(name, alive_only=False)
 
-            else:
-                if receiver_names:
-                    for receiver_name in receiver_names:
-                        if receiver_name in ["所有人", "all"]:
-                            raise ValueError("无法在个人消息中 @ 所有人。")
-                        friends = self.channel.search_friends(remarkName=receiver_name) or self.channel.search_friends(name=receiver_name)
-                        if friends:
-                            self.send_msg(media_type, content, friends[0].UserName)
-                            logger.info(f"发送消息到 {friends[0].NickName}: {content}")
-                        else:
-                            raise ValueError(f"未找到好友: {receiver_name}")
-                else:
-                    raise ValueError("接收者列表为空，无法发送个人消息。")
+    def _send_itchat_message(self, delivery):
+        """
+        使用 itchat 发送一次计划好的发送。
+        """
+        target = delivery.target
+        content = delivery.render()
+        try:
+            at_content = "".join(f"@{name} " for name in target.at_names)
+            self.send_msg(delivery.media_type, content, target.dest, at_content, channel=self._channel_of(target))
+            logger.info(f"发送消息到 {target.label}{' 的 ' + ','.join(target.at_names) if target.at_names else ''}: {content}")
         except Exception as e:
             logger.error(f"发送 itchat 消息时出错: {e}")
             raise
 
-    def _find_itchat_member(self, chatroom, member_name):
+    def _find_itchat_member(self, chatroom, member_name, directory=None):
         """
         在 itchat 群聊中通过名称查找成员。
         """
-        for member in chatroom.MemberList:
-            # 一些微信名称是不常见字, 会有特殊符号   需要除去
-            if member.NickName.replace("\x7f\x7f", "") == member_name or member.DisplayName.replace("\x7f\x7f", "") == member_name:
-                return member
+        directory = directory or self.directory
+        member = directory.find_member(chatroom, member_name)
+        if member:
+            return member
         # 如果在群聊中未找到，尝试在好友列表中查找
-        friends = self.channel.search_friends(remarkName=member_name) or self.channel.search_friends(name=member_name)
-        return friends[0] if friends else None
+        return directory.find_friend(member_name)
 
-    def _send_ntchat_message(self, receiver_names, content, group_names):
+    def _send_ntchat_message(self, delivery):
         """
-        使用 ntchat 发送消息。
+        使用 ntchat 发送一次计划好的发送。
         """
+        target = delivery.target
+        channel = self._channel_of(target)
+        content = delivery.render()
         try:
-            media_type = self._detect_media_type(content)
-            if media_type == "unsupported":
-                return
-
-            if group_names:
-                for group_name in group_names:
-                    chatroom = self._find_ntchat_chatroom(group_name)
-                    if not chatroom:
-                        logger.warning(f"未找到群聊: {group_name}")
-                        continue
-
-                    wxid = chatroom.get("wxid")
-                    room_members = self.channel.get_room_members(wxid)
-
-                    if receiver_names:
-                        if "所有人" in receiver_names or "all" in receiver_names:
-                            at_content = f"@所有人 {content}"
-                            self.channel.send_room_at_msg(wxid, at_content, [])
-                            logger.info(f"发送消息到 {group_name} 的所有人: {content}")
-                        else:
-                            user_wxids = [self._find_ntchat_member(wxid, name) for name in receiver_names]
-                            user_wxids = [uid for uid in user_wxids if uid]
-
-                            if user_wxids:
-                                at_content = f"{' '.join([f'@{name}' for name in receiver_names])} {content}"
-                                self.channel.send_room_at_msg(wxid, at_content, user_wxids)
-                                logger.info(f"发送消息到 {group_name} 的 {receiver_names}: {content}")
-                            else:
-                                logger.warning(f"在群聊 {group_name} 中未找到成员: {receiver_names}")
-                    else:
-                        self.channel.send_text(wxid, content)
-                        logger.info(f"发送消息到群聊 {group_name}: {content}")
-
+            if target.at_names:
+                # ntchat 的 @ 消息只支持文本
+                at_content = f"{' '.join(f'@{name}' for name in target.at_names)} {content}"
+                self._channel_call(channel.send_room_at_msg, target.dest, at_content, list(target.at_ids))
+                logger.info(f"发送消息到 {target.label} 的 {','.join(target.at_names)}: {content}")
             else:
-                for receiver_name in receiver_names:
-                    if receiver_name in ["所有人", "all"]:
-                        raise ValueError("无法在个人消息中 @ 所有人。")
-                    wxid = self._find_ntchat_friend(receiver_name)
-                    if wxid:
-                        self._send_ntchat_media_or_text(media_type, content, wxid)
-                        logger.info(f"发送消息到 {receiver_name}: {content}")
-                    else:
-                        logger.warning(f"未找到好友: {receiver_name}")
+                self._send_ntchat_media_or_text(delivery.media_type, content, target.dest, channel)
+                logger.info(f"发送消息到 {target.label}: {content}")
         except Exception as e:
             logger.error(f"发送 ntchat 消息时出错: {e}")
             raise
 
-    def _find_ntchat_chatroom(self, group_name):
+    def _find_ntchat_chatroom(self, group_name, directory=None):
         """
         在 ntchat 中通过名称查找群聊。
         """
-        rooms = self.channel.get_rooms()
-        for room in rooms:
-            if room.get("nickname") == group_name:
-                return room
-        return None
+        return (directory or self.directory).find_chatroom(group_name)
 
-    def _find_ntchat_member(self, group_wxid, member_name):
+    def _find_ntchat_member(self, chatroom, member_name, directory=None):
         """
         在 ntchat 群聊中通过名称查找成员 wxid。
         """
-        room_members = self.channel.get_room_members(group_wxid)
-        for member in room_members.get("member_list", []):
-            if member.get("nickname") == member_name:
-                return member.get("wxid")
-        return None
+        member = (directory or self.directory).find_member(chatroom, member_name)
+        return member.get("wxid") if member else None
 
-    def _find_ntchat_friend(self, friend_name):
+    def _find_ntchat_friend(self, friend_name, directory=None):
         """
         在 ntchat 中通过名称查找好友的 wxid。
         """
-        contacts = self.channel.get_contacts()
-        for friend in contacts:
-            if friend.get("nickname") == friend_name or friend.get("remark") == friend_name:
-                return friend.get("wxid")
-        return None
+        friend = (directory or self.directory).find_friend(friend_name)
+        return friend.get("wxid") if friend else None
 
-    def _send_ntchat_media_or_text(self, media_type, content, wxid):
+    def _send_ntchat_media_or_text(self, media_type, content, wxid, channel=None):
         """
         使用 ntchat 根据消息类型发送文本、图片、视频或文件。
         """
+        channel = channel or self.channel
         if media_type == "text":
-            self.channel.send_text(wxid, content)
+            self._channel_call(channel.send_text, wxid, content)
         else:
-            file_path = self.download_file(content)
-            if not file_path:
-                raise ValueError(f"无法下载文件: {content}")
+            with self.media_cache.acquire(content) as file_path:
+                if not file_path:
+                    raise self._download_error(content)
 
-            try:
                 if media_type == "img":
-                    self.channel.send_image(wxid, file_path)
+                    self._channel_call(channel.send_image, wxid, file_path)
                 elif media_type == "video":
-                    self.channel.send_video(wxid, file_path)
+                    self._channel_call(channel.send_video, wxid, file_path)
                 elif media_type == "file":
-                    self.channel.send_file(wxid, file_path)
+                    self._channel_call(channel.send_file, wxid, file_path)
                 else:
                     logger.error(f"不支持的消息类型: {media_type}")
-            finally:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
 
-    def send_msg(self, msg_type, content, to_user_name, at_content=None):
+    def _download_error(self, url):
+        """
+        下载失败的异常: 域名不可用 (连接失败、超时、5xx) 时可以重试, 4xx 等 URL 本身的问题不再重试。
+        """
+        error = self.media_cache.last_error(url)
+        if error is not None and not self.media_cache.is_host_failure(error):
+            return ValueError(f"无法下载文件: {url}: {error}")
+        return TransientError(f"无法下载文件: {url}")
+
+    def send_msg(self, msg_type, content, to_user_name, at_content=None, channel=None):
         """
         使用 itchat 发送消息。
         :param msg_type: 消息类型
         :param content: 消息内容
         :param to_user_name: 接收者的 UserName
         :param at_content: @ 的内容
+        :param channel: 发送使用的 itchat 实例, 默认为主账号
         """
+        channel = channel or self.channel
         try:
             if msg_type == 'text':
                 message = f"{at_content}{content}" if at_content else content
-                self.channel.send(message, to_user_name)
+                self._check_itchat_response(self._channel_call(channel.send, message, to_user_name))
             elif msg_type in ['img', 'video', 'file']:
-                local_file_path = self.download_file(content)
-                if not local_file_path:
-                    raise ValueError(f"无法下载文件: {content}")
-
-                if at_content:
-                    self.channel.send(at_content, to_user_name)
-
-                if msg_type == 'img':
-                    self.channel.send_image(local_file_path, to_user_name)
-                elif msg_type == 'video':
-                    self.channel.send_video(local_file_path, to_user_name)
-                elif msg_type == 'file':
-                    self.channel.send_file(local_file_path, to_user_name)
-
-                os.remove(local_file_path)
+                with self.media_cache.acquire(content) as local_file_path:
+                    if not local_file_path:
+                        raise self._download_error(content)
+
+                    if at_content:
+                        self._check_itchat_response(self._channel_call(channel.send, at_content, to_user_name))
+
+                    if msg_type == 'img':
+                        self._check_itchat_response(self._channel_call(channel.send_image, local_file_path, to_user_name))
+                    elif msg_type == 'video':
+                        self._check_itchat_response(self._channel_call(channel.send_video, local_file_path, to_user_name))
+                    elif msg_type == 'file':
+                        self._check_itchat_response(self._channel_call(channel.send_file, local_file_path, to_user_name))
             else:
                 raise ValueError(f"不支持的消息类型: {msg_type}")
         except Exception as e:
             logger.error(f"发送消息失败: {e}")
             raise
 
-    def download_file(self, url):
+    def _channel_call(self, func, *args):
         """
-        下载文件到本地。
-        :param url: 文件的 URL
+        调用微信接口并记录耗时, 接口抛出的异常转换为 ChannelError。
         """
-        try:
-            response = requests.get(url, timeout=22)
-            response.raise_for_status()
-            file_name = os.path.basename(url)
-            local_path = os.path.join(os.getcwd(), file_name)
-            with open(local_path, 'wb') as file:
-                file.write(response.content)
-            return local_path
-        except Exception as e:
-            logger.error(f"从 {url} 下载文件时出错: {e}")
-            return None
+        with STAGE_SECONDS.time(stage="channel"):
+            try:
+                return func(*args)
+            except Exception as e:
+                raise ChannelError(f"微信接口调用失败: {e}") from e
+
+    def _channel_of(self, target):
+        return target.account.channel if target.account is not None else self.channel
+
+    def _check_itchat_response(self, response):
+        """
+        itchat 发送失败时不抛出异常, 而是返回 BaseResponse.Ret 非 0 的结果, 转换为可重试的错误。
+        """
+        base_response = response.get("BaseResponse", {}) if isinstance(response, dict) else {}
+        ret = base_response.get("Ret", 0)
+        if ret != 0:
+            raise ChannelError(f"itchat 发送失败: {ret} {base_response.get('ErrMsg', '')}")
+        return response
 
     def get_help_text(self, **kwargs):
         return (
@@ -456,7 +1328,9 @@ class FileWatcherPlugin(Plugin):
             "2. 微信命令发送消息:\n"
             "   - $send_msg [微信备注名1, 微信备注名2] 消息内容\n"
             "   - $send_msg [微信备注名1, 微信备注名2] 消息内容 group[群聊1, 群聊2]\n"
-            "   - $send_msg [所有人] 消息内容 group[群聊1, 群聊2]"
+            "   - $send_msg [所有人] 消息内容 group[群聊1, 群聊2]\n"
+            "   - 末尾加 priority[urgent|normal|bulk] 时进入对应优先级的发送队列\n"
+            "   - $send_msg 后加 --dry-run 只预演发送计划, 不发送"
         )
 
 
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 追加写入的消息日志 (spool)
+
+
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import Future
+
+from plugins.send_msg.metrics import STAGE_SECONDS, COMMIT_BATCH
+
+
+# 初始化日志记录器
+logger = logging.getLogger(__name__)
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_FILE = "checkpoint"
+
+
+class MessageSpool:
+    """
+    只追加写入的消息日志。
+    每条记录分配递增的序号, 按分段文件顺序写入;
+    消费者通过 ack 确认, 连续确认的最大序号保存在 checkpoint 文件中。
+    checkpoint 文件批量保存: 推进 checkpoint_every 条或距上次保存 checkpoint_interval 秒时写入一次,
+    崩溃后最多重发这么多条已发送的消息; 已确认的分段在 checkpoint 保存后才删除。
+    """
+
+    def __init__(self, spool_dir, segment_bytes=4 * 1024 * 1024, fsync=True, checkpoint_every=100,
+                 checkpoint_interval=1.0):
+        self.spool_dir = spool_dir
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs(self.spool_dir, exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._file = None
+        self._acked = set()
+        # 顺序读取时的位置缓存: (上次读到的序号, 分段路径, 字节偏移)
+        self._read_pos = None
+
+        self.checkpoint = self._load_checkpoint()
+        # 已写入 checkpoint 文件的序号, 以及等待保存的定时器
+        self._saved_checkpoint = self.checkpoint
+        self._saved_at = time.monotonic()
+        self._save_timer = None
+        self._segments = self._list_segments()
+        self.next_seq = self._recover()
+        # 尚未确认的记录数, 在锁内更新, pending_count 不加锁读取
+        self._pending = self.next_seq - 1 - self.checkpoint
+
+    # ------------------------------------------------------------------ 写入
+
+    def append(self, record):
+        """
+        追加一条记录, 返回分配的序号。
+        """
+        return self.append_many([record])[0]
+
+    def append_many(self, records):
+        """
+        批量追加记录, 一次写入一次刷盘, 返回分配的序号列表。
+        """
+        with self._lock:
+            seqs = []
+            lines = []
+            for record in records:
+                seq = self.next_seq
+                self.next_seq += 1
+                seqs.append(seq)
+                lines.append(json.dumps({"seq": seq, "data": record}, ensure_ascii=False) + "\n")
+            if not lines:
+                return seqs
+            self._pending += len(lines)
+
+            file = self._active_file(seqs[0])
+            file.write("".join(lines).encode("utf-8"))
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+            return seqs
+
+    def _active_file(self, first_seq):
+        """
+        获取当前可写的分段文件, 超过大小上限时滚动到新分段。
+        """
+        if self._file is None:
+            if not self._segments:
+                self._segments.append((first_seq, self._segment_path(first_seq)))
+            self._file = open(self._segments[-1][1], "ab")
+
+        if self._file.tell() >= self.segment_bytes:
+            self._file.close()
+            self._segments.append((first_seq, self._segment_path(first_seq)))
+            self._file = open(self._segments[-1][1], "ab")
+        return self._file
+
+    # ------------------------------------------------------------------ 读取
+
+    def read(self, after_seq=None, limit=None):
+        """
+        读取序号大于 after_seq 的记录, 返回 [(seq, record), ...]。
+        after_seq 默认为当前 checkpoint。
+        """
+        if after_seq is None:
+            after_seq = self.checkpoint
+
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+            entries = []
+            start = self._locate(after_seq)
+            for index in range(start[0], len(self._segments)):
+                path = self._segments[index][1]
+                offset = start[1] if index == start[0] else 0
+                try:
+                    with open(path, "rb") as file:
+                        file.seek(offset)
+                        for raw in iter(file.readline, b""):
+                            if not raw.endswith(b"\n"):
+                                break
+                            offset += len(raw)
+                            entry = json.loads(raw)
+                            if entry["seq"] <= after_seq:
+                                continue
+                            entries.append((entry["seq"], entry["data"]))
+                            if limit is not None and len(entries) >= limit:
+                                self._read_pos = (entry["seq"], path, offset)
+                                return entries
+                except FileNotFoundError:
+                    # 分段已被压缩删除
+                    continue
+
+            if entries:
+                self._read_pos = (entries[-1][0], self._segments[-1][1], offset)
+            return entries
+
+    def _locate(self, after_seq):
+        """
+        返回读取 after_seq 之后记录的起点: (分段下标, 字节偏移)。
+        """
+        if self._read_pos and self._read_pos[0] == after_seq:
+            for index, (_, path) in enumerate(self._segments):
+                if path == self._read_pos[1]:
+                    return index, self._read_pos[2]
+
+        start = 0
+        for index, (base_seq, _) in enumerate(self._segments):
+            if base_seq <= after_seq + 1:
+                start = index
+        return start, 0
+
+    # ------------------------------------------------------------------ 确认
+
+    def ack(self, seq):
+        """
+        确认一条记录已处理完毕。
+        checkpoint 只会推进到连续确认的最大序号, 乱序确认会暂存在内存中。
+        """
+        with self._lock:
+            if seq <= self.checkpoint or seq in self._acked:
+                return
+            self._acked.add(seq)
+            self._pending -= 1
+            while self.checkpoint + 1 in self._acked:
+                self._acked.remove(self.checkpoint + 1)
+                self.checkpoint += 1
+            if self.checkpoint == self._saved_checkpoint:
+                return
+            if (self.checkpoint - self._saved_checkpoint >= self.checkpoint_every
+                    or time.monotonic() - self._saved_at >= self.checkpoint_interval):
+                self.flush_checkpoint()
+            elif self._save_timer is None:
+                # 之后没有新的确认时, 由定时器保存
+                self._save_timer = threading.Timer(self.checkpoint_interval, self.flush_checkpoint)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def flush_checkpoint(self):
+        """
+        保存当前的 checkpoint 并删除已全部确认的分段。
+        """
+        with self._lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if self.checkpoint == self._saved_checkpoint:
+                return
+            self._save_checkpoint()
+            self._saved_checkpoint = self.checkpoint
+            self._saved_at = time.monotonic()
+            self._compact()
+
+    def pending_count(self):
+        """
+        尚未确认的记录数。不等待 spool 的锁 (append_many 和 ack 持有锁时会刷盘), 可以在 API 的事件循环中调用。
+        """
+        return self._pending
+
+    def close(self):
+        self.flush_checkpoint()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # ------------------------------------------------------------------ 内部
+
+    def _segment_path(self, base_seq):
+        return os.path.join(self.spool_dir, f"{SEGMENT_PREFIX}{base_seq:020d}{SEGMENT_SUFFIX}")
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.spool_dir):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                base_seq = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                segments.append((base_seq, os.path.join(self.spool_dir, name)))
+        return sorted(segments)
+
+    def _recover(self):
+        """
+        从最后一个分段恢复下一个序号, 截掉崩溃时写了一半的尾行。
+        """
+        if not self._segments:
+            return self.checkpoint + 1
+
+        base_seq, path = self._segments[-1]
+        last_seq = base_seq - 1
+        good_bytes = 0
+        with open(path, "rb") as file:
+            for raw in iter(file.readline, b""):
+                if not raw.endswith(b"\n"):
+                    break
+                try:
+                    last_seq = json.loads(raw)["seq"]
+                except (ValueError, KeyError):
+                    break
+                good_bytes += len(raw)
+
+        if good_bytes != os.path.getsize(path):
+            logger.warning(f"spool 分段 {path} 尾部不完整, 截断到 {good_bytes} 字节。")
+            with open(path, "r+b") as file:
+                file.truncate(good_bytes)
+
+        return max(last_seq, self.checkpoint) + 1
+
+    def _load_checkpoint(self):
+        path = os.path.join(self.spool_dir, CHECKPOINT_FILE)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                return int(file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+        except ValueError as e:
+            logger.error(f"读取 spool checkpoint 出错: {e}")
+            return 0
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.spool_dir, CHECKPOINT_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            file.write(str(self.checkpoint))
+            file.flush()
+            if self.fsync:
+                os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+
+    def _compact(self):
+        """
+        删除所有记录都已确认的旧分段 (当前写入的分段除外)。
+        """
+        while len(self._segments) > 1 and self._segments[1][0] <= self.checkpoint + 1:
+            _, path = self._segments.pop(0)
+            if self._read_pos and self._read_pos[1] == path:
+                self._read_pos = None
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class SpoolWriter:
+    """
+    spool 的组提交写入线程。
+    调用方提交记录后得到 Future, 写入线程把 window 秒内到达的多个请求合并为一次写入和刷盘,
+    刷盘完成后调用 on_commit(序号列表, 记录列表), 再设置各 Future 的结果 (各自的序号列表)。
+    API 的事件循环只等待 Future, 不阻塞在磁盘 I/O 上。
+    """
+
+    def __init__(self, spool, window=0.002, max_records=10000, on_commit=None):
+        self.spool = spool
+        self.window = window
+        self.max_records = max_records
+        self.on_commit = on_commit
+
+        self._cond = threading.Condition()
+        # [(记录列表, Future)]
+        self._pending = []
+        self._pending_records = 0
+        self._thread = threading.Thread(target=self._run, name="send_msg-spool-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, records):
+        future = Future()
+        records = list(records)
+        if not records:
+            future.set_result([])
+            return future
+        with self._cond:
+            self._pending.append((records, future))
+            self._pending_records += len(records)
+            self._cond.notify_all()
+        return future
+
+    def write(self, records):
+        """
+        同步写入, 返回序号列表。
+        """
+        return self.submit(records).result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # 等待窗口内的其他请求, 记录数达到上限时提前写入
+                deadline = time.monotonic() + self.window
+                while self._pending_records < self.max_records:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, []
+                self._pending_records = 0
+            self._commit(batch)
+
+    def _commit(self, batch):
+        records = [record for request_records, _ in batch for record in request_records]
+        try:
+            with STAGE_SECONDS.time(stage="commit"):
+                seqs = self.spool.append_many(records)
+        except Exception as e:
+            logger.error(f"写入 spool 失败: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        COMMIT_BATCH.observe(len(batch))
+        if self.on_commit is not None:
+            try:
+                self.on_commit(seqs, records)
+            except Exception as e:
+                # 记录已经写入 spool, 插件启动时会重放, 不影响请求结果
+                logger.error(f"交接 spool 记录失败: {e}")
+        start = 0
+        for request_records, future in batch:
+            future.set_result(seqs[start:start + len(request_records)])
+            start += len(request_records)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : 模板消息: 一个模板加每个接收者的变量行, 发送时才渲染
+
+
+from string import Formatter
+from functools import lru_cache
+
+
+# 行中用于指定发送目标的列, 同时也可以在模板中引用
+TARGET_COLUMNS = ("receiver_name", "group_name")
+
+
+class MessageTemplate:
+    """
+    编译后的模板, 使用 str.format 语法的命名变量, 如 "你好 {name}, 订单 {id} 已发货"。
+    """
+
+    def __init__(self, source):
+        self.source = source
+        fields = set()
+        for _, field, _, _ in Formatter().parse(source):
+            if field is None:
+                continue
+            name = field.split(".")[0].split("[")[0]
+            if not name or name.isdigit():
+                raise ValueError(f"模板只支持命名变量: {source}")
+            fields.add(name)
+        self.fields = tuple(sorted(fields))
+
+    def render(self, values):
+        return self.source.format_map(values)
+
+
+@lru_cache(maxsize=128)
+def compile_template(source):
+    return MessageTemplate(source)
+
+
+class RenderedMessage:
+    """
+    延迟渲染的模板消息, str() 时才生成文本; 模板和变量相同的消息视为相同内容。
+    """
+
+    __slots__ = ("template", "values")
+
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+    def _key(self):
+        return self.template.source, tuple(str(self.values.get(field)) for field in self.template.fields)
+
+    def __str__(self):
+        return self.template.render(self.values)
+
+    def __eq__(self, other):
+        return isinstance(other, RenderedMessage) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+
+def is_template(data):
+    return "template" in data
+
+
+def iter_rows(data):
+    """
+    逐行返回变量字典。rows 为列表的列表 (按 columns 对应) 或字典列表。
+    """
+    columns = data.get("columns") or []
+    for row in data.get("rows") or []:
+        yield row if isinstance(row, dict) else dict(zip(columns, row))
+
+
+def validate_template_request(template, columns, rows, shared_targets):
+    """
+    检查模板变量与行数据是否匹配, 不匹配时抛出 ValueError。
+    shared_targets 为请求级别的 receiver_name/group_name 是否非空。
+    """
+    compiled = compile_template(template)
+    for index, row in enumerate(rows, start=1):
+        if isinstance(row, dict):
+            keys = row.keys()
+        else:
+            if len(row) != len(columns):
+                raise ValueError(f"第 {index} 行有 {len(row)} 列, 与 columns 的 {len(columns)} 列不一致")
+            keys = columns
+        missing = [field for field in compiled.fields if field not in keys]
+        if missing:
+            raise ValueError(f"第 {index} 行缺少模板变量: {', '.join(missing)}")
+        if not shared_targets and not any(column in keys for column in TARGET_COLUMNS):
+            raise ValueError(f"第 {index} 行没有 receiver_name 或 group_name")
+    return compiled
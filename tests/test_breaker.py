@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : CircuitBreaker 单元测试: 打开、半开与恢复
+
+
+import time
+
+import pytest
+
+from plugins.send_msg.accounts import Account
+from plugins.send_msg.benchmark.fakes import FakeItchat
+from plugins.send_msg.breaker import CircuitBreaker, CircuitOpenError, CLOSED, OPEN, HALF_OPEN
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_opens_after_threshold():
+    breaker = CircuitBreaker("test", failure_threshold=3, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.available()
+    with pytest.raises(CircuitOpenError) as info:
+        breaker.check()
+    assert info.value.retry_after >= 1.0
+    assert breaker.opened == 1
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+
+
+def test_half_open_allows_single_trial():
+    """
+    到期后放行一次调用, 探测结束前其他调用仍然快速失败。
+    """
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    assert wait_for(lambda: breaker.state == HALF_OPEN)
+    assert breaker.available()
+    breaker.check()
+    assert not breaker.available()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    breaker.check()
+
+
+def test_half_open_failure_reopens_with_backoff():
+    """
+    半开探测失败后重新打开, 打开时间加倍, 不超过 max_reset_timeout。
+    """
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05, max_reset_timeout=0.15)
+    breaker.record_failure()
+    assert wait_for(lambda: breaker.state == HALF_OPEN)
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert 0.05 < breaker.retry_after() <= 0.1
+    assert wait_for(lambda: breaker.state == HALF_OPEN)
+    breaker.check()
+    breaker.record_failure()
+    assert 0.1 < breaker.retry_after() <= 0.15
+    # 重新打开不计入打开次数
+    assert breaker.opened == 1
+
+
+def test_trip_and_reset():
+    breaker = CircuitBreaker("test", failure_threshold=5, reset_timeout=60)
+    breaker.trip(0.05)
+    assert breaker.state == OPEN
+    breaker.reset()
+    assert breaker.state == CLOSED
+    breaker.check()
+
+
+def test_probe_recovers_account():
+    """
+    有 probe 时由后台线程探测: 探测失败继续熔断, 成功后账号恢复可用。
+    """
+    channel = FakeItchat(friends=5, rooms=1, members=2)
+    healthy = []
+
+    def probe():
+        if not healthy:
+            raise ConnectionError("offline")
+        channel.get_friends(update=True)
+
+    account = Account("a", channel, "wx", failure_threshold=2, down_time=0.05, max_down_time=0.1, probe=probe)
+    account.record_failure()
+    account.record_failure()
+    assert not account.alive
+    with pytest.raises(CircuitOpenError):
+        account.breaker.check()
+
+    # 探测失败后仍不可用, 不放行发送作为探测
+    time.sleep(0.2)
+    assert account.breaker.state in (OPEN, HALF_OPEN)
+    assert not account.alive
+
+    healthy.append(True)
+    assert wait_for(lambda: account.alive, timeout=3)
+    assert account.breaker.state == CLOSED
+    account.breaker.check()
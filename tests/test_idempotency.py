@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : IdempotencyStore 单元测试: claim/release 与并发
+
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from plugins.send_msg.idempotency import IdempotencyStore, BloomFilter, NEW, DONE, PENDING
+
+
+def test_claim_complete_release():
+    store = IdempotencyStore()
+    assert store.claim("k") == (NEW, None)
+    assert store.claim("k") == (PENDING, None)
+    store.complete("k", {"seqs": [1]})
+    assert store.claim("k") == (DONE, {"seqs": [1]})
+
+    # 处理失败时 release, 下一次请求可以重新处理
+    assert store.claim("other") == (NEW, None)
+    store.release("other")
+    assert store.claim("other") == (NEW, None)
+
+
+def test_expired_entries_are_reclaimed():
+    store = IdempotencyStore(ttl=-1)
+    store.claim("k")
+    store.complete("k", "first")
+    assert store.claim_cached("k") == (NEW, None)
+
+
+def test_lru_eviction_without_disk():
+    store = IdempotencyStore(max_entries=2)
+    for key in ("a", "b", "c"):
+        store.claim(key)
+        store.complete(key, key)
+    assert len(store) == 2
+    assert store.claim("a") == (NEW, None)
+    assert store.claim("c") == (DONE, "c")
+
+
+def test_concurrent_claims_single_winner():
+    """
+    同一个 key 的并发请求只有一个得到 NEW。
+    """
+    store = IdempotencyStore()
+    barrier = threading.Barrier(16)
+
+    def claim(_):
+        barrier.wait()
+        return store.claim("k")[0]
+
+    with ThreadPoolExecutor(16) as executor:
+        results = list(executor.map(claim, range(16)))
+    assert results.count(NEW) == 1
+    assert results.count(PENDING) == 15
+
+
+def test_release_race_allows_one_retry():
+    """
+    release 之后的并发重试中仍然只有一个请求负责处理。
+    """
+    store = IdempotencyStore()
+    assert store.claim("k")[0] == NEW
+    store.release("k")
+    barrier = threading.Barrier(8)
+
+    def claim(_):
+        barrier.wait()
+        return store.claim("k")[0]
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(claim, range(8)))
+    assert results.count(NEW) == 1
+
+
+def test_disk_index_survives_restart(tmp_path):
+    """
+    LRU 中没有的 key 经布隆过滤器判断后查询磁盘; claim_cached 不查磁盘, 需要时返回 None。
+    """
+    path = str(tmp_path / "idempotency.db")
+    store = IdempotencyStore(max_entries=1, path=path, bloom_capacity=1000)
+    for key in ("a", "b"):
+        store.claim(key)
+        store.complete(key, {"key": key})
+
+    restarted = IdempotencyStore(path=path, bloom_capacity=1000)
+    assert restarted.claim_cached("a") is None
+    assert restarted.claim("a") == (DONE, {"key": "a"})
+    assert restarted.claim_cached("a") == (DONE, {"key": "a"})
+    # 布隆过滤器判断一定不存在的 key 不查询磁盘
+    assert restarted.claim_cached("missing") == (NEW, None)
+    assert restarted.claim_cached("missing") == (PENDING, None)
+
+
+def test_concurrent_claim_and_complete_with_disk(tmp_path):
+    """
+    写入磁盘期间的并发 claim: 每个 key 只处理一次, 完成后都返回第一次的结果。
+    """
+    store = IdempotencyStore(path=str(tmp_path / "idempotency.db"), bloom_capacity=1000)
+    keys = [f"k{i}" for i in range(50)]
+    winners = []
+    lock = threading.Lock()
+
+    def worker(key):
+        status, _ = store.claim(key)
+        if status == NEW:
+            with lock:
+                winners.append(key)
+            store.complete(key, key.upper())
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(worker, keys * 4))
+    assert sorted(winners) == sorted(keys)
+    assert all(store.claim(key) == (DONE, key.upper()) for key in keys)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(1000)
+    keys = [f"key-{i}" for i in range(1000)]
+    for key in keys:
+        bloom.add(key)
+    assert all(key in bloom for key in keys)
+    false_positives = sum(f"other-{i}" in bloom for i in range(1000))
+    assert false_positives < 50
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : Scheduler 单元测试: 日志重放与压缩
+
+
+import json
+import time
+import threading
+
+import pytest
+
+from plugins.send_msg.scheduler import Scheduler, parse_interval, parse_send_at
+
+
+def open_scheduler(path, on_fire=None, **kwargs):
+    kwargs.setdefault("fsync", False)
+    return Scheduler(str(path), on_fire=on_fire or (lambda messages: None), **kwargs)
+
+
+def journal_lines(path):
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file]
+
+
+def test_parse_helpers():
+    assert parse_interval("5m") == 300
+    assert parse_interval(2) == 2
+    assert parse_interval("0", allow_zero=True) == 0
+    assert parse_send_at(100) == 100.0
+    with pytest.raises(ValueError):
+        parse_interval("0")
+    with pytest.raises(ValueError):
+        parse_send_at("tomorrow")
+
+
+def test_add_is_idempotent_and_validates_whole_batch(tmp_path):
+    scheduler = open_scheduler(tmp_path / "schedule.jsonl")
+    later = time.time() + 3600
+    assert scheduler.add_many([(1, {"message": "a", "send_at": later})]) == ["1"]
+    assert scheduler.add_many([(1, {"message": "a", "send_at": later})]) == []
+    with pytest.raises(ValueError):
+        scheduler.add_many([(2, {"message": "b", "send_at": later}), (3, {"message": "c", "repeat": "x"})])
+    assert len(scheduler) == 1
+    assert scheduler.list()[0]["message"] == {"message": "a"}
+
+
+def test_journal_replay(tmp_path):
+    """
+    重启后按日志恢复: 添加的记录保留, 取消的记录不再出现。
+    """
+    path = tmp_path / "schedule.jsonl"
+    scheduler = open_scheduler(path)
+    later = time.time() + 3600
+    scheduler.add_many([(i, {"message": f"m{i}", "send_at": later + i}) for i in range(3)])
+    scheduler.add_many([("r", {"message": "daily", "send_at": later, "repeat": "1d"})])
+    assert scheduler.cancel(1)
+    assert not scheduler.cancel(1)
+
+    restored = open_scheduler(path)
+    assert sorted(entry["id"] for entry in restored.list()) == ["0", "2", "r"]
+    assert {entry["id"]: entry["repeat"] for entry in restored.list()}["r"] == 86400
+
+
+def test_journal_replay_skips_partial_tail(tmp_path):
+    """
+    崩溃时写了一半的尾行被忽略, 并重写日志, 之后追加的记录可以正常恢复。
+    """
+    path = tmp_path / "schedule.jsonl"
+    scheduler = open_scheduler(path)
+    later = time.time() + 3600
+    scheduler.add_many([("a", {"message": "a", "send_at": later})])
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('{"op": "add", "entry": {"id": "b"')
+
+    restored = open_scheduler(path)
+    assert [entry["id"] for entry in restored.list()] == ["a"]
+    restored.add_many([("c", {"message": "c", "send_at": later})])
+    assert sorted(entry["id"] for entry in open_scheduler(path).list()) == ["a", "c"]
+
+
+def test_journal_compaction(tmp_path):
+    """
+    日志行数远大于有效记录数时压缩为快照, 压缩后重放结果不变。
+    """
+    path = tmp_path / "schedule.jsonl"
+    scheduler = open_scheduler(path)
+    scheduler.compact_min = 10
+    later = time.time() + 3600
+    for i in range(20):
+        scheduler.add_many([(i, {"message": f"m{i}", "send_at": later})])
+        if i % 4:
+            scheduler.cancel(i)
+
+    lines = journal_lines(path)
+    assert len(lines) <= max(scheduler.compact_min, len(scheduler) * scheduler.compact_ratio)
+    kept = sorted(entry["id"] for entry in scheduler.list())
+    assert kept == sorted(str(i) for i in range(0, 20, 4))
+    assert sorted(entry["id"] for entry in open_scheduler(path).list()) == kept
+
+
+def test_fire_removes_one_shot_and_reschedules_repeat(tmp_path):
+    path = tmp_path / "schedule.jsonl"
+    fired = []
+    done = threading.Event()
+
+    def on_fire(messages):
+        fired.extend(message["message"] for message in messages)
+        done.set()
+
+    scheduler = open_scheduler(path, on_fire=on_fire)
+    now = time.time()
+    scheduler.add_many([("once", {"message": "once", "send_at": now - 1}),
+                        ("repeat", {"message": "repeat", "send_at": now - 1, "repeat": "1h"})])
+    scheduler.start()
+    try:
+        assert done.wait(5)
+        deadline = time.monotonic() + 5
+        while len(scheduler) != 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        scheduler.stop()
+    assert sorted(fired) == ["once", "repeat"]
+    [entry] = open_scheduler(path).list()
+    assert entry["id"] == "repeat" and entry["send_at"] > now
+
+
+def test_fire_error_retries_later(tmp_path):
+    """
+    on_fire 出错时消息不会丢失, retry_delay 秒后再次提交。
+    """
+    attempts = []
+    done = threading.Event()
+
+    def on_fire(messages):
+        attempts.append(messages)
+        if len(attempts) == 1:
+            raise OSError("disk full")
+        done.set()
+
+    scheduler = open_scheduler(tmp_path / "schedule.jsonl", on_fire=on_fire)
+    scheduler.retry_delay = 0.05
+    scheduler.add_many([("a", {"message": "a", "send_at": time.time() - 1})])
+    scheduler.start()
+    try:
+        assert done.wait(5)
+    finally:
+        scheduler.stop()
+    assert len(attempts) == 2
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+# Author:
+# E-mail:
+# Date  : 26-10-17
+# Desc  : MessageSpool 单元测试, 在 chatgpt-on-wechat 根目录执行: python -m pytest plugins/send_msg/tests
+
+
+import os
+import time
+
+from plugins.send_msg.spool import MessageSpool, SpoolWriter, CHECKPOINT_FILE
+
+
+def open_spool(path, **kwargs):
+    kwargs.setdefault("fsync", False)
+    return MessageSpool(str(path), **kwargs)
+
+
+def segment_files(path):
+    return sorted(name for name in os.listdir(path) if name.startswith("segment-"))
+
+
+def saved_checkpoint(path):
+    with open(os.path.join(path, CHECKPOINT_FILE), encoding="utf-8") as file:
+        return int(file.read())
+
+
+def test_append_assigns_sequential_seqs(tmp_path):
+    spool = open_spool(tmp_path)
+    assert spool.append({"message": "a"}) == 1
+    assert spool.append_many([{"message": "b"}, {"message": "c"}]) == [2, 3]
+    assert spool.append_many([]) == []
+    assert spool.read() == [(1, {"message": "a"}), (2, {"message": "b"}), (3, {"message": "c"})]
+    assert spool.read(after_seq=1, limit=1) == [(2, {"message": "b"})]
+    assert spool.pending_count() == 3
+
+
+def test_recover_across_segments(tmp_path):
+    """
+    重启后从多个分段恢复全部未确认的记录, 序号接着上次继续。
+    """
+    spool = open_spool(tmp_path, segment_bytes=64)
+    seqs = [spool.append({"message": f"m{i}"}) for i in range(10)]
+    spool.close()
+    assert len(segment_files(tmp_path)) > 1
+
+    spool = open_spool(tmp_path, segment_bytes=64)
+    assert [seq for seq, _ in spool.read()] == seqs
+    assert spool.append({"message": "next"}) == 11
+    assert spool.pending_count() == 11
+
+
+def test_recover_truncates_partial_tail(tmp_path):
+    """
+    崩溃时写了一半的尾行在恢复时截掉, 新记录不会接在残缺的行后面。
+    """
+    spool = open_spool(tmp_path)
+    spool.append_many([{"message": "a"}, {"message": "b"}])
+    spool.close()
+    path = os.path.join(tmp_path, segment_files(tmp_path)[-1])
+    size = os.path.getsize(path)
+    with open(path, "ab") as file:
+        file.write(b'{"seq": 3, "data": {"mess')
+
+    spool = open_spool(tmp_path)
+    assert os.path.getsize(path) == size
+    assert spool.append({"message": "c"}) == 3
+    assert spool.read() == [(1, {"message": "a"}), (2, {"message": "b"}), (3, {"message": "c"})]
+
+
+def test_out_of_order_ack(tmp_path):
+    """
+    checkpoint 只推进到连续确认的最大序号。
+    """
+    spool = open_spool(tmp_path, checkpoint_every=1)
+    spool.append_many([{"message": str(i)} for i in range(5)])
+    spool.ack(3)
+    spool.ack(2)
+    assert spool.checkpoint == 0
+    assert spool.pending_count() == 3
+    spool.ack(1)
+    assert spool.checkpoint == 3
+    spool.ack(5)
+    assert spool.checkpoint == 3
+    spool.ack(4)
+    assert spool.checkpoint == 5
+    # 重复确认不会改变计数
+    spool.ack(5)
+    spool.ack(1)
+    assert spool.pending_count() == 0
+    assert spool.read() == []
+
+
+def test_checkpoint_saved_in_batches(tmp_path):
+    """
+    推进 checkpoint_every 条才写入 checkpoint 文件, 未保存的确认重启后会重放。
+    """
+    spool = open_spool(tmp_path, checkpoint_every=3, checkpoint_interval=60)
+    spool.append_many([{"message": str(i)} for i in range(5)])
+    spool.ack(1)
+    spool.ack(2)
+    assert not os.path.exists(os.path.join(tmp_path, CHECKPOINT_FILE))
+    spool.ack(3)
+    assert saved_checkpoint(tmp_path) == 3
+    spool.ack(4)
+    assert saved_checkpoint(tmp_path) == 3
+
+    # 模拟崩溃: 不调用 close, 第 4 条会重放
+    spool = open_spool(tmp_path)
+    assert spool.checkpoint == 3
+    assert [seq for seq, _ in spool.read()] == [4, 5]
+    assert spool.pending_count() == 2
+
+
+def test_checkpoint_saved_by_timer(tmp_path):
+    """
+    之后没有新的确认时, checkpoint_interval 秒后由定时器保存。
+    """
+    spool = open_spool(tmp_path, checkpoint_every=100, checkpoint_interval=0.05)
+    spool.append_many([{"message": "a"}, {"message": "b"}])
+    spool.ack(1)
+    deadline = time.monotonic() + 2
+    while not os.path.exists(os.path.join(tmp_path, CHECKPOINT_FILE)) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert saved_checkpoint(tmp_path) == 1
+
+
+def test_compaction_removes_acked_segments(tmp_path):
+    """
+    已全部确认的分段在 checkpoint 保存后删除, 当前写入的分段保留。
+    """
+    spool = open_spool(tmp_path, segment_bytes=64, checkpoint_every=100, checkpoint_interval=60)
+    seqs = [spool.append({"message": f"m{i}"}) for i in range(10)]
+    segments = len(segment_files(tmp_path))
+    assert segments > 2
+
+    for seq in seqs[:5]:
+        spool.ack(seq)
+    # checkpoint 尚未保存, 分段不能删除
+    assert len(segment_files(tmp_path)) == segments
+    spool.flush_checkpoint()
+    remaining = len(segment_files(tmp_path))
+    assert 1 <= remaining < segments
+    assert [seq for seq, _ in spool.read()] == seqs[5:]
+
+    for seq in seqs[5:]:
+        spool.ack(seq)
+    spool.close()
+    assert len(segment_files(tmp_path)) == 1
+
+    spool = open_spool(tmp_path, segment_bytes=64)
+    assert spool.read() == []
+    assert spool.append({"message": "next"}) == 11
+
+
+def test_spool_writer_group_commit(tmp_path):
+    spool = open_spool(tmp_path)
+    committed = []
+    writer = SpoolWriter(spool, window=0.05, on_commit=lambda seqs, records: committed.append(seqs))
+    first = writer.submit([{"message": "a"}, {"message": "b"}])
+    second = writer.submit([{"message": "c"}])
+    assert first.result(timeout=5) == [1, 2]
+    assert second.result(timeout=5) == [3]
+    assert committed == [[1, 2, 3]]
+    assert writer.write([]) == []